@@ -0,0 +1,108 @@
+# SSE 解析性能对比：旧的字符串拼接 + 正则循环 与 SSEDecoder
+# 用法（在项目根目录下运行）：
+#   python benchmarks/bench_sse_decoder.py
+#   python benchmarks/bench_sse_decoder.py --recording stream.bin
+# 未指定 --recording 时会按上游格式合成一个 50k token 的流，每个事件携带截至当前的完整 parts
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+from main import SSEDecoder  # noqa: E402
+
+
+def synthesize_stream(tokens, tokens_per_event):
+    words = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit"]
+    parts = []
+    events = []
+    for index in range(tokens):
+        parts.append(" " + words[index % len(words)])
+        if (index + 1) % tokens_per_event == 0 or index == tokens - 1:
+            data = {
+                "message": {
+                    "id": "bench",
+                    "author": {"role": "assistant"},
+                    "content": {"content_type": "text", "parts": ["".join(parts)]},
+                    "status": "in_progress",
+                    "metadata": {}
+                },
+                "conversation_id": "bench"
+            }
+            events.append("data: " + json.dumps(data) + "\n\n")
+            if len(events) % 20 == 0:
+                events.append("event: ping\ndata: 2024-01-01 00:00:00.000000\n\n")
+    events.append("data: [DONE]\n\n")
+    return "".join(events).encode("utf-8")
+
+
+def iter_chunks(stream, chunk_size):
+    for start in range(0, len(stream), chunk_size):
+        yield stream[start:start + chunk_size]
+
+
+def legacy_loop(stream, chunk_size):
+    # 与改造前 data_fetcher 中的处理方式一致
+    count = 0
+    buffer = ""
+    for chunk in iter_chunks(stream, chunk_size):
+        buffer += chunk.decode('utf-8')
+        if "event: ping" in buffer:
+            if "data:" in buffer:
+                buffer = buffer.split("data:", 1)[1]
+                buffer = "data:" + buffer
+        buffer = re.sub(r'data: \d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d{6}(\r\n|\r|\n){2}', '', buffer)
+        while 'data:' in buffer and '\n\n' in buffer:
+            end_index = buffer.index('\n\n') + 2
+            complete_data, buffer = buffer[:end_index], buffer[end_index:]
+            if complete_data[6:].strip():
+                count += 1
+    return count
+
+
+def decoder_loop(stream, chunk_size):
+    count = 0
+    sse_decoder = SSEDecoder()
+    for chunk in iter_chunks(stream, chunk_size):
+        for _ in sse_decoder.feed(chunk):
+            count += 1
+    sse_decoder.flush()
+    return count
+
+
+def measure(func, stream, chunk_size):
+    start = time.perf_counter()
+    count = func(stream, chunk_size)
+    return count, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--recording', help='录制的上游原始 SSE 响应文件')
+    parser.add_argument('--tokens', type=int, default=50000)
+    parser.add_argument('--tokens-per-event', type=int, default=50)
+    parser.add_argument('--chunk-size', type=int, default=1024)
+    args = parser.parse_args()
+
+    if args.recording:
+        with open(args.recording, 'rb') as file:
+            stream = file.read()
+    else:
+        stream = synthesize_stream(args.tokens, args.tokens_per_event)
+    print(f"stream size: {len(stream) / 1024 / 1024:.1f} MiB, chunk size: {args.chunk_size}")
+
+    new_count, new_time = measure(decoder_loop, stream, args.chunk_size)
+    print(f"SSEDecoder : {new_count} events, {new_time:.3f}s")
+    old_count, old_time = measure(legacy_loop, stream, args.chunk_size)
+    print(f"legacy loop: {old_count} events, {old_time:.3f}s")
+    if new_time:
+        print(f"speedup: {old_time / new_time:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
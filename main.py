@@ -1,5 +1,6 @@
 # 导入所需的库
 import base64
+import codecs
 import hashlib
 import json
 import logging
@@ -8,14 +9,11 @@ import os
 import requests
 import uuid
 from datetime import datetime
-from fake_useragent import UserAgent
-from flask import Flask, request, jsonify, Response, send_from_directory
-from flask_apscheduler import APScheduler
+from flask import Flask, request, jsonify, Response, send_file
 from flask_cors import CORS, cross_origin
 from io import BytesIO
 from logging.handlers import TimedRotatingFileHandler
 from queue import Queue
-from urllib.parse import urlparse
 
 
 # 读取配置文件
@@ -44,6 +42,7 @@ GPT_4_O_NEW_NAMES = CONFIG.get('gpt_4_o_new_name', 'gpt-4o').split(',')
 GPT_4_O_MINI_NEW_NAMES = CONFIG.get('gpt_4_o_mini_new_name', 'gpt-4o-mini').split(',')
 O1_PREVIEW_NEW_NAMES = CONFIG.get('o1_preview_new_name', 'o1-preview').split(',')
 O1_MINI_NEW_NAMES = CONFIG.get('o1_mini_new_name', 'o1-mini').split(',')
+UPSTREAM_MODELS_CONFIG = CONFIG.get('upstream_models', {})
 UPLOAD_SUCCESS_TEXT = CONFIG.get('upload_success_text', "`🤖 文件上传成功，搜索将不再提供额外信息！`\n")
 
 BOT_MODE = CONFIG.get('bot_mode', {})
@@ -60,6 +59,9 @@ REFRESH_TOACCESS_ENABLEOAI = REFRESH_TOACCESS.get('enableOai', 'true').lower() =
 REFRESH_TOACCESS_OAIFREE_REFRESHTOACCESS_URL = REFRESH_TOACCESS.get('oaifree_refreshToAccess_Url', '')
 STEAM_SLEEP_TIME = REFRESH_TOACCESS.get('steam_sleep_time', 0)
 
+# 是否向上游声明支持 v1 增量编码，上游支持时只下发新增内容
+UPSTREAM_DELTA_ENCODING = CONFIG.get('upstream_delta_encoding', 'false').lower() == 'true'
+
 NEED_DELETE_CONVERSATION_AFTER_RESPONSE = CONFIG.get('need_delete_conversation_after_response',
                                                      'true').lower() == 'true'
 
@@ -81,11 +83,102 @@ REDIS_CONFIG_PASSWORD = REDIS_CONFIG.get('password', '')
 REDIS_CONFIG_DB = REDIS_CONFIG.get('db', 0)
 REDIS_CONFIG_POOL_SIZE = REDIS_CONFIG.get('pool_size', 10)
 REDIS_CONFIG_POOL_TIMEOUT = REDIS_CONFIG.get('pool_timeout', 30)
-
-# 定义全部变量，用于缓存refresh_token和access_token
-# 其中refresh_token 为 key
-# access_token 为 value
-refresh_dict = {}
+# 兼容旧配置中以毫秒填写的 pool_timeout
+if REDIS_CONFIG_POOL_TIMEOUT > 1000:
+    REDIS_CONFIG_POOL_TIMEOUT = REDIS_CONFIG_POOL_TIMEOUT / 1000
+REDIS_CONFIG_SOCKET_TIMEOUT = REDIS_CONFIG.get('socket_timeout', 5)
+REDIS_CONFIG_CONNECT_TIMEOUT = REDIS_CONFIG.get('connect_timeout', 5)
+REDIS_CONFIG_HEALTH_CHECK_INTERVAL = REDIS_CONFIG.get('health_check_interval', 30)
+REDIS_CONFIG_RETRY_INTERVAL = REDIS_CONFIG.get('retry_interval', 10)
+REDIS_CONFIG_LRU_SIZE = REDIS_CONFIG.get('lru_size', 4096)
+REDIS_CONFIG_KEY_PREFIX = REDIS_CONFIG.get('key_prefix', 'r2v')
+
+# 上游 HTTP 连接池配置读取
+HTTP_CLIENT_CONFIG = CONFIG.get('http_client', {})
+HTTP_CLIENT_POOL_CONNECTIONS = HTTP_CLIENT_CONFIG.get('pool_connections', 10)
+HTTP_CLIENT_POOL_MAXSIZE = HTTP_CLIENT_CONFIG.get('pool_maxsize', 50)
+HTTP_CLIENT_POOL_BLOCK = HTTP_CLIENT_CONFIG.get('pool_block', 'false').lower() == 'true'
+HTTP_CLIENT_CONNECT_TIMEOUT = HTTP_CLIENT_CONFIG.get('connect_timeout', 10)
+HTTP_CLIENT_READ_TIMEOUT = HTTP_CLIENT_CONFIG.get('read_timeout', 300)
+
+# 上游前缀负载均衡配置读取
+UPSTREAM_BALANCER = CONFIG.get('upstream_balancer', {})
+UPSTREAM_BALANCER_STRATEGY = UPSTREAM_BALANCER.get('strategy', 'round_robin').lower()
+UPSTREAM_BALANCER_COOLDOWN = UPSTREAM_BALANCER.get('cooldown', 30)
+UPSTREAM_BALANCER_PROBE_PATH = UPSTREAM_BALANCER.get('probe_path', '/backend-api/me')
+
+# 服务运行模式：threaded 为 Flask 多线程服务；asgi 时流式对话在 asyncio 事件循环中处理；
+# gunicorn 为多进程 WSGI 服务，asgi 模式下 workers 大于 1 时同样由 gunicorn 管理多个进程
+SERVER_CONFIG = CONFIG.get('server', {})
+SERVER_MODE = SERVER_CONFIG.get('mode', 'threaded').lower()
+SERVER_WORKERS = SERVER_CONFIG.get('workers', 1)
+SERVER_THREADS = SERVER_CONFIG.get('threads', 10)
+SERVER_GRACEFUL_TIMEOUT = SERVER_CONFIG.get('graceful_timeout', 30)
+SERVER_HEARTBEAT_INTERVAL = SERVER_CONFIG.get('heartbeat_interval', 1)
+SERVER_USES_GUNICORN = SERVER_MODE == 'gunicorn' or (SERVER_MODE == 'asgi' and SERVER_WORKERS > 1)
+# 快速启动：先使用内置模型提供服务，GPTs 配置信息在后台加载
+SERVER_FAST_START = SERVER_CONFIG.get('fast_start', 'false').lower() == 'true'
+
+# use_oaiusercontent_url 为 false 时，生成的图片在后台下载保存到 ./images
+IMAGE_STORAGE = CONFIG.get('image_storage', {})
+IMAGE_STORAGE_WORKERS = IMAGE_STORAGE.get('workers', 4)
+IMAGE_STORAGE_WAIT_TIMEOUT = IMAGE_STORAGE.get('wait_timeout', 30)
+
+# ./images 和 ./files 的清理策略，max_size 按目录分别计算，为 0 时不限制
+STORAGE = CONFIG.get('storage', {})
+STORAGE_MAX_SIZE = STORAGE.get('max_size', 1024 * 1024 * 1024)
+STORAGE_MAX_AGE = STORAGE.get('max_age', 7 * 24 * 3600)
+STORAGE_SWEEP_INTERVAL = STORAGE.get('sweep_interval', 3600)
+
+# /images、/files 的发送方式：none 由本服务发送（gunicorn 下使用 sendfile），
+# x-accel-redirect 交给 nginx 发送，x-sendfile 交给 Apache/lighttpd 发送
+STATIC_FILES = CONFIG.get('static_files', {})
+STATIC_FILES_OFFLOAD = STATIC_FILES.get('offload', 'none').lower()
+STATIC_FILES_ACCEL_PREFIX = STATIC_FILES.get('accel_prefix', '/internal/')
+STATIC_FILES_CACHE_MAX_AGE = STATIC_FILES.get('cache_max_age', 31536000)
+STATIC_FILES_ALIAS_CACHE_MAX_AGE = STATIC_FILES.get('alias_cache_max_age', 300)
+
+# usage 中 token 数的统计配置
+TOKEN_USAGE = CONFIG.get('token_usage', {})
+TOKEN_USAGE_PROMPT_CACHE_SIZE = TOKEN_USAGE.get('prompt_cache_size', 4096)
+
+# GPTS 配置信息的并发获取数和 Redis 缓存时间
+GPTS_CACHE = CONFIG.get('gpts_cache', {})
+GPTS_CACHE_WORKERS = GPTS_CACHE.get('workers', 16)
+GPTS_CACHE_TTL = GPTS_CACHE.get('ttl', 604800)
+
+# refresh_token 换取的 access_token 缓存配置
+TOKEN_CACHE = CONFIG.get('token_cache', {})
+TOKEN_CACHE_LRU_SIZE = TOKEN_CACHE.get('lru_size', 1024)
+TOKEN_CACHE_REFRESH_BEFORE = TOKEN_CACHE.get('refresh_before', 3600)
+TOKEN_CACHE_DEFAULT_TTL = TOKEN_CACHE.get('default_ttl', 86400)
+TOKEN_CACHE_LOCK_TIMEOUT = TOKEN_CACHE.get('lock_timeout', 30)
+# 设置后 refresh_token 加密保存在 Redis 中，所有进程用过的 refresh_token 都会被定时刷新
+TOKEN_CACHE_INDEX_SECRET = TOKEN_CACHE.get('index_secret', '')
+
+# 已上传文件的缓存配置，单位为秒
+FILE_CACHE = CONFIG.get('file_cache', {})
+FILE_CACHE_TRUST_TTL = FILE_CACHE.get('trust_ttl', 1800)
+FILE_CACHE_REVALIDATE_AFTER = FILE_CACHE.get('revalidate_after', 300)
+FILE_CACHE_NEGATIVE_TTL = FILE_CACHE.get('negative_ttl', 300)
+FILE_CACHE_TTL = FILE_CACHE.get('ttl', 2592000)
+
+# 多模态消息中附件（image_url）的并发处理配置
+ATTACHMENTS = CONFIG.get('attachments', {})
+ATTACHMENTS_WORKERS = ATTACHMENTS.get('workers', 8)
+ATTACHMENTS_POOL_SIZE = ATTACHMENTS.get('pool_size', 32)
+ATTACHMENTS_TIMEOUT = ATTACHMENTS.get('timeout', 60)
+ATTACHMENTS_MAX_SIZE = ATTACHMENTS.get('max_size', 50 * 1024 * 1024)
+ATTACHMENTS_FETCH_TIMEOUT = ATTACHMENTS.get('fetch_timeout', 30)
+
+# 后台批量刷新 access_token 的配置
+TOKEN_REFRESHER = CONFIG.get('token_refresher', {})
+TOKEN_REFRESHER_INTERVAL = TOKEN_REFRESHER.get('interval', 600)
+TOKEN_REFRESHER_REFRESH_AHEAD = TOKEN_REFRESHER.get('refresh_ahead', 86400)
+TOKEN_REFRESHER_WORKERS = TOKEN_REFRESHER.get('workers', 8)
+TOKEN_REFRESHER_RATE = TOKEN_REFRESHER.get('rate', 5)
+TOKEN_REFRESHER_BURST = TOKEN_REFRESHER.get('burst', 10)
+TOKEN_REFRESHER_RETRIES = TOKEN_REFRESHER.get('retries', 3)
 
 # 设置日志级别
 log_level_dict = {
@@ -103,16 +196,25 @@ logger.setLevel(log_level_dict.get(LOG_LEVEL, logging.DEBUG))
 
 import redis
 
-# 假设您已经有一个Redis客户端的实例
-redis_client = redis.StrictRedis(host=REDIS_CONFIG_HOST,
-                                 port=REDIS_CONFIG_PORT,
-                                 password=REDIS_CONFIG_PASSWORD,
-                                 db=REDIS_CONFIG_DB,
-                                 retry_on_timeout=True
-                                 )
+# 连接数达到 pool_size 时最多等待 pool_timeout 秒，Redis 响应慢时不会无限期占住请求线程
+redis_pool = redis.BlockingConnectionPool(host=REDIS_CONFIG_HOST,
+                                          port=REDIS_CONFIG_PORT,
+                                          password=REDIS_CONFIG_PASSWORD,
+                                          db=REDIS_CONFIG_DB,
+                                          max_connections=REDIS_CONFIG_POOL_SIZE,
+                                          timeout=REDIS_CONFIG_POOL_TIMEOUT,
+                                          socket_timeout=REDIS_CONFIG_SOCKET_TIMEOUT,
+                                          socket_connect_timeout=REDIS_CONFIG_CONNECT_TIMEOUT,
+                                          health_check_interval=REDIS_CONFIG_HEALTH_CHECK_INTERVAL,
+                                          retry_on_timeout=True
+                                          )
+redis_client = redis.StrictRedis(connection_pool=redis_pool)
+
+# 多个 gunicorn worker 写同一个按天分割的日志文件时会互相覆盖，此时只输出到控制台
+LOG_TO_FILE_DISABLED = NEED_LOG_TO_FILE and SERVER_USES_GUNICORN and SERVER_WORKERS > 1
 
 # 如果环境变量指示需要输出到文件
-if NEED_LOG_TO_FILE:
+if NEED_LOG_TO_FILE and not LOG_TO_FILE_DISABLED:
     log_filename = './log/access.log'
     file_handler = TimedRotatingFileHandler(log_filename, when="midnight", interval=1, backupCount=30)
     file_handler.setFormatter(log_formatter)
@@ -122,24 +224,247 @@ if NEED_LOG_TO_FILE:
 stream_handler = logging.StreamHandler()
 stream_handler.setFormatter(log_formatter)
 logger.addHandler(stream_handler)
+if LOG_TO_FILE_DISABLED:
+    logger.warning("多进程运行时不输出日志文件，日志只输出到控制台")
+
+import threading
+
+
+class LazyUserAgent:
+    """
+    首次使用时才创建 FakeUserAgent 对象，避免启动时加载浏览器数据
+    """
+
+    def __init__(self):
+        self.user_agent = None
+        self.lock = threading.Lock()
+
+    @property
+    def random(self):
+        if self.user_agent is None:
+            with self.lock:
+                if self.user_agent is None:
+                    from fake_useragent import UserAgent
+                    self.user_agent = UserAgent()
+        return self.user_agent.random
+
 
 # 创建FakeUserAgent对象
-ua = UserAgent()
+ua = LazyUserAgent()
 
-import threading
+import time
 
-#  开启线程锁
-lock = threading.Lock()
+from http.cookiejar import DefaultCookiePolicy
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 
+# 连接池命中统计，acquired 为取连接次数，misses 为新建连接次数
+http_pool_stats = {'acquired': 0, 'misses': 0}
+http_pool_stats_lock = threading.Lock()
 
-def getPROXY_API_PREFIX(lock):
-    index = 0
-    while True:
-        with lock:
-            if not PROXY_API_PREFIX:
+
+def record_http_pool_event(key):
+    with http_pool_stats_lock:
+        http_pool_stats[key] += 1
+
+
+class CountingPoolMixin:
+    # _get_conn 在池中没有空闲连接时会调用 _new_conn 新建连接
+    def _get_conn(self, timeout=None):
+        record_http_pool_event('acquired')
+        return super()._get_conn(timeout=timeout)
+
+    def _new_conn(self):
+        record_http_pool_event('misses')
+        return super()._new_conn()
+
+
+class CountingHTTPConnectionPool(CountingPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class CountingHTTPSConnectionPool(CountingPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class UpstreamHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool
+        }
+
+
+class UpstreamSession(requests.Session):
+    def request(self, method, url, **kwargs):
+        # 未显式指定超时时间的请求统一使用配置中的连接/读取超时
+        kwargs.setdefault('timeout', (HTTP_CLIENT_CONNECT_TIMEOUT, HTTP_CLIENT_READ_TIMEOUT))
+        return super().request(method, url, **kwargs)
+
+
+def create_http_client():
+    session = UpstreamSession()
+    # 不同用户的请求共用同一个会话，禁止保存上游下发的 cookie
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    adapter = UpstreamHTTPAdapter(pool_connections=HTTP_CLIENT_POOL_CONNECTIONS,
+                                  pool_maxsize=HTTP_CLIENT_POOL_MAXSIZE,
+                                  pool_block=HTTP_CLIENT_POOL_BLOCK)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# 全局共享的上游 HTTP 客户端，按 host 复用 keep-alive 连接
+http_client = create_http_client()
+
+
+def get_http_pool_stats():
+    with http_pool_stats_lock:
+        acquired = http_pool_stats['acquired']
+        misses = http_pool_stats['misses']
+    hits = max(acquired - misses, 0)
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": round(hits / acquired, 4) if acquired else 0.0,
+        "pool_connections": HTTP_CLIENT_POOL_CONNECTIONS,
+        "pool_maxsize": HTTP_CLIENT_POOL_MAXSIZE,
+        "connect_timeout": HTTP_CLIENT_CONNECT_TIMEOUT,
+        "read_timeout": HTTP_CLIENT_READ_TIMEOUT
+    }
+
+
+class UpstreamPrefix:
+    def __init__(self, prefix, weight=1):
+        self.prefix = "/" + prefix
+        self.weight = max(int(weight), 1)
+        self.current_weight = 0
+        self.inflight = 0
+        self.requests = 0
+        self.failures = 0
+        # 被摘除时记录冷却结束时间，0 表示正常可用
+        self.ejected_until = 0
+        self.probing = False
+
+
+class UpstreamSelector:
+    """
+    在 upstream_api_prefix 中选择本次请求使用的前缀。
+
+    支持 round_robin、weighted（平滑加权轮询）和 least_inflight 三种策略，
+    返回 429/5xx 的前缀会被摘除 cooldown 秒，冷却结束后经健康检查通过再重新加入。
+    """
+
+    def __init__(self, entries, strategy='round_robin', cooldown=30, probe_path='/backend-api/me'):
+        self.lock = threading.Lock()
+        self.strategy = strategy
+        self.cooldown = cooldown
+        self.probe_path = probe_path
+        self.rr_index = 0
+        if isinstance(entries, str):
+            entries = [entries] if entries else []
+        self.upstreams = []
+        for entry in entries or []:
+            if isinstance(entry, dict):
+                self.upstreams.append(UpstreamPrefix(entry.get('prefix', ''), entry.get('weight', 1)))
+            else:
+                self.upstreams.append(UpstreamPrefix(entry))
+        self.by_prefix = {upstream.prefix: upstream for upstream in self.upstreams}
+
+    def has_upstreams(self):
+        return bool(self.upstreams)
+
+    def acquire(self):
+        with self.lock:
+            if not self.upstreams:
                 return None
+            now = time.time()
+            candidates = []
+            for upstream in self.upstreams:
+                if not upstream.ejected_until:
+                    candidates.append(upstream)
+                elif upstream.ejected_until <= now and not upstream.probing:
+                    upstream.probing = True
+                    threading.Thread(target=self.probe, args=(upstream,), daemon=True).start()
+
+            if not candidates:
+                # 全部被摘除时退而求其次，选择最早结束冷却的前缀
+                upstream = min(self.upstreams, key=lambda u: u.ejected_until)
+            elif self.strategy == 'weighted':
+                total = 0
+                upstream = None
+                for candidate in candidates:
+                    candidate.current_weight += candidate.weight
+                    total += candidate.weight
+                    if upstream is None or candidate.current_weight > upstream.current_weight:
+                        upstream = candidate
+                upstream.current_weight -= total
+            elif self.strategy == 'least_inflight':
+                # 并发数相同时从轮询位置开始取，避免总是落在第一个前缀上
+                start = self.rr_index % len(candidates)
+                ordered = candidates[start:] + candidates[:start]
+                upstream = min(ordered, key=lambda u: u.inflight / u.weight)
+                self.rr_index += 1
             else:
-                return "/" + (PROXY_API_PREFIX[index % len(PROXY_API_PREFIX)])
+                upstream = candidates[self.rr_index % len(candidates)]
+                self.rr_index += 1
+
+            upstream.inflight += 1
+            upstream.requests += 1
+            return upstream.prefix
+
+    def release(self, prefix, status_code=None, failed=False):
+        with self.lock:
+            upstream = self.by_prefix.get(prefix)
+            if upstream is None:
+                return
+            upstream.inflight = max(upstream.inflight - 1, 0)
+            if failed or status_code == 429 or (status_code is not None and status_code >= 500):
+                upstream.failures += 1
+                if not upstream.ejected_until:
+                    logger.warning(f"上游前缀 {prefix} 返回 {status_code}，摘除 {self.cooldown} 秒")
+                upstream.ejected_until = time.time() + self.cooldown
+
+    def probe(self, upstream):
+        healthy = False
+        status_code = None
+        headers = {}
+        if KEY_FOR_GPTS_INFO_ACCESS_TOKEN.startswith("eyJhb"):
+            headers['Authorization'] = f"Bearer {KEY_FOR_GPTS_INFO_ACCESS_TOKEN}"
+        try:
+            response = http_client.get(f"{BASE_URL}{upstream.prefix}{self.probe_path}", headers=headers,
+                                       timeout=(HTTP_CLIENT_CONNECT_TIMEOUT, HTTP_CLIENT_CONNECT_TIMEOUT))
+            status_code = response.status_code
+            response.close()
+            # 带凭证时只有 2xx 算健康；没有凭证时 401 说明前缀有效、请求已到达上游鉴权，也算健康
+            healthy = 200 <= status_code < 300 or (status_code == 401 and not headers)
+        except Exception as e:
+            logger.warning(f"上游前缀 {upstream.prefix} 健康检查异常: {e}")
+        with self.lock:
+            upstream.probing = False
+            if healthy:
+                upstream.ejected_until = 0
+                logger.info(f"上游前缀 {upstream.prefix} 健康检查通过({status_code})，重新加入")
+            else:
+                upstream.ejected_until = time.time() + self.cooldown
+                logger.warning(f"上游前缀 {upstream.prefix} 健康检查失败({status_code})，继续摘除")
+
+    def snapshot(self):
+        # 前缀本身相当于密钥，只按配置中的顺序编号
+        with self.lock:
+            return [{
+                "index": index,
+                "weight": upstream.weight,
+                "inflight": upstream.inflight,
+                "requests": upstream.requests,
+                "failures": upstream.failures,
+                "ejected": bool(upstream.ejected_until)
+            } for index, upstream in enumerate(self.upstreams)]
+
+
+upstream_selector = UpstreamSelector(PROXY_API_PREFIX, UPSTREAM_BALANCER_STRATEGY, UPSTREAM_BALANCER_COOLDOWN,
+                                     UPSTREAM_BALANCER_PROBE_PATH)
 
 
 def generate_unique_id(prefix):
@@ -152,15 +477,178 @@ def generate_unique_id(prefix):
     return unique_id
 
 
+class ModelRegistry:
+    """
+    模型注册表：按模型名称建立字典索引，预先计算 ori_name 和 GPTS 的 payload 模板；
+    写入时复制出新的索引再整体替换，读取方不会看到更新到一半的列表
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (名称 -> 配置, 按添加顺序排列的名称)，两者作为一个整体替换
+        self.state = ({}, ())
+
+    @staticmethod
+    def prepare(config):
+        config = dict(config)
+        config['ori_name'] = config.get('ori_name', config['name'])
+        gizmo_info = config.get('config')
+        if gizmo_info:
+            config['payload_template'] = {
+                "action": "next",
+                "model": "gpt-4-gizmo",
+                "timezone_offset_min": -480,
+                "history_and_training_disabled": False,
+                "conversation_mode": {
+                    "gizmo": gizmo_info,
+                    "kind": "gizmo_interaction",
+                    "gizmo_id": gizmo_info['gizmo']['id']
+                },
+                "force_paragen": False,
+                "force_rate_limit": False
+            }
+        return config
+
+    def replace(self, configurations):
+        index = {}
+        for config in configurations:
+            if config['name'] in index:
+                raise Exception("检测到重复的模型名称，请检查环境变量或配置文件。")
+            index[config['name']] = self.prepare(config)
+        with self.lock:
+            self.state = (index, tuple(index))
+
+    def add_all(self, configurations):
+        """
+        添加尚未注册的模型，返回实际添加的模型名称
+        """
+        with self.lock:
+            index, names = self.state
+            new_index = dict(index)
+            added = []
+            for config in configurations:
+                if config['name'] in new_index:
+                    logger.info(f"Model already exists in the list, skipping...")
+                    continue
+                new_index[config['name']] = self.prepare(config)
+                added.append(config['name'])
+            if added:
+                self.state = (new_index, names + tuple(added))
+            return added
+
+    def get(self, model_name):
+        return self.state[0].get(model_name)
+
+    def __contains__(self, model_name):
+        return model_name in self.state[0]
+
+    def names(self):
+        return list(self.state[1])
+
+
+model_registry = ModelRegistry()
+
+# 上游模型的 payload 模板（不含 messages、parent_message_id），启动时构建一次，请求时只做浅拷贝
+UPSTREAM_SUGGESTIONS = [
+    "What are 5 creative things I could do with my kids' art? I don't want to throw them away, "
+    "but it's also so much clutter.",
+    "I want to cheer up my friend who's having a rough day. Can you suggest a couple short and sweet "
+    "text messages to go with a kitten gif?",
+    "Come up with 5 concepts for a retro-style arcade game.",
+    "I have a photoshoot tomorrow. Can you recommend me some colors and outfit options that will look "
+    "good on camera?"
+]
+UPSTREAM_BASE_PAYLOAD = {
+    "action": "next",
+    "timezone_offset_min": -480,
+    "history_and_training_disabled": False,
+    "conversation_mode": {"kind": "primary_assistant"},
+    "force_paragen": False,
+    "force_rate_limit": False
+}
+# (ori_name, 模型名称与别名, 相对 UPSTREAM_BASE_PAYLOAD 的差异字段)
+BUILTIN_UPSTREAM_MODELS = [
+    ("gpt-4-s", GPT_4_S_New_Names, {"model": "gpt-4", "suggestions": []}),
+    ("gpt-4-mobile", GPT_4_MOBILE_NEW_NAMES, {"model": "gpt-4", "suggestions": []}),
+    ("gpt-3.5-turbo", GPT_3_5_NEW_NAMES, {
+        "model": "gpt-4o-mini",
+        "suggestions": UPSTREAM_SUGGESTIONS,
+        "arkose_token": None,
+        "force_paragen_model_slug": ""
+    }),
+    ("gpt-4-o", GPT_4_O_NEW_NAMES, {
+        "model": "gpt-4o",
+        "suggestions": UPSTREAM_SUGGESTIONS,
+        "arkose_token": None
+    }),
+    ("gpt-4o-mini", GPT_4_O_MINI_NEW_NAMES, {
+        "model": "gpt-4o-mini",
+        "suggestions": UPSTREAM_SUGGESTIONS,
+        "arkose_token": None,
+        "force_paragen_model_slug": ""
+    }),
+    ("o1-preview", O1_PREVIEW_NEW_NAMES, {
+        "model": "o1-preview",
+        "suggestions": UPSTREAM_SUGGESTIONS,
+        "variant_purpose": "comparison_implicit",
+        "force_paragen_model_slug": "",
+        "force_nulligen": False,
+        "reset_rate_limits": False,
+        "force_use_sse": True
+    }),
+    ("o1-mini", O1_MINI_NEW_NAMES, {
+        "model": "o1-mini",
+        "suggestions": UPSTREAM_SUGGESTIONS,
+        "variant_purpose": "comparison_implicit",
+        "force_paragen_model_slug": "",
+        "force_nulligen": False,
+        "reset_rate_limits": False,
+        "force_use_sse": True
+    }),
+]
+
+
+def load_upstream_models():
+    """
+    合并内置模型与配置文件中的 upstream_models，返回 ori_name -> {"names", "payload"}
+    """
+    upstream_models = {}
+    for ori_name, names, payload in BUILTIN_UPSTREAM_MODELS:
+        upstream_models[ori_name] = {"names": names, "payload": dict(UPSTREAM_BASE_PAYLOAD, **payload)}
+    for ori_name, entry in UPSTREAM_MODELS_CONFIG.items():
+        upstream_model = upstream_models.get(ori_name) or {"names": [ori_name], "payload": dict(UPSTREAM_BASE_PAYLOAD)}
+        names = entry.get('names')
+        if names:
+            upstream_model["names"] = names.split(',') if isinstance(names, str) else names
+        payload = dict(upstream_model["payload"], **entry.get('payload', {}))
+        payload.setdefault("model", ori_name)
+        upstream_model["payload"] = payload
+        upstream_models[ori_name] = upstream_model
+    return upstream_models
+
+
+UPSTREAM_MODELS = load_upstream_models()
+
+
+def new_conversation_payload(payload_template, messages):
+    # 模板中的嵌套对象在请求间共享，只允许修改顶层字段
+    payload = dict(payload_template)
+    payload["messages"] = messages
+    payload["parent_message_id"] = str(uuid.uuid4())
+    return payload
+
+
 def get_accessible_model_list():
-    return [config['name'] for config in gpts_configurations]
+    return model_registry.names()
 
 
 def find_model_config(model_name):
-    for config in gpts_configurations:
-        if config['name'] == model_name:
-            return config
-    return None
+    return model_registry.get(model_name)
+
+
+def get_ori_model_name(model_name):
+    model_config = find_model_config(model_name)
+    return model_config['ori_name'] if model_config else ''
 
 
 # 从 gpts.json 读取配置
@@ -169,6 +657,17 @@ def load_gpts_config(file_path):
         return json.load(file)
 
 
+class TokenExchangeError(Exception):
+    def __init__(self, message, transient=False):
+        super().__init__(message)
+        # 网络错误、429 和 5xx 可以重试，其余错误说明 refresh_token 已失效
+        self.transient = transient
+
+
+def is_transient_status(status_code):
+    return status_code == 429 or status_code >= 500
+
+
 # 官方refresh_token刷新access_token
 def oaiGetAccessToken(refresh_token):
     logger.info("将通过这个网址请求access_token：https://auth0.openai.com/oauth/token")
@@ -183,60 +682,548 @@ def oaiGetAccessToken(refresh_token):
         "refresh_token": refresh_token
     }
     try:
-        response = requests.post(url, headers=headers, json=data)
-        # 如果响应的状态码不是 200，将引发 HTTPError 异常
-        response.raise_for_status()
+        response = http_client.post(url, headers=headers, json=data)
+    except requests.RequestException as err:
+        raise TokenExchangeError(f"Other error occurred: {err}", transient=True)
+    if response.status_code != 200:
+        raise TokenExchangeError(f"HTTP error occurred: {response.status_code} {response.text.strip()}",
+                                 transient=is_transient_status(response.status_code))
+
+    # 拿到access_token
+    try:
+        access_token = response.json().get('access_token')
+    except ValueError:
+        raise TokenExchangeError("Failed to decode JSON response.", transient=True)
 
-        # 拿到access_token
-        json_response = response.json()
-        access_token = json_response.get('access_token')
+    # 检查 access_token 是否有效
+    if not access_token or not access_token.startswith("eyJhb"):
+        raise TokenExchangeError("access_token 无效.")
+    return access_token
 
-        # 检查 access_token 是否有效
-        if not access_token or not access_token.startswith("eyJhb"):
-            logger.error("access_token 无效.")
-            return None
 
-        return access_token
+# oaiFree获得access_token
+def oaiFreeGetAccessToken(getAccessTokenUrl, refresh_token):
+    logger.info("将通过这个网址请求access_token：" + getAccessTokenUrl)
+    data = {
+        'refresh_token': refresh_token,
+    }
+    try:
+        response = http_client.post(getAccessTokenUrl, data=data)
+    except requests.RequestException as e:
+        raise TokenExchangeError(f"获取access token失败: {e}", transient=True)
+    if not response.ok:
+        raise TokenExchangeError("Request 失败: " + response.text.strip(),
+                                 transient=is_transient_status(response.status_code))
+    try:
+        access_token = response.json().get("access_token")
+    except ValueError:
+        raise TokenExchangeError("Failed to decode JSON response.", transient=True)
+    if not access_token or not access_token.startswith("eyJhb"):
+        raise TokenExchangeError("access_token 无效.")
+    return access_token
 
-    except requests.HTTPError as http_err:
-        logger.error(f"HTTP error occurred: {http_err}")
-    except Exception as err:
-        logger.error(f"Other error occurred: {err}")
-    return None
 
+def request_access_token(refresh_token):
+    """
+    换取 access_token，失败时抛出 TokenExchangeError
+    """
+    if REFRESH_TOACCESS_ENABLEOAI:
+        return oaiGetAccessToken(refresh_token)
+    return oaiFreeGetAccessToken(REFRESH_TOACCESS_OAIFREE_REFRESHTOACCESS_URL, refresh_token)
 
-# oaiFree获得access_token
-def oaiFreeGetAccessToken(getAccessTokenUrl, refresh_token):
+
+def exchange_refresh_token(refresh_token):
     try:
-        logger.info("将通过这个网址请求access_token：" + getAccessTokenUrl)
-        data = {
-            'refresh_token': refresh_token,
-        }
-        response = requests.post(getAccessTokenUrl, data=data)
-        if not response.ok:
-            logger.error("Request 失败: " + response.text.strip())
+        return request_access_token(refresh_token)
+    except TokenExchangeError as e:
+        logger.error(f"{e}")
+        return None
+
+
+def decode_jwt_payload(token):
+    # 只解析 JWT payload，不校验签名
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload))
+    except Exception:
+        return {}
+
+
+def get_jwt_expiry(token):
+    try:
+        return int(decode_jwt_payload(token).get('exp'))
+    except Exception:
+        return None
+
+
+from collections import OrderedDict
+
+# Redis 中的 key 按命名空间划分：<key_prefix>:<命名空间>:<...>
+REDIS_NAMESPACES = ('gizmo', 'file', 'token')
+
+
+def redis_key(namespace, *parts):
+    return ':'.join((REDIS_CONFIG_KEY_PREFIX, namespace) + parts)
+
+
+def is_pool_exhausted(error):
+    # BlockingConnectionPool 等待 pool_timeout 后仍没有空闲连接时抛出的 ConnectionError
+    return isinstance(error, redis.ConnectionError) and 'No connection available' in str(error)
+
+
+class RedisStore:
+    """
+    Redis 缓存访问层：连接失败或超时后 retry_interval 秒内不再访问 Redis，
+    读写降级到进程内 LRU，请求不会因为 Redis 不可用而失败
+    """
+
+    def __init__(self, client, lru_size=4096, retry_interval=10):
+        self.client = client
+        self.lru_size = lru_size
+        self.retry_interval = retry_interval
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+        self.down_until = 0
+        self.stats = {'errors': 0, 'degraded': 0, 'pool_exhausted': 0}
+        self.namespace_stats = {namespace: {'hits': 0, 'misses': 0} for namespace in REDIS_NAMESPACES}
+        self.keyspace_lock = threading.Lock()
+        self.keyspace_cache = None
+
+    def execute(self, func):
+        """
+        执行 func(client)，Redis 不可用时抛出 redis.ConnectionError
+        """
+        if time.time() < self.down_until:
+            with self.lock:
+                self.stats['degraded'] += 1
+            raise redis.ConnectionError('Redis 暂不可用')
+        try:
+            return func(self.client)
+        except (redis.ConnectionError, redis.TimeoutError) as e:
+            if is_pool_exhausted(e):
+                # 连接池中没有空闲连接只是负载高，不是 Redis 不可用，只有本次调用降级
+                with self.lock:
+                    self.stats['pool_exhausted'] += 1
+                raise
+            with self.lock:
+                self.stats['errors'] += 1
+                self.down_until = time.time() + self.retry_interval
+            logger.warning(f"Redis 不可用，{self.retry_interval} 秒内使用进程内缓存: {e}")
+            raise
+
+    def remember(self, key, value, ex=None):
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        expires_at = time.time() + ex if ex else None
+        with self.lock:
+            self.lru[key] = (value, expires_at)
+            self.lru.move_to_end(key)
+            while len(self.lru) > self.lru_size:
+                self.lru.popitem(last=False)
+
+    def recall(self, key):
+        with self.lock:
+            entry = self.lru.get(key)
+            if entry is None:
+                return None
+            if entry[1] and entry[1] <= time.time():
+                del self.lru[key]
+                return None
+            self.lru.move_to_end(key)
+            return entry[0]
+
+    def record(self, key, hit):
+        """
+        按 key 所属的命名空间统计命中率
+        """
+        # key_prefix 中也可能包含 ':'，先去掉前缀再取命名空间
+        prefix = redis_key('')
+        namespace = key[len(prefix):].split(':', 1)[0] if key.startswith(prefix) else None
+        with self.lock:
+            stats = self.namespace_stats.get(namespace)
+            if stats is not None:
+                stats['hits' if hit else 'misses'] += 1
+
+    def get(self, key):
+        try:
+            value = self.execute(lambda client: client.get(key))
+        except redis.RedisError:
+            value = self.recall(key)
+        else:
+            if value is not None:
+                self.remember(key, value)
+        self.record(key, value is not None)
+        return value
+
+    def mget(self, keys):
+        try:
+            values = self.execute(lambda client: client.mget(keys))
+        except redis.RedisError:
+            values = [self.recall(key) for key in keys]
+        else:
+            for key, value in zip(keys, values):
+                if value is not None:
+                    self.remember(key, value)
+        for key, value in zip(keys, values):
+            self.record(key, value is not None)
+        return values
+
+    def set(self, key, value, ex=None):
+        self.set_many({key: value}, ex)
+
+    def set_many(self, items, ex=None):
+        """
+        多个 key 通过一次 pipeline 写入
+        """
+        for key, value in items.items():
+            self.remember(key, value, ex)
+
+        def write(client):
+            pipe = client.pipeline(transaction=False)
+            for key, value in items.items():
+                pipe.set(key, value, ex=ex)
+            pipe.execute()
+
+        try:
+            self.execute(write)
+        except redis.RedisError:
+            # 不可用时 execute 中已记录日志，数据保留在进程内缓存中
+            pass
+
+    def snapshot(self):
+        with self.lock:
+            namespaces = {}
+            for namespace, stats in self.namespace_stats.items():
+                lookups = stats['hits'] + stats['misses']
+                namespaces[namespace] = dict(stats, hit_ratio=round(stats['hits'] / lookups, 4) if lookups else None)
+            return dict(self.stats, available=time.time() >= self.down_until, local_entries=len(self.lru),
+                        namespaces=namespaces)
+
+    # 每个命名空间最多遍历的 key 数，以及遍历结果的缓存秒数
+    KEYSPACE_SCAN_LIMIT = 100000
+    KEYSPACE_CACHE_TTL = 300
+
+    def keyspace(self, sample_size=100):
+        """
+        遍历各命名空间的 key，统计数量，并按抽样的平均内存占用估算总内存；
+        结果缓存 KEYSPACE_CACHE_TTL 秒，同一时间只有一个调用在遍历
+        """
+        with self.keyspace_lock:
+            if self.keyspace_cache and time.time() - self.keyspace_cache['scanned_at'] < self.KEYSPACE_CACHE_TTL:
+                return self.keyspace_cache
+            self.keyspace_cache = self.scan_keyspace(sample_size)
+            return self.keyspace_cache
+
+    def scan_keyspace(self, sample_size):
+        def scan(client):
+            result = {'scanned_at': int(time.time())}
+            for namespace in REDIS_NAMESPACES:
+                count = 0
+                truncated = False
+                sample = []
+                for key in client.scan_iter(match=redis_key(namespace, '*'), count=1000):
+                    if count >= self.KEYSPACE_SCAN_LIMIT:
+                        truncated = True
+                        break
+                    count += 1
+                    if len(sample) < sample_size:
+                        sample.append(key)
+                pipe = client.pipeline(transaction=False)
+                for key in sample:
+                    pipe.memory_usage(key)
+                    pipe.ttl(key)
+                # 不支持 MEMORY USAGE 的 Redis 兼容服务只返回 key 数量
+                values = pipe.execute(raise_on_error=False) if sample else []
+                sizes = [size for size in values[0::2] if isinstance(size, int)]
+                result[namespace] = {
+                    'keys': count,
+                    # 达到遍历上限时 keys 和 estimated_bytes 只是下限
+                    'truncated': truncated,
+                    'estimated_bytes': int(sum(sizes) / len(sizes) * count) if sizes else None,
+                    # 抽样中没有设置过期时间的 key 数
+                    'sampled_without_ttl': sum(1 for ttl in values[1::2] if ttl == -1)
+                }
+            return result
+
+        return self.execute(scan)
+
+
+redis_store = RedisStore(redis_client, REDIS_CONFIG_LRU_SIZE, REDIS_CONFIG_RETRY_INTERVAL)
+
+
+def create_token_cipher(secret):
+    """
+    由 index_secret 派生加密 refresh_token 的密钥，未设置时返回 None
+    """
+    if not secret:
+        return None
+    from cryptography.fernet import Fernet
+    return Fernet(base64.urlsafe_b64encode(hashlib.sha256(secret.encode('utf-8')).digest()))
+
+
+class TokenCache:
+    """
+    refresh_token -> access_token 缓存：Redis 中按 JWT 的 exp 设置过期时间，多进程共享、重启不丢失；
+    进程内 LRU 缓存热点 key，命中时不访问 Redis。
+    Redis 中的 key 只有 refresh_token 的 sha256；设置了 cipher 时，refresh_token 加密后写入索引，
+    供定时刷新任务遍历所有进程用过的 refresh_token，否则只保存在进程内存中
+    """
+
+    def __init__(self, store, lru_size=1024, default_ttl=86400, cipher=None):
+        self.store = store
+        self.lru_size = lru_size
+        self.default_ttl = default_ttl
+        self.cipher = cipher
+        self.lru = OrderedDict()
+        # 本进程用过的 refresh_token（sha256 -> refresh_token），定时刷新任务据此遍历
+        self.known_tokens = {}
+        self.lock = threading.Lock()
+        self.index_key = redis_key('token', 'index')
+
+    @staticmethod
+    def digest(refresh_token):
+        # Redis 中不直接使用 refresh_token 作为 key
+        return hashlib.sha256(refresh_token.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def key(digest):
+        return redis_key('token', digest)
+
+    def remember(self, digest, access_token, expires_at, refresh_token):
+        with self.lock:
+            new_token = digest not in self.known_tokens
+            self.known_tokens[digest] = refresh_token
+            self.lru[digest] = (access_token, expires_at)
+            self.lru.move_to_end(digest)
+            while len(self.lru) > self.lru_size:
+                self.lru.popitem(last=False)
+        if new_token and self.cipher:
+            # 每个进程只在第一次用到某个 refresh_token 时写入索引
+            encrypted = self.cipher.encrypt(refresh_token.encode('utf-8'))
+            try:
+                self.store.execute(lambda client: client.hset(self.index_key, digest, encrypted))
+            except redis.RedisError as e:
+                logger.warning(f"写入 refresh_token 索引失败: {e}")
+
+    def get(self, refresh_token, skip_local=False):
+        """
+        :param skip_local: 跳过进程内缓存，直接读取 Redis 中其他进程写入的最新值
+        :return: (access_token, 过期时间戳)，未缓存或已过期时返回 None
+        """
+        digest = self.digest(refresh_token)
+        now = time.time()
+        with self.lock:
+            entry = None if skip_local else self.lru.get(digest)
+            if entry and entry[1] > now:
+                self.lru.move_to_end(digest)
+                return entry
+        try:
+            access_token = self.store.execute(lambda client: client.get(self.key(digest)))
+        except redis.RedisError as e:
+            logger.warning(f"读取 access_token 缓存失败: {e}")
+            return None
+        self.store.record(self.key(digest), access_token is not None)
+        if not access_token:
             return None
-        access_token = None
+        access_token = access_token.decode('utf-8')
+        expires_at = get_jwt_expiry(access_token) or now + self.default_ttl
+        if expires_at <= now:
+            return None
+        self.remember(digest, access_token, expires_at, refresh_token)
+        return access_token, expires_at
+
+    def set(self, refresh_token, access_token):
+        digest = self.digest(refresh_token)
+        expires_at = get_jwt_expiry(access_token) or time.time() + self.default_ttl
+        ttl = int(expires_at - time.time())
+        if ttl <= 0:
+            return
+        self.remember(digest, access_token, expires_at, refresh_token)
         try:
-            access_token = response.json()["access_token"]
-        except json.JSONDecodeError:
-            logger.exception("Failed to decode JSON response.")
-        if response.status_code == 200 and access_token and access_token.startswith("eyJhb"):
-            return access_token
-    except Exception as e:
-        logger.exception("获取access token失败.")
-    return None
+            self.store.execute(lambda client: client.set(self.key(digest), access_token, ex=ttl))
+        except redis.RedisError as e:
+            logger.warning(f"写入 access_token 缓存失败: {e}")
+        logger.info("添加access_token缓存成功.............")
+
+    def delete(self, refresh_token):
+        digest = self.digest(refresh_token)
+        with self.lock:
+            self.lru.pop(digest, None)
+            self.known_tokens.pop(digest, None)
+
+        def delete(client):
+            pipe = client.pipeline(transaction=False)
+            pipe.delete(self.key(digest))
+            pipe.hdel(self.index_key, digest)
+            pipe.execute()
+
+        try:
+            self.store.execute(delete)
+        except redis.RedisError as e:
+            logger.warning(f"删除 access_token 缓存失败: {e}")
+
+    def refresh_tokens(self):
+        """
+        需要定时刷新的 refresh_token：本进程用过的，以及设置了 cipher 时 Redis 索引中其他进程用过的
+        """
+        with self.lock:
+            tokens = dict(self.known_tokens)
+        if not self.cipher:
+            return list(tokens.values())
+        from cryptography.fernet import InvalidToken
+        try:
+            index = self.store.execute(lambda client: client.hgetall(self.index_key))
+        except redis.RedisError as e:
+            logger.warning(f"读取 refresh_token 索引失败，只刷新本进程用过的 refresh_token: {e}")
+            return list(tokens.values())
+        undecryptable = 0
+        for digest, encrypted in index.items():
+            digest = digest.decode('utf-8')
+            if digest in tokens:
+                continue
+            try:
+                tokens[digest] = self.cipher.decrypt(encrypted).decode('utf-8')
+            except InvalidToken:
+                # index_secret 修改前写入的 refresh_token 无法解密，等下次使用时重新写入
+                undecryptable += 1
+        if undecryptable:
+            logger.warning(f"{undecryptable} 个 refresh_token 无法解密，请检查 index_secret 是否被修改")
+        return list(tokens.values())
+
+
+token_cache = TokenCache(redis_store, TOKEN_CACHE_LRU_SIZE, TOKEN_CACHE_DEFAULT_TTL,
+                         create_token_cipher(TOKEN_CACHE_INDEX_SECRET))
+
+
+class SingleFlight:
+    """
+    相同 key 的并发调用合并为一次，其余调用等待并共享同一个结果
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.stats = {'calls': 0, 'coalesced': 0}
+
+    def do(self, key, func):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = {'event': threading.Event(), 'result': None, 'error': None}
+                self.stats['calls'] += 1
+            else:
+                self.stats['coalesced'] += 1
+        if not leader:
+            call['event'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+        try:
+            call['result'] = func()
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+            call['event'].set()
+        return call['result']
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, in_flight=len(self.calls))
+
+
+token_singleflight = SingleFlight()
+
+
+def exchange_with_lock(refresh_token, exchange=exchange_refresh_token, refresh_before=TOKEN_CACHE_REFRESH_BEFORE):
+    """
+    多进程部署时用 Redis 锁保证同一个 refresh_token 只有一个进程在换取
+    :param exchange: 实际换取 access_token 的函数，其抛出的异常原样向上传递
+    :param refresh_before: 等锁期间其他进程换取的 access_token 剩余有效期不少于该秒数时直接使用
+    """
+    lock = redis_client.lock(redis_key('lock', 'token', TokenCache.digest(refresh_token)),
+                             timeout=TOKEN_CACHE_LOCK_TIMEOUT, blocking_timeout=TOKEN_CACHE_LOCK_TIMEOUT)
+    try:
+        acquired = redis_store.execute(lambda client: lock.acquire())
+    except redis.RedisError as e:
+        logger.warning(f"获取 refresh_token 锁失败: {e}")
+        acquired = False
+    try:
+        if acquired:
+            # 等锁期间其他进程可能已经换取完成
+            cached = token_cache.get(refresh_token, skip_local=True)
+            if cached and cached[1] - time.time() >= refresh_before:
+                return cached[0]
+        access_token = exchange(refresh_token)
+        if access_token:
+            token_cache.set(refresh_token, access_token)
+        return access_token
+    finally:
+        if acquired:
+            try:
+                redis_store.execute(lambda client: lock.release())
+            except redis.RedisError:
+                pass
+
+
+def refresh_access_token(refresh_token):
+    """
+    换取 access_token 并写入缓存，同一个 refresh_token 的并发调用只会发出一次请求，换取失败返回 None
+    """
+    try:
+        return token_singleflight.do(refresh_token, lambda: exchange_with_lock(refresh_token))
+    except TokenExchangeError:
+        # 合并到了定时刷新任务中的换取，错误已由刷新任务记录
+        return None
+
+# 正在后台提前刷新的 refresh_token
+proactive_refreshing = set()
+proactive_refreshing_lock = threading.Lock()
+
+
+def refresh_in_background(refresh_token):
+    with proactive_refreshing_lock:
+        if refresh_token in proactive_refreshing:
+            return
+        proactive_refreshing.add(refresh_token)
+
+    def refresh():
+        try:
+            refresh_access_token(refresh_token)
+        finally:
+            with proactive_refreshing_lock:
+                proactive_refreshing.discard(refresh_token)
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+def get_access_token(api_key):
+    """
+    api_key 为 refresh_token 时换取 access_token，换取失败返回 None
+    """
+    if api_key.startswith("eyJhb"):
+        return api_key
+    cached = token_cache.get(api_key)
+    if cached:
+        logger.info(f"从缓存读取到api_key.........")
+        access_token, expires_at = cached
+        # 临近过期时在后台提前刷新，本次请求仍使用未过期的 access_token
+        if expires_at - time.time() < TOKEN_CACHE_REFRESH_BEFORE:
+            refresh_in_background(api_key)
+        return access_token
+    return refresh_access_token(api_key)
 
 
 def updateGptsKey():
     global KEY_FOR_GPTS_INFO
     global KEY_FOR_GPTS_INFO_ACCESS_TOKEN
     if not KEY_FOR_GPTS_INFO == '' and not KEY_FOR_GPTS_INFO.startswith("eyJhb"):
-        if REFRESH_TOACCESS_ENABLEOAI:
-            access_token = oaiGetAccessToken(KEY_FOR_GPTS_INFO)
-        else:
-            access_token = oaiFreeGetAccessToken(REFRESH_TOACCESS_OAIFREE_REFRESHTOACCESS_URL, KEY_FOR_GPTS_INFO)
-        if access_token.startswith("eyJhb"):
+        access_token = get_access_token(KEY_FOR_GPTS_INFO)
+        if access_token:
             KEY_FOR_GPTS_INFO_ACCESS_TOKEN = access_token
             logging.info("KEY_FOR_GPTS_INFO_ACCESS_TOKEN被更新:" + KEY_FOR_GPTS_INFO_ACCESS_TOKEN)
 
@@ -248,7 +1235,7 @@ def fetch_gizmo_info(base_url, proxy_api_prefix, model_id):
         "Authorization": f"Bearer {KEY_FOR_GPTS_INFO_ACCESS_TOKEN}"
     }
 
-    response = requests.get(url, headers=headers)
+    response = http_client.get(url, headers=headers)
     # logger.debug(f"fetch_gizmo_info_response: {response.text}")
     if response.status_code == 200:
         return response.json()
@@ -256,85 +1243,212 @@ def fetch_gizmo_info(base_url, proxy_api_prefix, model_id):
         return None
 
 
-# gpts_configurations = []
+import ast
+from concurrent.futures import ThreadPoolExecutor
+
+
+def load_gizmo_info(cached):
+    """
+    解析 Redis 中缓存的 GPTS 配置信息，兼容旧版本用 str() 写入的数据，无法解析时返回 None
+    """
+    if not cached:
+        return None
+    try:
+        return json.loads(cached)
+    except ValueError:
+        pass
+    try:
+        # 旧版本写入的是 Python 字面量，只解析字面量，不执行代码
+        gizmo_info = ast.literal_eval(cached.decode('utf-8'))
+    except (ValueError, SyntaxError, UnicodeDecodeError):
+        return None
+    return gizmo_info if isinstance(gizmo_info, dict) else None
+
+
+def dump_gizmo_info(gizmo_info):
+    return json.dumps(gizmo_info, ensure_ascii=False)
+
+
+def fetch_gizmo_info_safely(base_url, proxy_api_prefix, model_id):
+    try:
+        return fetch_gizmo_info(base_url, proxy_api_prefix, model_id)
+    except Exception as e:
+        logger.error(f"获取 GPTS 配置信息失败 {model_id}: {e}")
+        return None
 
-# 将配置添加到全局列表
+
+# 将配置添加到模型注册表
 def add_config_to_global_list(base_url, proxy_api_prefix, gpts_data):
-    global gpts_configurations
     updateGptsKey()  # cSpell:ignore Gpts
-    # print(f"gpts_data: {gpts_data}")
-    for model_name, model_info in gpts_data.items():
-        # print(f"model_name: {model_name}")
-        # print(f"model_info: {model_info}")
-        model_id = model_info['id']
-        # 首先尝试从 Redis 获取缓存数据
-        cached_gizmo_info = redis_client.get(model_id)
-        if cached_gizmo_info:
-            gizmo_info = eval(cached_gizmo_info)  # 将字符串转换回字典
+    models = [(model_name, model_info['id']) for model_name, model_info in gpts_data.items()]
+    if not models:
+        return
+    # 一次 MGET 读取全部缓存
+    cached_values = redis_store.mget([redis_key('gizmo', model_id) for _, model_id in models])
+    gizmo_infos = {}
+    legacy_ids = []
+    missing = []
+    for (model_name, model_id), cached in zip(models, cached_values):
+        gizmo_info = load_gizmo_info(cached)
+        if gizmo_info:
             logger.info(f"Using cached info for {model_name}, {model_id}")
-        else:
+            gizmo_infos[model_id] = gizmo_info
+            # JSON 格式的缓存以 {" 开头，其余为旧版本写入的数据
+            if not cached.startswith(b'{"'):
+                legacy_ids.append(model_id)
+        elif model_id not in missing:
             logger.info(f"Fetching gpts info for {model_name}, {model_id}")
-            gizmo_info = fetch_gizmo_info(base_url, proxy_api_prefix, model_id)
-            # 如果成功获取到数据，则将其存入 Redis
-            if gizmo_info:
-                redis_client.set(model_id, str(gizmo_info))
-                logger.info(f"Cached gizmo info for {model_name}, {model_id}")
-
-        # 检查模型名称是否已经在列表中
-        if gizmo_info and not any(d['name'] == model_name for d in gpts_configurations):
-            gpts_configurations.append({
+            missing.append(model_id)
+
+    # 未命中缓存的并发获取，耗时约等于最慢的一次请求
+    fetched = {}
+    if missing:
+        with ThreadPoolExecutor(max_workers=min(GPTS_CACHE_WORKERS, len(missing))) as executor:
+            results = executor.map(lambda model_id: fetch_gizmo_info_safely(base_url, proxy_api_prefix, model_id),
+                                   missing)
+            fetched = {model_id: gizmo_info for model_id, gizmo_info in zip(missing, results) if gizmo_info}
+        gizmo_infos.update(fetched)
+
+    # 新获取的和旧格式的缓存通过一次 pipeline 以 JSON 写回
+    if fetched or legacy_ids:
+        redis_store.set_many({redis_key('gizmo', model_id): dump_gizmo_info(gizmo_infos[model_id])
+                              for model_id in list(fetched) + legacy_ids}, ex=GPTS_CACHE_TTL)
+        logger.info(f"Cached gizmo info for {len(fetched)} GPTS, migrated {len(legacy_ids)} legacy entries")
+
+    new_configurations = []
+    for model_name, model_id in models:
+        gizmo_info = gizmo_infos.get(model_id)
+        if gizmo_info:
+            new_configurations.append({
                 'name': model_name,
                 'id': model_id,
                 'config': gizmo_info
             })
-        else:
-            logger.info(f"Model already exists in the list, skipping...")
+    # 一次性加入注册表，已存在的模型会被跳过
+    model_registry.add_all(new_configurations)
 
 
 def generate_gpts_payload(model, messages):
     model_config = find_model_config(model)
-    if model_config:
-        gizmo_info = model_config['config']
-        gizmo_id = gizmo_info['gizmo']['id']
-
-        payload = {
-            "action": "next",
-            "messages": messages,
-            "parent_message_id": str(uuid.uuid4()),
-            "model": "gpt-4-gizmo",
-            "timezone_offset_min": -480,
-            "history_and_training_disabled": False,
-            "conversation_mode": {
-                "gizmo": gizmo_info,
-                "kind": "gizmo_interaction",
-                "gizmo_id": gizmo_id
-            },
-            "force_paragen": False,
-            "force_rate_limit": False
-        }
-        return payload
+    if model_config and 'payload_template' in model_config:
+        return new_conversation_payload(model_config['payload_template'], messages)
     else:
         return None
 
 
 # 创建 Flask 应用
 app = Flask(__name__)
+app.config['USE_X_SENDFILE'] = STATIC_FILES_OFFLOAD == 'x-sendfile'
 CORS(app, resources={r"/images/*": {"origins": "*"}})
-scheduler = APScheduler()
-scheduler.init_app(app)
-scheduler.start()
+
+
+class DeferredScheduler:
+    """
+    先记录定时任务，start() 时才导入并启动 APScheduler，不运行定时任务的进程不会加载它
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.jobs = []
+        self.scheduler = None
+
+    def add_job(self, **kwargs):
+        self.jobs.append(kwargs)
+
+    def start(self):
+        from flask_apscheduler import APScheduler
+        self.scheduler = APScheduler()
+        self.scheduler.init_app(self.app)
+        for job in self.jobs:
+            self.scheduler.add_job(**job)
+        self.scheduler.start()
+
+
+scheduler = DeferredScheduler(app)
+# 定时任务在启动服务时按运行模式启动，多进程部署时只在一个 worker 中运行
 
 # PANDORA_UPLOAD_URL = 'files.pandoranext.com'
 
 
+REDIS_SCHEMA_VERSION = b'1'
+
+
+def migrate_redis_keys():
+    """
+    迁移旧版本写入的无前缀、无过期时间的 key，迁移完成后写入 schema 版本，只执行一次
+    """
+    schema_key = redis_key('meta', 'schema')
+
+    def migrate(client):
+        if client.get(schema_key) == REDIS_SCHEMA_VERSION:
+            return
+        migrated = 0
+        # 旧版本以 GPTS id 作为 key 保存配置信息，只迁移能解析为配置信息的
+        for old_key in client.scan_iter(match='g-*', count=1000):
+            if load_gizmo_info(client.get(old_key)) is None:
+                continue
+            new_key = redis_key('gizmo', old_key.decode('utf-8'))
+            pipe = client.pipeline(transaction=False)
+            pipe.renamenx(old_key, new_key)
+            pipe.expire(new_key, GPTS_CACHE_TTL)
+            pipe.delete(old_key)
+            pipe.execute(raise_on_error=False)
+            migrated += 1
+        # 旧版本按文件 sha256 直接写入、没有区分账号的文件缓存已无法使用，直接删除
+        for old_key in client.scan_iter(match='[0-9a-f]' * 64, count=1000):
+            if b'"file_id"' in (client.get(old_key) or b''):
+                client.delete(old_key)
+                migrated += 1
+        client.set(schema_key, REDIS_SCHEMA_VERSION)
+        logger.info(f"Redis key 迁移完成，共处理 {migrated} 个旧 key")
+
+    try:
+        redis_store.execute(migrate)
+    except redis.RedisError as e:
+        logger.warning(f"Redis key 迁移失败，下次启动时重试: {e}")
+
+
+# GPTs 配置信息是否已加载完成，/ready 据此判断模型列表是否完整
+gpts_loaded = threading.Event()
+
+
+def load_gpts_models():
+    # 加载配置并添加到全局列表
+    gpts_data = load_gpts_config("./data/gpts.json")
+    proxy_api_prefix = upstream_selector.acquire()
+    try:
+        add_config_to_global_list(BASE_URL, proxy_api_prefix, gpts_data)
+    finally:
+        upstream_selector.release(proxy_api_prefix)
+    gpts_loaded.set()
+    # 获取当前可用的 GPTS 模型列表
+    accessible_model_list = get_accessible_model_list()
+    logger.info(f"当前可用 GPTS 列表: {accessible_model_list}")
+
+
+def load_gpts_models_in_background(migrate=False):
+    def load():
+        if migrate:
+            migrate_redis_keys()
+        delay = 5
+        while True:
+            try:
+                load_gpts_models()
+                return
+            except Exception as e:
+                logger.error(f"后台加载 GPTS 配置信息失败，{delay} 秒后重试: {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, 300)
+
+    threading.Thread(target=load, daemon=True).start()
+
+
 VERSION = '0.8.2'
 # VERSION = 'test'
 UPDATE_INFO = '🥳 修复data:结尾代码输出出现异常问题'
 # UPDATE_INFO = '【仅供临时测试使用】 '
 
 with app.app_context():
-    global gpts_configurations  # 移到作用域的最开始
-
     # 输出版本信息
     logger.info(f"==========================================")
     logger.info(f"Version: {VERSION}")
@@ -400,7 +1514,7 @@ with app.app_context():
         logger.info(f"key_for_gpts_info: {KEY_FOR_GPTS_INFO}")
 
     if not API_PREFIX:
-        logger.warning("backend_container_api_prefix 未设置，安全性会有所下降")
+        logger.warning("backend_container_api_prefix 未设置，安全性会有所下降，统计接口不开放")
         logger.info(f'Chat 接口 URI: /v1/chat/completions')
         logger.info(f'绘图接口 URI: /v1/images/generations')
     else:
@@ -423,57 +1537,26 @@ with app.app_context():
 
     logger.info(f"==========================================")
 
-    # 更新 gpts_configurations 列表，支持多个映射
+    # 更新模型注册表，支持多个映射
     gpts_configurations = []
-    for name in GPT_4_S_New_Names:
-        gpts_configurations.append({
-            "name": name.strip(),
-            "ori_name": "gpt-4-s"
-        })
-    for name in GPT_4_MOBILE_NEW_NAMES:
-        gpts_configurations.append({
-            "name": name.strip(),
-            "ori_name": "gpt-4-mobile"
-        })
-    for name in GPT_3_5_NEW_NAMES:
-        gpts_configurations.append({
-            "name": name.strip(),
-            "ori_name": "gpt-3.5-turbo"
-        })
-    for name in GPT_4_O_NEW_NAMES:
-        gpts_configurations.append({
-            "name": name.strip(),
-            "ori_name": "gpt-4-o"
-        })
-    for name in GPT_4_O_MINI_NEW_NAMES:
-        gpts_configurations.append({
-            "name": name.strip(),
-            "ori_name": "gpt-4o-mini"
-        })
-    for name in O1_PREVIEW_NEW_NAMES:
-        gpts_configurations.append({
-            "name": name.strip(),
-            "ori_name": "o1-preview"
-        })
-    for name in O1_MINI_NEW_NAMES:
-        gpts_configurations.append({
-            "name": name.strip(),
-            "ori_name": "o1-mini"
-        })
+    for ori_name, upstream_model in UPSTREAM_MODELS.items():
+        for name in upstream_model["names"]:
+            gpts_configurations.append({
+                "name": name.strip(),
+                "ori_name": ori_name,
+                "payload_template": upstream_model["payload"]
+            })
+    model_registry.replace(gpts_configurations)
     logger.info(f"GPTS 配置信息")
 
-    # 加载配置并添加到全局列表
-    gpts_data = load_gpts_config("./data/gpts.json")
-    add_config_to_global_list(BASE_URL, getPROXY_API_PREFIX(lock), gpts_data)
-    # print("当前可用GPTS：" + get_accessible_model_list())
-    # 输出当前可用 GPTS name
-    # 获取当前可用的 GPTS 模型列表
-    accessible_model_list = get_accessible_model_list()
-    logger.info(f"当前可用 GPTS 列表: {accessible_model_list}")
-
-    # 检查列表中是否有重复的模型名称
-    if len(accessible_model_list) != len(set(accessible_model_list)):
-        raise Exception("检测到重复的模型名称，请检查环境变量或配置文件。")
+    if not SERVER_FAST_START:
+        migrate_redis_keys()
+        load_gpts_models()
+    elif SERVER_USES_GUNICORN:
+        # 迁移只在主进程中 fork 之前执行一次；后台线程不能跨 fork，GPTS 在每个 worker 启动后再加载
+        migrate_redis_keys()
+    else:
+        load_gpts_models_in_background(migrate=True)
 
     logger.info(f"==========================================")
 
@@ -495,7 +1578,7 @@ def get_token():
         payload = {'type': 'gpt-4'}
 
         try:
-            response = requests.post(full_url, data=payload)
+            response = http_client.post(full_url, data=payload)
             if response.status_code == 200:
                 token = response.json().get('token')
                 # 确保 token 字段存在且不是 None 或空字符串
@@ -512,11 +1595,194 @@ def get_token():
     raise Exception("获取 arkose token 失败")
 
 
-import os
+import binascii
+import struct
+import tempfile
+from urllib.parse import unquote_to_bytes
+
 
+class AttachmentError(Exception):
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
 
-def get_image_dimensions(file_content):
-    with Image.open(BytesIO(file_content)) as img:
+
+class Attachment:
+    """
+    待上传的附件：内容较小时保存在内存中，超过 SPOOL_SIZE 后写入临时文件；sha256 在写入时增量计算
+    """
+
+    SPOOL_SIZE = 1024 * 1024
+
+    def __init__(self, mime_type='', content=None):
+        self.mime_type = mime_type
+        self.width = None
+        self.height = None
+        self.hasher = hashlib.sha256()
+        if content is None:
+            self.file = tempfile.SpooledTemporaryFile(max_size=self.SPOOL_SIZE)
+            self.size = 0
+        else:
+            # BytesIO 在写入前与 content 共用同一块内存，不会复制
+            self.file = BytesIO(content)
+            self.size = len(content)
+            self.hasher.update(content)
+
+    def write(self, chunk):
+        self.file.write(chunk)
+        self.hasher.update(chunk)
+        self.size += len(chunk)
+
+    @property
+    def sha256(self):
+        return self.hasher.hexdigest()
+
+    def inspect(self):
+        """
+        读取图片宽高；无法识别的图片按 text/plain 处理
+        """
+        if self.mime_type.startswith('image/') and self.width is None:
+            try:
+                self.width, self.height = get_image_dimensions(self.open())
+            except Exception as e:
+                logger.error(f"图片信息获取异常, 切换为text/plain： {e}")
+                self.mime_type = 'text/plain'
+        return self
+
+    def open(self):
+        self.file.seek(0)
+        return self.file
+
+    def body(self):
+        """
+        作为请求体上传：仍在内存中的小文件直接返回内容，其余返回文件对象由 requests 分块发送
+        """
+        file = self.open()
+        if isinstance(file, tempfile.SpooledTemporaryFile) and self.size <= self.SPOOL_SIZE:
+            # requests 获取文件长度时会调用 fileno()，使 SpooledTemporaryFile 写入磁盘
+            return file.read()
+        return file
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def fetch_attachment(file_url, deadline):
+    """
+    流式下载远程文件，超过 ATTACHMENTS_MAX_SIZE 或到达请求的截止时间 deadline（time.monotonic()）时中止
+    """
+    tmp_user_agent = ua.random
+    logger.debug(f"随机 User-Agent: {tmp_user_agent}")
+    tmp_headers = {
+        'User-Agent': tmp_user_agent
+    }
+    timeout = max(min(ATTACHMENTS_FETCH_TIMEOUT, deadline - time.monotonic()), 0.1)
+    with requests.get(url=file_url, headers=tmp_headers, stream=True, timeout=(timeout, timeout)) as file_response:
+        file_response.raise_for_status()
+        content_length = file_response.headers.get('Content-Length')
+        if content_length and content_length.isdigit() and int(content_length) > ATTACHMENTS_MAX_SIZE:
+            raise AttachmentError(f"文件大小 {content_length} 超过限制 {ATTACHMENTS_MAX_SIZE}")
+        mime_type = file_response.headers.get('Content-Type', '').split(';')[0].strip()
+        attachment = Attachment(mime_type)
+        try:
+            for chunk in file_response.iter_content(chunk_size=64 * 1024):
+                attachment.write(chunk)
+                if attachment.size > ATTACHMENTS_MAX_SIZE:
+                    raise AttachmentError(f"文件大小超过限制 {ATTACHMENTS_MAX_SIZE}")
+                if time.monotonic() > deadline:
+                    raise AttachmentError(f"下载 {file_url} 超时", 504)
+        except Exception:
+            attachment.close()
+            raise
+    logger.debug(f"文件大小: {attachment.size}")
+    return attachment
+
+
+def decode_data_url(file_url):
+    """
+    解析 data: URL，逗号之后的 base64 内容切片后直接由 binascii 解码，不再先把整个 URL 编码为 bytes
+    """
+    comma = file_url.find(',')
+    if comma < 0:
+        raise AttachmentError("data URL 格式错误")
+    header = file_url[5:comma]
+    mime_type = header.split(';', 1)[0]
+    if not header.endswith(';base64'):
+        return Attachment(mime_type, unquote_to_bytes(file_url[comma + 1:]))
+    if (len(file_url) - comma - 1) // 4 * 3 > ATTACHMENTS_MAX_SIZE:
+        raise AttachmentError(f"文件大小超过限制 {ATTACHMENTS_MAX_SIZE}")
+    try:
+        return Attachment(mime_type, binascii.a2b_base64(file_url[comma + 1:]))
+    except ValueError as e:
+        # binascii.Error 以及包含非 ASCII 字符时的 ValueError
+        raise AttachmentError(f"类型为 {mime_type} 的 base64 编码数据解码失败: {e}")
+
+
+# JPEG 中携带图片尺寸的 SOF 段（不含 DHT、JPG、DAC）
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def read_image_header_dimensions(file):
+    """
+    只读取 PNG/GIF/WebP/JPEG 的文件头获取宽高，无法识别时返回 None
+    """
+    head = file.read(32)
+    if head.startswith(b'\x89PNG\r\n\x1a\n') and head[12:16] == b'IHDR':
+        return struct.unpack('>II', head[16:24])
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return struct.unpack('<HH', head[6:10])
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP' and len(head) >= 30:
+        chunk = head[12:16]
+        if chunk == b'VP8X':
+            return 1 + int.from_bytes(head[24:27], 'little'), 1 + int.from_bytes(head[27:30], 'little')
+        if chunk == b'VP8L':
+            bits = int.from_bytes(head[21:25], 'little')
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b'VP8 ' and head[23:26] == b'\x9d\x01\x2a':
+            width, height = struct.unpack('<HH', head[26:30])
+            return width & 0x3FFF, height & 0x3FFF
+        return None
+    if head[:2] == b'\xff\xd8':
+        file.seek(2)
+        while True:
+            byte = file.read(1)
+            while byte == b'\xff':
+                marker = file.read(1)
+                if marker != b'\xff':
+                    break
+            else:
+                return None
+            if not marker:
+                return None
+            marker = marker[0]
+            if 0xD0 <= marker <= 0xD9 or marker == 0x01:
+                # 没有长度字段的标记
+                continue
+            segment_length = file.read(2)
+            if len(segment_length) < 2:
+                return None
+            if marker in JPEG_SOF_MARKERS:
+                height, width = struct.unpack('>xHH', file.read(5))
+                return width, height
+            file.seek(struct.unpack('>H', segment_length)[0] - 2, 1)
+    return None
+
+
+def get_image_dimensions(file):
+    dimensions = read_image_header_dimensions(file)
+    if dimensions:
+        return dimensions
+    # 其他格式交给 Pillow，同样只解析文件头
+    from PIL import Image
+    file.seek(0)
+    with Image.open(file) as img:
         return img.width, img.height
 
 
@@ -538,24 +1804,18 @@ def determine_file_use_case(mime_type):
         return "ace_upload"
 
 
-def upload_file(file_content, mime_type, api_key, proxy_api_prefix):
+def upload_file(attachment, api_key, proxy_api_prefix):
     logger.debug("文件上传开始")
 
-    width = None
-    height = None
-    if mime_type.startswith('image/'):
-        try:
-            width, height = get_image_dimensions(file_content)
-        except Exception as e:
-            logger.error(f"图片信息获取异常, 切换为text/plain： {e}")
-            mime_type = 'text/plain'
+    mime_type = attachment.inspect().mime_type
+    width = attachment.width
+    height = attachment.height
 
-    # logger.debug(f"文件内容: {file_content}")
-    file_size = len(file_content)
+    file_size = attachment.size
     logger.debug(f"文件大小: {file_size}")
     file_extension = get_file_extension(mime_type)
     logger.debug(f"文件扩展名: {file_extension}")
-    sha256_hash = hashlib.sha256(file_content).hexdigest()
+    sha256_hash = attachment.sha256
     logger.debug(f"sha256_hash: {sha256_hash}")
     file_name = f"{sha256_hash}{file_extension}"
     logger.debug(f"文件名: {file_name}")
@@ -576,7 +1836,7 @@ def upload_file(file_content, mime_type, api_key, proxy_api_prefix):
     headers = {
         "Authorization": f"Bearer {api_key}"
     }
-    upload_response = requests.post(upload_api_url, json=upload_request_payload, headers=headers)
+    upload_response = http_client.post(upload_api_url, json=upload_request_payload, headers=headers)
     logger.debug(f"upload_response: {upload_response.text}")
     if upload_response.status_code != 200:
         raise Exception("Failed to get upload URL")
@@ -592,7 +1852,7 @@ def upload_file(file_content, mime_type, api_key, proxy_api_prefix):
         'Content-Type': mime_type,
         'x-ms-blob-type': 'BlockBlob'  # 添加这个头部
     }
-    put_response = requests.put(upload_url, data=file_content, headers=put_headers)
+    put_response = http_client.put(upload_url, data=attachment.body(), headers=put_headers)
     if put_response.status_code != 201:
         logger.debug(f"put_response: {put_response.text}")
         logger.debug(f"put_response status_code: {put_response.status_code}")
@@ -600,7 +1860,7 @@ def upload_file(file_content, mime_type, api_key, proxy_api_prefix):
 
     # 第3步：检测上传是否成功并检查响应
     check_url = f"{BASE_URL}{proxy_api_prefix}/backend-api/files/{file_id}/uploaded"
-    check_response = requests.post(check_url, json={}, headers=headers)
+    check_response = http_client.post(check_url, json={}, headers=headers)
     logger.debug(f"check_response: {check_response.text}")
     if check_response.status_code != 200:
         raise Exception("Failed to check file upload completion")
@@ -619,50 +1879,148 @@ def upload_file(file_content, mime_type, api_key, proxy_api_prefix):
     }
 
 
-def get_file_metadata(file_content, mime_type, api_key, proxy_api_prefix):
-    sha256_hash = hashlib.sha256(file_content).hexdigest()
+class FileCache:
+    """
+    文件 sha256 -> 已上传文件元数据的缓存，按账号隔离。
+    最近验证过的 file_id 在 trust_ttl 内直接使用，超过 revalidate_after 后在后台重新验证；
+    验证失败时在 negative_ttl 内记为失效，期间直接重新上传而不再检查；缓存在 ttl 内没有被重新验证时过期
+    """
+
+    def __init__(self, store, trust_ttl=1800, revalidate_after=300, negative_ttl=300, ttl=2592000):
+        self.store = store
+        self.trust_ttl = trust_ttl
+        self.revalidate_after = revalidate_after
+        self.negative_ttl = negative_ttl
+        self.ttl = ttl
+        self.revalidating = set()
+        self.lock = threading.Lock()
+
+    def key(self, scope, sha256_hash):
+        return redis_key('file', scope, sha256_hash)
+
+    def get(self, scope, sha256_hash):
+        """
+        返回 (文件元数据, 上次验证时间)；没有缓存返回 None，已记为失效返回 ({}, 0)
+        """
+        return self.parse(self.store.get(self.key(scope, sha256_hash)))
+
+    def get_many(self, scope, sha256_hashes):
+        """
+        通过一次 MGET 读取多个文件的缓存，返回 sha256 -> get() 的返回值
+        """
+        sha256_hashes = list(sha256_hashes)
+        if not sha256_hashes:
+            return {}
+        values = self.store.mget([self.key(scope, sha256_hash) for sha256_hash in sha256_hashes])
+        return {sha256_hash: self.parse(value) for sha256_hash, value in zip(sha256_hashes, values)}
+
+    @staticmethod
+    def parse(cached):
+        if cached is None:
+            return None
+        file_data = json.loads(cached.decode())
+        if file_data.get('invalid'):
+            return {}, 0
+        validated_at = file_data.pop('validated_at', 0)
+        return file_data, validated_at
+
+    def set(self, scope, sha256_hash, file_data):
+        entry = dict(file_data)
+        entry['validated_at'] = time.time()
+        self.store.set(self.key(scope, sha256_hash), json.dumps(entry), ex=self.ttl)
+
+    def invalidate(self, scope, sha256_hash):
+        self.store.set(self.key(scope, sha256_hash), json.dumps({'invalid': True}), ex=self.negative_ttl)
+
+    def revalidate_in_background(self, scope, sha256_hash, file_data, api_key):
+        key = self.key(scope, sha256_hash)
+        with self.lock:
+            if key in self.revalidating:
+                return
+            self.revalidating.add(key)
+
+        def revalidate():
+            proxy_api_prefix = upstream_selector.acquire()
+            try:
+                if check_uploaded_file(file_data.get("file_id"), api_key, proxy_api_prefix):
+                    self.set(scope, sha256_hash, file_data)
+                else:
+                    logger.info(f"缓存的文件 {file_data.get('file_id')} 已失效")
+                    self.invalidate(scope, sha256_hash)
+            except Exception as e:
+                # 网络等临时错误不改变缓存状态，下次命中时再检查
+                logger.warning(f"后台验证文件 {file_data.get('file_id')} 失败: {e}")
+            finally:
+                upstream_selector.release(proxy_api_prefix)
+                with self.lock:
+                    self.revalidating.discard(key)
+
+        threading.Thread(target=revalidate, daemon=True).start()
+
+
+file_cache = FileCache(redis_store, FILE_CACHE_TRUST_TTL, FILE_CACHE_REVALIDATE_AFTER, FILE_CACHE_NEGATIVE_TTL,
+                       FILE_CACHE_TTL)
+
+
+def get_account_scope(api_key, account_id=None):
+    # 上游的 file_id 只对上传它的账号有效，缓存按 用户ID + ChatGPT-Account-ID 隔离
+    payload = decode_jwt_payload(api_key)
+    user_id = (payload.get('https://api.openai.com/auth') or {}).get('user_id') or payload.get('sub')
+    if not user_id:
+        user_id = hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+    return f"{user_id}:{account_id}" if account_id else user_id
+
+
+def check_uploaded_file(file_id, api_key, proxy_api_prefix):
+    # 检测之前上传的文件是否仍然有效
+    check_url = f"{BASE_URL}{proxy_api_prefix}/backend-api/files/{file_id}/uploaded"
+    headers = {
+        "Authorization": f"Bearer {api_key}"
+    }
+    check_response = http_client.post(check_url, json={}, headers=headers)
+    logger.debug(f"check_response: {check_response.text}")
+    if check_response.status_code != 200:
+        return False
+    return check_response.json().get("status") == "success"
+
+
+def get_file_metadata(attachment, cached, api_key, proxy_api_prefix, account_id=None):
+    """
+    :param cached: 预先通过 file_cache.get_many 从 Redis 中读取的文件缓存
+    """
+    sha256_hash = attachment.sha256
     logger.debug(f"sha256_hash: {sha256_hash}")
-    # 首先尝试从Redis中获取数据
-    cached_data = redis_client.get(sha256_hash)
-    if cached_data is not None:
-        # 如果在Redis中找到了数据，解码后直接返回
-        logger.info(f"从Redis中获取到文件缓存数据")
-        cache_file_data = json.loads(cached_data.decode())
+    scope = get_account_scope(api_key, account_id)
+    if cached is None:
+        logger.info(f"Redis中没有找到文件缓存数据")
+    elif not cached[0]:
+        logger.info(f"Redis中的文件缓存数据近期已失效，重新上传文件")
+    else:
+        cache_file_data, validated_at = cached
+        age = time.time() - validated_at
+        if age < file_cache.trust_ttl:
+            logger.info(f"从Redis中获取到文件缓存数据，{int(age)} 秒前验证有效，将使用缓存数据")
+            if age >= file_cache.revalidate_after:
+                file_cache.revalidate_in_background(scope, sha256_hash, cache_file_data, api_key)
+            return cache_file_data
 
-        tag = True
-        file_id = cache_file_data.get("file_id")
-        # 检测之前的文件是否仍然有效
-        check_url = f"{BASE_URL}{proxy_api_prefix}/backend-api/files/{file_id}/uploaded"
-        headers = {
-            "Authorization": f"Bearer {api_key}"
-        }
-        check_response = requests.post(check_url, json={}, headers=headers)
-        logger.debug(f"check_response: {check_response.text}")
-        if check_response.status_code != 200:
-            tag = False
-
-        check_data = check_response.json()
-        if check_data.get("status") != "success":
-            tag = False
-        if tag:
+        logger.info(f"从Redis中获取到文件缓存数据")
+        try:
+            valid = check_uploaded_file(cache_file_data.get("file_id"), api_key, proxy_api_prefix)
+        except Exception as e:
+            logger.warning(f"检测文件缓存数据失败: {e}")
+            valid = False
+        if valid:
             logger.info(f"Redis中的文件缓存数据有效，将使用缓存数据")
+            file_cache.set(scope, sha256_hash, cache_file_data)
             return cache_file_data
-        else:
-            logger.info(f"Redis中的文件缓存数据已失效，重新上传文件")
+        logger.info(f"Redis中的文件缓存数据已失效，重新上传文件")
 
-    else:
-        logger.info(f"Redis中没有找到文件缓存数据")
-    # 如果Redis中没有，上传文件并保存新数据
-    new_file_data = upload_file(file_content, mime_type, api_key, proxy_api_prefix)
-    mime_type = new_file_data.get('mimeType')
-    # 为图片类型文件添加宽度和高度信息
-    if mime_type.startswith('image/'):
-        width, height = get_image_dimensions(file_content)
-        new_file_data['width'] = width
-        new_file_data['height'] = height
+    # 如果Redis中没有，上传文件并保存新数据（upload_file 已包含图片的宽度和高度信息）
+    new_file_data = upload_file(attachment, api_key, proxy_api_prefix)
 
     # 将新的文件数据存入Redis
-    redis_client.set(sha256_hash, json.dumps(new_file_data))
+    file_cache.set(scope, sha256_hash, new_file_data)
 
     return new_file_data
 
@@ -710,8 +2068,138 @@ my_files_types = [
 ]
 
 
+from concurrent.futures import FIRST_COMPLETED, wait
+
+# 所有请求共用的线程池，单个请求同时占用的线程数不超过 ATTACHMENTS_WORKERS
+attachment_executor = ThreadPoolExecutor(max_workers=ATTACHMENTS_POOL_SIZE, thread_name_prefix='attachment')
+
+
+def acquire_attachment(file_url, deadline):
+    """
+    解码或下载 image_url，获取文件失败时抛出 AttachmentError
+    """
+    if file_url.startswith('data:'):
+        # 处理 base64 编码的文件数据
+        attachment = decode_data_url(file_url)
+    else:
+        # 处理普通的文件URL
+        try:
+            attachment = fetch_attachment(file_url, deadline)
+        except AttachmentError:
+            raise
+        except Exception as e:
+            raise AttachmentError(f"获取文件 {file_url} 失败: {e}")
+
+    logger.debug(f"mime_type: {attachment.mime_type}")
+    return attachment
+
+
+def run_attachment_tasks(tasks, func, deadline, abandon, results):
+    """
+    在共用线程池中并发执行 (key, arg) 列表中的 func(arg)，同时执行的不超过 ATTACHMENTS_WORKERS 个，
+    结果按 key 写入 results。任务抛出异常或到达截止时间 deadline 时向上抛出，排队中的任务被取消，
+    仍在执行的任务无法取消，交给 abandon(key, future) 处理
+    """
+    running = {}
+    next_task = 0
+    try:
+        while next_task < len(tasks) or running:
+            while next_task < len(tasks) and len(running) < ATTACHMENTS_WORKERS:
+                key, arg = tasks[next_task]
+                next_task += 1
+                running[attachment_executor.submit(func, arg)] = key
+            done, _ = wait(running, timeout=max(deadline - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+            for future in done:
+                # 上传失败等异常与串行处理时一样向上抛出
+                results[running.pop(future)] = future.result()
+            if running and time.monotonic() >= deadline:
+                key = next(iter(running.values()))
+                raise AttachmentError(f"处理第 {key[0] + 1} 条消息中的附件超时（{ATTACHMENTS_TIMEOUT}s）", 504)
+    finally:
+        for future, key in running.items():
+            if not future.cancel():
+                abandon(key, future)
+
+
+def close_result(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+def resolve_attachments(messages, ori_model_name, api_key, proxy_api_prefix, account_id):
+    """
+    并发处理所有消息中的 image_url，返回 (消息下标, part 下标) -> 文件元数据。
+    先并发下载所有附件，再通过一次 MGET 读取它们的文件缓存，最后并发上传未缓存的附件。
+    同时处理的附件不超过 ATTACHMENTS_WORKERS 个；附件获取失败，或全部附件的处理时间超过
+    ATTACHMENTS_TIMEOUT 时抛出 AttachmentError，不会在缺少附件的情况下继续请求
+    """
+    if ori_model_name in ['gpt-3.5-turbo']:
+        return {}
+    tasks = []
+    for message_index, message in enumerate(messages):
+        content = message.get("content")
+        if not isinstance(content, list):
+            continue
+        for part_index, part in enumerate(content):
+            if isinstance(part, dict) and part.get("type") == "image_url":
+                # logger.debug(f"image_url: {part['image_url']}")
+                tasks.append(((message_index, part_index), part["image_url"]["url"]))
+    if not tasks:
+        return {}
+
+    # 整个请求的截止时间，排队和处理中的附件共用
+    deadline = time.monotonic() + ATTACHMENTS_TIMEOUT
+
+    def check_deadline():
+        if time.monotonic() >= deadline:
+            raise AttachmentError(f"处理附件超时（{ATTACHMENTS_TIMEOUT}s）", 504)
+
+    def acquire(file_url):
+        check_deadline()
+        return acquire_attachment(file_url, deadline)
+
+    def upload(key):
+        check_deadline()
+        attachment = attachments[key]
+        return get_file_metadata(attachment, cached[attachment.sha256], api_key, proxy_api_prefix, account_id)
+
+    def abandon_upload(key, future):
+        # 仍在上传的附件在后台执行完毕后再关闭，上传结果仍会写入文件缓存
+        abandoned.add(key)
+        future.add_done_callback(lambda _: attachments[key].close())
+
+    attachments = {}
+    abandoned = set()
+    try:
+        # 仍在下载的附件到达截止时间后中止，下载完成的文件直接关闭
+        run_attachment_tasks(tasks, acquire, deadline, lambda key, future: future.add_done_callback(close_result),
+                             attachments)
+        scope = get_account_scope(api_key, account_id)
+        cached = file_cache.get_many(scope, {attachment.sha256 for attachment in attachments.values()})
+        results = {}
+        run_attachment_tasks([(key, key) for key in attachments], upload, deadline, abandon_upload, results)
+        return results
+    finally:
+        for key, attachment in attachments.items():
+            if key not in abandoned:
+                attachment.close()
+
+
 # 定义发送请求的函数
 def send_text_prompt_and_get_response(messages, api_key, account_id, stream, model, proxy_api_prefix):
+    conversation_request = build_conversation_request(messages, api_key, account_id, model, proxy_api_prefix)
+    if not conversation_request:
+        return None
+    url, headers, payload = conversation_request
+    response = http_client.post(url, headers=headers, json=payload, stream=True)
+    # print(response)
+    return response
+
+
+def build_conversation_request(messages, api_key, account_id, model, proxy_api_prefix):
+    """
+    构造 /backend-api/conversation 请求（包括上传附件），返回 (url, headers, payload)
+    """
     url = f"{BASE_URL}{proxy_api_prefix}/backend-api/conversation"
     headers = {
         "Authorization": f"Bearer {api_key}"
@@ -720,12 +2208,14 @@ def send_text_prompt_and_get_response(messages, api_key, account_id, stream, mod
     model_config = find_model_config(model)
     ori_model_name = ''
     if model_config:
-        # 检查是否有 ori_name
-        ori_model_name = model_config.get('ori_name', model)
+        ori_model_name = model_config['ori_name']
+
+    # 先并发处理所有消息中的附件，再按原顺序组装消息
+    attachment_results = resolve_attachments(messages, ori_model_name, api_key, proxy_api_prefix, account_id)
 
     formatted_messages = []
     # logger.debug(f"原始 messages: {messages}")
-    for message in messages:
+    for message_index, message in enumerate(messages):
         message_id = str(uuid.uuid4())
         content = message.get("content")
 
@@ -735,39 +2225,14 @@ def send_text_prompt_and_get_response(messages, api_key, account_id, stream, mod
             attachments = []
             contains_image = False  # 标记是否包含图片
 
-            for part in content:
+            for part_index, part in enumerate(content):
                 if isinstance(part, dict) and "type" in part:
                     if part["type"] == "text":
                         new_parts.append(part["text"])
                     elif part["type"] == "image_url":
-                        # logger.debug(f"image_url: {part['image_url']}")
-                        file_url = part["image_url"]["url"]
-                        if file_url.startswith('data:'):
-                            # 处理 base64 编码的文件数据
-                            mime_type, base64_data = file_url.split(';')[0], file_url.split(',')[1]
-                            mime_type = mime_type.split(':')[1]
-                            try:
-                                file_content = base64.b64decode(base64_data)
-                            except Exception as e:
-                                logger.error(f"类型为 {mime_type} 的 base64 编码数据解码失败: {e}")
-                                continue
-                        else:
-                            # 处理普通的文件URL
-                            try:
-                                tmp_user_agent = ua.random
-                                logger.debug(f"随机 User-Agent: {tmp_user_agent}")
-                                tmp_headers = {
-                                    'User-Agent': tmp_user_agent
-                                }
-                                file_response = requests.get(url=file_url, headers=tmp_headers)
-                                file_content = file_response.content
-                                mime_type = file_response.headers.get('Content-Type', '').split(';')[0].strip()
-                            except Exception as e:
-                                logger.error(f"获取文件 {file_url} 失败: {e}")
-                                continue
-
-                        logger.debug(f"mime_type: {mime_type}")
-                        file_metadata = get_file_metadata(file_content, mime_type, api_key, proxy_api_prefix)
+                        file_metadata = attachment_results.get((message_index, part_index))
+                        if not file_metadata:
+                            continue
 
                         mime_type = file_metadata["mimeType"]
                         logger.debug(f"处理后 mime_type: {mime_type}")
@@ -807,227 +2272,63 @@ def send_text_prompt_and_get_response(messages, api_key, account_id, stream, mod
             formatted_message = {
                 "id": message_id,
                 "author": {"role": message.get("role")},
-                "content": {"content_type": content_type, "parts": new_parts},
-                "metadata": {"attachments": attachments}
-            }
-            formatted_messages.append(formatted_message)
-            logger.critical(f"formatted_message: {formatted_message}")
-
-        else:
-            # 处理单个文本消息的情况
-            formatted_message = {
-                "id": message_id,
-                "author": {"role": message.get("role")},
-                "content": {"content_type": "text", "parts": [content]},
-                "metadata": {}
-            }
-            formatted_messages.append(formatted_message)
-
-    # logger.debug(f"formatted_messages: {formatted_messages}")
-    # return
-    payload = {}
-
-    logger.info(f"model: {model}")
-
-    # 查找模型配置
-    model_config = find_model_config(model)
-    if model_config or 'gpt-4-gizmo-' in model:
-        # 检查是否有 ori_name
-        if model_config:
-            ori_model_name = model_config.get('ori_name', model)
-            logger.info(f"原模型名: {ori_model_name}")
-        else:
-            logger.info(f"请求模型名: {model}")
-            ori_model_name = model
-        if ori_model_name == 'gpt-4-s':
-            payload = {
-                # 构建 payload
-                "action": "next",
-                "messages": formatted_messages,
-                "parent_message_id": str(uuid.uuid4()),
-                "model": "gpt-4",
-                "timezone_offset_min": -480,
-                "suggestions": [],
-                "history_and_training_disabled": False,
-                "conversation_mode": {"kind": "primary_assistant"}, "force_paragen": False, "force_rate_limit": False
-            }
-        elif ori_model_name == 'gpt-4-mobile':
-            payload = {
-                # 构建 payload
-                "action": "next",
-                "messages": formatted_messages,
-                "parent_message_id": str(uuid.uuid4()),
-                "model": "gpt-4",
-                "timezone_offset_min": -480,
-                "suggestions": [],
-                "history_and_training_disabled": False,
-                "conversation_mode": {"kind": "primary_assistant"}, "force_paragen": False, "force_rate_limit": False
-            }
-        elif ori_model_name == 'gpt-3.5-turbo':
-            payload = {
-                # 构建 payload
-                "action": "next",
-                "messages": formatted_messages,
-                "parent_message_id": str(uuid.uuid4()),
-                "model": "gpt-4o-mini",
-                "timezone_offset_min": -480,
-                "suggestions": [
-                    "What are 5 creative things I could do with my kids' art? I don't want to throw them away, "
-                    "but it's also so much clutter.",
-                    "I want to cheer up my friend who's having a rough day. Can you suggest a couple short and sweet "
-                    "text messages to go with a kitten gif?",
-                    "Come up with 5 concepts for a retro-style arcade game.",
-                    "I have a photoshoot tomorrow. Can you recommend me some colors and outfit options that will look "
-                    "good on camera?"
-                ],
-                "history_and_training_disabled": False,
-                "arkose_token": None,
-                "conversation_mode": {
-                    "kind": "primary_assistant"
-                },
-                "force_paragen": False,
-                "force_paragen_model_slug": "",
-                "force_rate_limit": False
-            }
-        elif ori_model_name == 'gpt-4-o':
-            payload = {
-                # 构建 payload
-                "action": "next",
-                "messages": formatted_messages,
-                "parent_message_id": str(uuid.uuid4()),
-                "model": "gpt-4o",
-                "timezone_offset_min": -480,
-                "suggestions": [
-                    "What are 5 creative things I could do with my kids' art? I don't want to throw them away, but it's also so much clutter.",
-                    "I want to cheer up my friend who's having a rough day. Can you suggest a couple short and sweet text messages to go with a kitten gif?",
-                    "Come up with 5 concepts for a retro-style arcade game.",
-                    "I have a photoshoot tomorrow. Can you recommend me some colors and outfit options that will look good on camera?"
-                ],
-                "history_and_training_disabled": False,
-                "arkose_token": None,
-                "conversation_mode": {
-                    "kind": "primary_assistant"
-                },
-                "force_paragen": False,
-                "force_rate_limit": False
-            }
-        elif ori_model_name == 'gpt-4o-mini':
-            payload = {
-                # 构建 payload
-                "action": "next",
-                "messages": formatted_messages,
-                "parent_message_id": str(uuid.uuid4()),
-                "model": "gpt-4o-mini",
-                "timezone_offset_min": -480,
-                "suggestions": [
-                    "What are 5 creative things I could do with my kids' art? I don't want to throw them away, "
-                    "but it's also so much clutter.",
-                    "I want to cheer up my friend who's having a rough day. Can you suggest a couple short and sweet "
-                    "text messages to go with a kitten gif?",
-                    "Come up with 5 concepts for a retro-style arcade game.",
-                    "I have a photoshoot tomorrow. Can you recommend me some colors and outfit options that will look "
-                    "good on camera?"
-                ],
-                "history_and_training_disabled": False,
-                "arkose_token": None,
-                "conversation_mode": {
-                    "kind": "primary_assistant"
-                },
-                "force_paragen": False,
-                "force_paragen_model_slug": "",
-                "force_rate_limit": False
-            }
-        elif ori_model_name == 'o1-preview':
-            payload = {
-                "action": "next",
-                "messages": formatted_messages,
-                "parent_message_id": str(uuid.uuid4()),
-                "model": "o1-preview",
-                "timezone_offset_min": -480,
-                "suggestions": [
-                    "What are 5 creative things I could do with my kids' art? I don't want to throw them away, "
-                    "but it's also so much clutter.",
-                    "I want to cheer up my friend who's having a rough day. Can you suggest a couple short and sweet "
-                    "text messages to go with a kitten gif?",
-                    "Come up with 5 concepts for a retro-style arcade game.",
-                    "I have a photoshoot tomorrow. Can you recommend me some colors and outfit options that will look "
-                    "good on camera?"
-                ],
-                "variant_purpose": "comparison_implicit",
-                "history_and_training_disabled": False,
-                "conversation_mode": {
-                    "kind": "primary_assistant"
-                },
-                "force_paragen": False,
-                "force_paragen_model_slug": "",
-                "force_nulligen": False,
-                "force_rate_limit": False,
-                "reset_rate_limits": False,
-                "force_use_sse": True,
+                "content": {"content_type": content_type, "parts": new_parts},
+                "metadata": {"attachments": attachments}
             }
-        elif ori_model_name == 'o1-mini':
-            payload = {
-                "action": "next",
-                "messages": formatted_messages,
-                "parent_message_id": str(uuid.uuid4()),
-                "model": "o1-mini",
-                "timezone_offset_min": -480,
-                "suggestions": [
-                    "What are 5 creative things I could do with my kids' art? I don't want to throw them away, "
-                    "but it's also so much clutter.",
-                    "I want to cheer up my friend who's having a rough day. Can you suggest a couple short and sweet "
-                    "text messages to go with a kitten gif?",
-                    "Come up with 5 concepts for a retro-style arcade game.",
-                    "I have a photoshoot tomorrow. Can you recommend me some colors and outfit options that will look "
-                    "good on camera?"
-                ],
-                "variant_purpose": "comparison_implicit",
-                "history_and_training_disabled": False,
-                "conversation_mode": {
-                    "kind": "primary_assistant"
-                },
-                "force_paragen": False,
-                "force_paragen_model_slug": "",
-                "force_nulligen": False,
-                "force_rate_limit": False,
-                "reset_rate_limits": False,
-                "force_use_sse": True,
+            formatted_messages.append(formatted_message)
+            logger.critical(f"formatted_message: {formatted_message}")
+
+        else:
+            # 处理单个文本消息的情况
+            formatted_message = {
+                "id": message_id,
+                "author": {"role": message.get("role")},
+                "content": {"content_type": "text", "parts": [content]},
+                "metadata": {}
             }
+            formatted_messages.append(formatted_message)
+
+    # logger.debug(f"formatted_messages: {formatted_messages}")
+    # return
+    payload = {}
 
+    logger.info(f"model: {model}")
+
+    if model_config or 'gpt-4-gizmo-' in model:
+        if model_config:
+            logger.info(f"原模型名: {ori_model_name}")
+        else:
+            logger.info(f"请求模型名: {model}")
+            ori_model_name = model
+        if model_config and 'payload_template' in model_config:
+            payload = new_conversation_payload(model_config['payload_template'], formatted_messages)
         elif 'gpt-4-gizmo-' in model:
-            payload = generate_gpts_payload(model, formatted_messages)
-            if not payload:
-                global gpts_configurations
-                # 假设 model是 'gpt-4-gizmo-123'
-                split_name = model.split('gpt-4-gizmo-')
-                model_id = split_name[1] if len(split_name) > 1 else None
-                gizmo_info = fetch_gizmo_info(BASE_URL, proxy_api_prefix, model_id)
-                logging.info(gizmo_info)
-
-                # 如果成功获取到数据，则将其存入 Redis
-                if gizmo_info:
-                    redis_client.set(model_id, str(gizmo_info))
-                    logger.info(f"Cached gizmo info for {model}, {model_id}")
-                    # 检查模型名称是否已经在列表中
-                    if not any(d['name'] == model for d in gpts_configurations):
-                        gpts_configurations.append({
-                            'name': model,
-                            'id': model_id,
-                            'config': gizmo_info
-                        })
-                    else:
-                        logger.info(f"Model already exists in the list, skipping...")
-                    payload = generate_gpts_payload(model, formatted_messages)
-                else:
-                    raise Exception('KEY_FOR_GPTS_INFO is not accessible')
+            # 假设 model是 'gpt-4-gizmo-123'
+            split_name = model.split('gpt-4-gizmo-')
+            model_id = split_name[1] if len(split_name) > 1 else None
+            gizmo_info = fetch_gizmo_info(BASE_URL, proxy_api_prefix, model_id)
+            logging.info(gizmo_info)
+
+            # 如果成功获取到数据，则将其存入 Redis
+            if gizmo_info:
+                redis_store.set(redis_key('gizmo', model_id), dump_gizmo_info(gizmo_info), ex=GPTS_CACHE_TTL)
+                logger.info(f"Cached gizmo info for {model}, {model_id}")
+                model_registry.add_all([{
+                    'name': model,
+                    'id': model_id,
+                    'config': gizmo_info
+                }])
+                payload = generate_gpts_payload(model, formatted_messages)
+            else:
+                raise Exception('KEY_FOR_GPTS_INFO is not accessible')
         else:
-            payload = generate_gpts_payload(model, formatted_messages)
-            if not payload:
-                raise Exception('model is not accessible')
+            raise Exception('model is not accessible')
         # 根据NEED_DELETE_CONVERSATION_AFTER_RESPONSE修改history_and_training_disabled
         if NEED_DELETE_CONVERSATION_AFTER_RESPONSE:
             logger.debug(f"是否保留会话: {NEED_DELETE_CONVERSATION_AFTER_RESPONSE == False}")
             payload['history_and_training_disabled'] = True
+        if UPSTREAM_DELTA_ENCODING:
+            payload['supported_encodings'] = ["v1"]
         if ori_model_name not in ['gpt-3.5-turbo']:
             if CUSTOM_ARKOSE:
                 token = get_token()
@@ -1041,9 +2342,7 @@ def send_text_prompt_and_get_response(messages, api_key, account_id, stream, mod
 
         logger.debug(f"headers: {headers}")
         logger.debug(f"payload: {payload}")
-        response = requests.post(url, headers=headers, json=payload, stream=True)
-        # print(response)
-        return response
+        return url, headers, payload
 
 
 def delete_conversation(conversation_id, api_key, proxy_api_prefix):
@@ -1057,7 +2356,7 @@ def delete_conversation(conversation_id, api_key, proxy_api_prefix):
             "Authorization": f"Bearer {api_key}",
         }
         patch_data = {"is_visible": False}
-        response = requests.patch(patch_url, headers=patch_headers, json=patch_data)
+        response = http_client.patch(patch_url, headers=patch_headers, json=patch_data)
 
         if response.status_code == 200:
             logger.info(f"删除会话 {conversation_id} 成功")
@@ -1065,30 +2364,318 @@ def delete_conversation(conversation_id, api_key, proxy_api_prefix):
             logger.error(f"PATCH 请求失败: {response.text}")
 
 
-from PIL import Image
 import io
+import re
 
 
-def save_image(image_data, path='images'):
-    try:
-        # print(f"image_data: {image_data}")
-        if not os.path.exists(path):
-            os.makedirs(path)
-        current_time = datetime.now().strftime('%Y%m%d%H%M%S')
-        filename = f'image_{current_time}.png'
-        full_path = os.path.join(path, filename)
-        logger.debug(f"完整的文件路径: {full_path}")  # 打印完整路径
-        # print(f"filename: {filename}")
-        # 使用 PIL 打开图像数据
-        with Image.open(io.BytesIO(image_data)) as image:
-            # 保存为 PNG 格式
-            image.save(os.path.join(path, filename), 'PNG')
-
-        logger.debug(f"保存图片成功: {filename}")
-
-        return os.path.join(path, filename)
-    except Exception as e:
-        logger.error(f"保存图片时出现异常: {e}")
+def get_download_url(file_id, api_key, proxy_api_prefix):
+    image_url = f"{BASE_URL}{proxy_api_prefix}/backend-api/files/{file_id}/download"
+    headers = {
+        "Authorization": f"Bearer {api_key}"
+    }
+    image_response = http_client.get(image_url, headers=headers)
+    if image_response.status_code != 200:
+        logger.error(f"获取图片下载链接失败: {image_response.text}")
+        return None
+    download_url = image_response.json().get('download_url')
+    logger.debug(f"download_url: {download_url}")
+    return download_url
+
+
+def encode_image(image_data):
+    """
+    PNG、WebP 原样保存，其他格式转为 PNG，返回 (图片数据, 扩展名)
+    """
+    if image_data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return image_data, '.png'
+    if image_data[:4] == b'RIFF' and image_data[8:12] == b'WEBP':
+        return image_data, '.webp'
+    from PIL import Image
+    with Image.open(io.BytesIO(image_data)) as image:
+        output = io.BytesIO()
+        image.save(output, 'PNG')
+        return output.getvalue(), '.png'
+
+
+class ContentStore:
+    """
+    按内容寻址的文件存储：文件以 sha256 命名，保存在 objects/ab/cd/ 分片目录下；
+    对外的文件名（例如 image_<asset>）通过 aliases/ 下的别名文件指向实际文件。
+    sweep() 按保存时间和目录总大小清理旧文件，根目录下旧版本保存的文件同样参与清理
+    """
+
+    # .part 文件超过该秒数仍存在，认为下载进程已退出
+    STALE_AFTER = 300
+    # 临时文件超过该秒数没有写入，认为写入进程已退出；远大于上游的读取超时，慢速下载不会被误删
+    TMP_STALE_AFTER = 86400
+
+    def __init__(self, root, max_size=0, max_age=0):
+        self.root = root
+        self.objects_dir = os.path.join(root, 'objects')
+        self.aliases_dir = os.path.join(root, 'aliases')
+        self.max_size = max_size
+        self.max_age = max_age
+        self.last_summary = None
+        # 本进程正在写入的临时文件，清理时跳过
+        self.writing = set()
+        self.lock = threading.Lock()
+
+    def object_path(self, key):
+        return os.path.join(self.objects_dir, key[:2], key[2:4], key)
+
+    def alias_path(self, alias):
+        return os.path.join(self.aliases_dir, alias)
+
+    @staticmethod
+    def is_safe_name(name):
+        return bool(name) and name not in ('.', '..') and '/' not in name and os.sep not in name
+
+    def put(self, chunks, extension='', alias=None):
+        """
+        保存文件内容（bytes 或 bytes 迭代器），边写入边计算 sha256，返回文件的 key
+        """
+        if isinstance(chunks, bytes):
+            chunks = [chunks]
+        os.makedirs(self.objects_dir, exist_ok=True)
+        tmp_path = os.path.join(self.objects_dir, f'{uuid.uuid4().hex}.tmp')
+        hasher = hashlib.sha256()
+        with self.lock:
+            self.writing.add(tmp_path)
+        try:
+            with open(tmp_path, 'wb') as file:
+                for chunk in chunks:
+                    hasher.update(chunk)
+                    file.write(chunk)
+            key = hasher.hexdigest() + extension.lower()
+            path = self.object_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.exists(path):
+                # 内容相同的文件已存在，只更新保存时间
+                os.utime(path)
+            else:
+                os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            with self.lock:
+                self.writing.discard(tmp_path)
+        if alias:
+            self.link(alias, key)
+        return key
+
+    def link(self, alias, key):
+        os.makedirs(self.aliases_dir, exist_ok=True)
+        tmp_path = os.path.join(self.aliases_dir, f'.{uuid.uuid4().hex}.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            file.write(key)
+        os.replace(tmp_path, self.alias_path(alias))
+
+    def resolve(self, filename):
+        """
+        对外文件名 -> 实际文件路径，不存在返回 None
+        """
+        if not self.is_safe_name(filename):
+            return None
+        try:
+            with open(self.alias_path(filename), encoding='utf-8') as file:
+                path = self.object_path(file.read().strip())
+        except OSError:
+            # 直接使用 key 访问，或旧版本保存在根目录下的文件
+            path = self.object_path(filename) if re.fullmatch(r'[0-9a-f]{64}(\.\w+)?', filename) \
+                else os.path.join(self.root, filename)
+        return path if os.path.isfile(path) else None
+
+    def sweep(self):
+        """
+        删除超过 max_age 的文件，总大小超过 max_size 时从最早保存的文件开始删除，再清理失效的别名
+        """
+        now = time.time()
+        entries = []
+        removed = 0
+        freed = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            if dirpath == self.root and 'aliases' in dirnames:
+                dirnames.remove('aliases')
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if name.endswith('.tmp'):
+                    with self.lock:
+                        writing = path in self.writing
+                    if not writing and now - stat.st_mtime > self.TMP_STALE_AFTER:
+                        os.remove(path)
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in entries:
+            expired = self.max_age and now - mtime > self.max_age
+            if not expired and not (self.max_size and total > self.max_size):
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+            freed += size
+
+        if os.path.isdir(self.aliases_dir):
+            for name in os.listdir(self.aliases_dir):
+                path = self.alias_path(name)
+                try:
+                    if name.endswith('.part'):
+                        if now - os.path.getmtime(path) > self.STALE_AFTER:
+                            os.remove(path)
+                    elif name.endswith('.tmp'):
+                        if now - os.path.getmtime(path) > self.TMP_STALE_AFTER:
+                            os.remove(path)
+                    elif not self.resolve(name):
+                        os.remove(path)
+                except OSError:
+                    continue
+
+        self.last_summary = {
+            "files": len(entries) - removed,
+            "bytes": total,
+            "removed": removed,
+            "freed": freed,
+            "swept_at": datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        }
+        return self.last_summary
+
+
+def serve_stored_file(store, filename):
+    full_path = store.resolve(filename)
+    if not full_path:
+        return "文件不存在哦！", 404
+    name = os.path.basename(full_path)
+    # 实际文件以 sha256 作为 ETag；只有文件名本身包含该 sha256（完整 key 或 <前 12 位>_<文件名>）时内容才不会变化，
+    # 可以被客户端长期缓存，image_<asset> 等别名可能被重新指向，只短期缓存并重新验证
+    content_addressed = full_path.startswith(store.objects_dir)
+    etag = name.split('.')[0] if content_addressed else True
+    hash_prefixed = bool(re.fullmatch(r'[0-9a-f]{12}_.+', filename)) and name.startswith(filename[:12])
+    immutable = content_addressed and (filename == name or hash_prefixed)
+    mimetype = mimetypes.guess_type(name)[0] or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    if STATIC_FILES_OFFLOAD == 'x-accel-redirect':
+        # 由 nginx 发送文件并处理 Range，条件请求在这里先返回 304
+        response = Response(mimetype=mimetype)
+        internal_path = f"{STATIC_FILES_ACCEL_PREFIX.rstrip('/')}/{os.path.relpath(full_path).replace(os.sep, '/')}"
+        response.headers['X-Accel-Redirect'] = urllib.parse.quote(internal_path)
+        if content_addressed:
+            response.set_etag(etag)
+        response.last_modified = os.path.getmtime(full_path)
+        response.make_conditional(request)
+    else:
+        # send_file 处理 If-None-Match、If-Modified-Since 和 Range，USE_X_SENDFILE 时只返回 X-Sendfile 头
+        response = send_file(full_path, mimetype=mimetype, conditional=True, etag=etag, download_name=filename)
+    if immutable and STATIC_FILES_CACHE_MAX_AGE:
+        # send_file 默认带有 no-cache，这里替换为长期缓存
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_FILES_CACHE_MAX_AGE
+        response.cache_control.immutable = True
+    elif content_addressed and STATIC_FILES_ALIAS_CACHE_MAX_AGE:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_FILES_ALIAS_CACHE_MAX_AGE
+        response.cache_control.must_revalidate = True
+    return response
+
+
+image_store = ContentStore('images', STORAGE_MAX_SIZE, STORAGE_MAX_AGE)
+file_store = ContentStore('files', STORAGE_MAX_SIZE, STORAGE_MAX_AGE)
+
+
+class ImagePersister:
+    """
+    后台下载并保存生成的图片：对外文件名由 asset pointer 决定，流式响应中可以立即返回图片地址；
+    下载期间存在 .part 文件，同一图片只会下载一次（多进程间同样有效）。
+    下载前无法知道图片格式，首次返回的文件名不带扩展名，按实际格式返回 Content-Type；
+    保存后另建带实际扩展名的别名，之后再次引用同一图片时返回带扩展名的地址
+    """
+
+    def __init__(self, store, workers=4, wait_timeout=30):
+        self.store = store
+        self.wait_timeout = wait_timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image')
+        self.lock = threading.Lock()
+        self.stats = {'saved': 0, 'failed': 0}
+
+    @staticmethod
+    def image_name(file_id):
+        safe_id = re.sub(r'[^A-Za-z0-9_-]', '_', file_id)
+        return f'image_{safe_id}'
+
+    def persist(self, file_id, api_key, proxy_api_prefix):
+        """
+        返回图片的相对路径，图片在后台下载保存
+        """
+        image_name = self.image_name(file_id)
+        url_path = f"{self.store.root}/{image_name}"
+        stored_path = self.store.resolve(image_name)
+        if stored_path:
+            url_path += os.path.splitext(stored_path)[1]
+            logger.debug(f"图片已存在: {url_path}")
+            return url_path
+        os.makedirs(self.store.aliases_dir, exist_ok=True)
+        part_path = self.store.alias_path(image_name) + '.part'
+        try:
+            # 独占创建 .part 文件，已在下载中的图片不重复下载
+            open(part_path, 'x').close()
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(part_path) < self.store.STALE_AFTER:
+                    return url_path
+            except OSError:
+                return url_path
+        self.executor.submit(self.download, file_id, api_key, proxy_api_prefix, image_name)
+        return url_path
+
+    def download(self, file_id, api_key, proxy_api_prefix, image_name):
+        part_path = self.store.alias_path(image_name) + '.part'
+        saved = False
+        try:
+            download_url = get_download_url(file_id, api_key, proxy_api_prefix)
+            if download_url:
+                image_download_response = http_client.get(download_url)
+                if image_download_response.status_code == 200:
+                    logger.debug(f"下载图片成功")
+                    image_data, extension = encode_image(image_download_response.content)
+                    key = self.store.put(image_data, extension, alias=image_name)
+                    self.store.link(image_name + extension, key)
+                    logger.debug(f"保存图片成功: {image_name} -> {key}")
+                    saved = True
+                else:
+                    logger.error(f"下载图片失败: {image_download_response.text}")
+        except Exception as e:
+            logger.error(f"保存图片时出现异常: {e}")
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        with self.lock:
+            self.stats['saved' if saved else 'failed'] += 1
+        if not saved:
+            # 已返回给客户端的地址将返回 404，再次引用同一图片时会重新下载
+            logger.error(f"图片 {image_name} 保存失败，已返回的地址 {self.store.root}/{image_name} 将无法访问")
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def wait(self, image_name):
+        """
+        图片仍在下载时等待其完成，返回图片是否存在
+        """
+        part_path = self.store.alias_path(image_name) + '.part'
+        deadline = time.monotonic() + self.wait_timeout
+        while os.path.exists(part_path) and time.monotonic() < deadline:
+            time.sleep(0.1)
+        return self.store.resolve(image_name) is not None
 
 
 def unicode_to_chinese(unicode_string):
@@ -1098,7 +2685,7 @@ def unicode_to_chinese(unicode_string):
     return json.loads(json_formatted_str)
 
 
-import re
+image_persister = ImagePersister(image_store, IMAGE_STORAGE_WORKERS, IMAGE_STORAGE_WAIT_TIMEOUT)
 
 
 # 辅助函数：检查是否为合法的引用格式或正在构建中的引用格式
@@ -1202,10 +2789,9 @@ def replace_sandbox(text, conversation_id, message_id, api_key, proxy_api_prefix
         if download_url == None:
             return "\n```\nError: 沙箱文件下载失败，这可能是因为您启用了隐私模式\n```"
         file_name = extract_filename(download_url)
-        timestamped_file_name = timestamp_filename(file_name)
         if USE_OAIUSERCONTENT_URL == False:
-            download_file(download_url, timestamped_file_name)
-            return f"({UPLOAD_BASE_URL}/files/{timestamped_file_name})"
+            stored_file_name = download_file(download_url, file_name)
+            return f"({UPLOAD_BASE_URL}/files/{stored_file_name})"
         else:
             return f"({download_url})"
 
@@ -1217,7 +2803,7 @@ def replace_sandbox(text, conversation_id, message_id, api_key, proxy_api_prefix
             "Authorization": f"Bearer {api_key}"
         }
 
-        response = requests.get(sandbox_info_url, headers=headers)
+        response = http_client.get(sandbox_info_url, headers=headers)
 
         if response.status_code == 200:
             logger.debug(f"获取下载 URL 成功: {response.json()}")
@@ -1233,587 +2819,779 @@ def replace_sandbox(text, conversation_id, message_id, api_key, proxy_api_prefix
         filename = query_params.get("rscd", [""])[0].split("filename=")[-1]
         return filename
 
-    def timestamp_filename(filename):
-        # 在文件名前加上当前时间戳
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-
-        # 解码URL编码的filename
-        decoded_filename = unquote(filename)
-
-        return f"{timestamp}_{decoded_filename}"
-
     def download_file(download_url, filename):
-        # 下载并保存文件
-        # 确保 ./files 目录存在
-        if not os.path.exists("./files"):
-            os.makedirs("./files")
-        file_path = f"./files/{filename}"
-        with requests.get(download_url, stream=True) as r:
-            with open(file_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
+        # 下载并按内容保存文件，返回 <sha256 前 12 位>_<原文件名> 形式的对外文件名
+        decoded_filename = re.sub(r'[\\/]', '_', unquote(filename)) or 'file'
+        extension = os.path.splitext(decoded_filename)[1]
+        if not re.fullmatch(r'\.[A-Za-z0-9]{1,10}', extension):
+            extension = ''
+        with http_client.get(download_url, stream=True) as r:
+            key = file_store.put(r.iter_content(chunk_size=8192), extension)
+        stored_file_name = f"{key[:12]}_{decoded_filename}"
+        file_store.link(stored_file_name, key)
+        return urllib.parse.quote(stored_file_name)
 
     # 替换 (sandbox:xxx) 格式的文本
     replaced_text = re.sub(r'\(sandbox:([^)]+)\)', replace_match, text)
     return replaced_text
 
 
-def data_fetcher(upstream_response, data_queue, stop_event, last_data_time, api_key, chat_message_id, model,
-                 proxy_api_prefix):
-    all_new_text = ""
+# 上游 ping 事件携带的时间戳数据，例如 data: 2024-01-01 00:00:00.000000
+SSE_TIMESTAMP_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d{6}')
 
-    first_output = True
-
-    # 当前时间戳
-    timestamp = int(time.time())
-
-    buffer = ""
-    last_full_text = ""  # 用于存储之前所有出现过的 parts 组成的完整文本
-    last_full_code = ""
-    last_full_code_result = ""
-    last_content_type = None  # 用于记录上一个消息的内容类型
-    conversation_id = ''
-    citation_buffer = ""
-    citation_accumulating = False
-    file_output_buffer = ""
-    file_output_accumulating = False
-    execution_output_image_url_buffer = ""
-    execution_output_image_id_buffer = ""
-    message = None
-    try:
-        for chunk in upstream_response.iter_content(chunk_size=1024):
-            if stop_event.is_set():
-                logger.info(f"接受到停止信号，停止数据处理线程")
-                break
-            if chunk:
-                buffer += chunk.decode('utf-8')
-                # 检查是否存在 "event: ping"，如果存在，则只保留 "data:" 后面的内容
-                if "event: ping" in buffer:
-                    if "data:" in buffer:
-                        buffer = buffer.split("data:", 1)[1]
-                        buffer = "data:" + buffer
-                # 使用正则表达式移除特定格式的字符串
-                # print("应用正则表达式之前的 buffer:", buffer.replace('\n', '\\n'))
-                buffer = re.sub(r'data: \d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d{6}(\r\n|\r|\n){2}', '', buffer)
-                # print("应用正则表达式之后的 buffer:", buffer.replace('\n', '\\n'))
-
-                while 'data:' in buffer and '\n\n' in buffer:
-                    end_index = buffer.index('\n\n') + 2
-                    complete_data, buffer = buffer[:end_index], buffer[end_index:]
-                    try:
-                        data_content = complete_data[6:].strip()
-                        if not data_content:
-                            continue
-                        data_json = json.loads(data_content)
-                        # print(f"data_json: {data_json}")
-                        message = data_json.get("message", {})
 
-                        if message == {} or message == None:
-                            logger.debug(f"message 为空: data_json: {data_json}")
+class SSEDecoder:
+    """
+    增量解析上游返回的 SSE 字节流。
 
-                        message_id = message.get("id")
-                        message_status = message.get("status")
-                        content = message.get("content", {})
-                        role = message.get("author", {}).get("role")
-                        content_type = content.get("content_type")
+    feed() 接收任意切分的字节块，返回新解析出的完整事件 (event, data) 列表。
+    使用增量 UTF-8 解码器处理跨块的多字节字符，未完成的事件以片段列表暂存，
+    每个字符只扫描一次；ping 事件和时间戳数据会被直接丢弃。
+    """
 
-                        metadata = {}
-                        citations = []
-                        try:
-                            metadata = message.get("metadata", {})
-                            citations = metadata.get("citations", [])
-                        except:
-                            pass
-                        name = message.get("author", {}).get("name")
-                        if (
-                                role == "user" or message_status == "finished_successfully" or role == "system") and role != "tool":
-                            # 如果是用户发来的消息，直接舍弃
-                            continue
-                        try:
-                            conversation_id = data_json.get("conversation_id")
-                            # print(f"conversation_id: {conversation_id}")
-                            if conversation_id:
-                                data_queue.put(('conversation_id', conversation_id))
-                        except:
-                            pass
-                            # 只获取新的部分
-                        new_text = ""
-                        is_img_message = False
-                        parts = content.get("parts", [])
-                        for part in parts:
-                            try:
-                                # print(f"part: {part}")
-                                # print(f"part type: {part.get('content_type')}")
-                                if part.get('content_type') == 'image_asset_pointer':
-                                    logger.debug(f"find img message~")
-                                    is_img_message = True
-                                    asset_pointer = part.get('asset_pointer').replace('file-service://', '')
-                                    logger.debug(f"asset_pointer: {asset_pointer}")
-                                    image_url = f"{BASE_URL}{proxy_api_prefix}/backend-api/files/{asset_pointer}/download"
-
-                                    headers = {
-                                        "Authorization": f"Bearer {api_key}"
-                                    }
-                                    image_response = requests.get(image_url, headers=headers)
-
-                                    if image_response.status_code == 200:
-                                        download_url = image_response.json().get('download_url')
-                                        logger.debug(f"download_url: {download_url}")
-                                        if USE_OAIUSERCONTENT_URL == True:
-                                            if ((BOT_MODE_ENABLED == False) or (
-                                                    BOT_MODE_ENABLED == True and BOT_MODE_ENABLED_MARKDOWN_IMAGE_OUTPUT == True)):
-                                                new_text = f"\n![image]({download_url})\n[下载链接]({download_url})\n"
-                                            if BOT_MODE_ENABLED == True and BOT_MODE_ENABLED_PLAIN_IMAGE_URL_OUTPUT == True:
-                                                if all_new_text != "":
-                                                    new_text = f"\n图片链接：{download_url}\n"
-                                                else:
-                                                    new_text = f"图片链接：{download_url}\n"
-                                        else:
-                                            # 从URL下载图片
-                                            # image_data = requests.get(download_url).content
-                                            image_download_response = requests.get(download_url)
-                                            # print(f"image_download_response: {image_download_response.text}")
-                                            if image_download_response.status_code == 200:
-                                                logger.debug(f"下载图片成功")
-                                                image_data = image_download_response.content
-                                                today_image_url = save_image(image_data)  # 保存图片，并获取文件名
-                                                if ((BOT_MODE_ENABLED == False) or (
-                                                        BOT_MODE_ENABLED == True and BOT_MODE_ENABLED_MARKDOWN_IMAGE_OUTPUT == True)):
-                                                    new_text = f"\n![image]({UPLOAD_BASE_URL}/{today_image_url})\n[下载链接]({UPLOAD_BASE_URL}/{today_image_url})\n"
-                                                if BOT_MODE_ENABLED == True and BOT_MODE_ENABLED_PLAIN_IMAGE_URL_OUTPUT == True:
-                                                    if all_new_text != "":
-                                                        new_text = f"\n图片链接：{UPLOAD_BASE_URL}/{today_image_url}\n"
-                                                    else:
-                                                        new_text = f"图片链接：{UPLOAD_BASE_URL}/{today_image_url}\n"
-                                            else:
-                                                logger.error(f"下载图片失败: {image_download_response.text}")
-                                        if last_content_type == "code":
-                                            if BOT_MODE_ENABLED and BOT_MODE_ENABLED_CODE_BLOCK_OUTPUT == False:
-                                                new_text = new_text
-                                            else:
-                                                new_text = "\n```\n" + new_text
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.pieces = []
+        self.pending_cr = False
+        # 不符合 SSE 格式的内容（如上游直接返回的 JSON 错误），在 flush() 时原样返回
+        self.unparsed = []
+
+    def feed(self, chunk):
+        return self.feed_text(self.decoder.decode(chunk))
+
+    def feed_text(self, text):
+        # 统一换行符，块末尾的 \r 可能与下一块开头的 \n 组成 \r\n，先保留
+        if self.pending_cr:
+            text = '\r' + text
+            self.pending_cr = False
+        if text.endswith('\r'):
+            text = text[:-1]
+            self.pending_cr = True
+        if '\r' in text:
+            text = text.replace('\r\n', '\n').replace('\r', '\n')
+        if not text:
+            return []
+
+        events = []
+        start = 0
+        # 上一块以换行结尾且本块以换行开头，事件边界横跨两个块
+        if self.pieces and self.pieces[-1].endswith('\n') and text.startswith('\n'):
+            self.parse_block(''.join(self.pieces), events)
+            self.pieces = []
+            start = 1
+        while True:
+            end_index = text.find('\n\n', start)
+            if end_index == -1:
+                break
+            self.pieces.append(text[start:end_index])
+            self.parse_block(''.join(self.pieces), events)
+            self.pieces = []
+            start = end_index + 2
+        if start < len(text):
+            self.pieces.append(text[start:])
+        return events
+
+    def parse_block(self, block, events):
+        event_name = None
+        data_lines = []
+        is_sse = False
+        for line in block.split('\n'):
+            if not line:
+                continue
+            if line.startswith(':'):
+                is_sse = True
+                continue
+            field, _, value = line.partition(':')
+            if value.startswith(' '):
+                value = value[1:]
+            if field == 'data':
+                data_lines.append(value)
+            elif field == 'event':
+                event_name = value
+            elif field not in ('id', 'retry'):
+                continue
+            is_sse = True
+        if not is_sse:
+            if block.strip():
+                self.unparsed.append(block)
+            return
+        if event_name == 'ping' or not data_lines:
+            return
+        data = '\n'.join(data_lines)
+        if SSE_TIMESTAMP_PATTERN.fullmatch(data):
+            return
+        events.append((event_name, data))
+
+    def flush(self):
+        # 返回流结束时剩余的未解析文本
+        tail = self.decoder.decode(b'', final=True)
+        if self.pending_cr:
+            tail = '\r' + tail
+            self.pending_cr = False
+        rest = ''.join(self.pieces) + tail
+        self.pieces = []
+        if rest.strip():
+            self.unparsed.append(rest)
+        unparsed = '\n\n'.join(self.unparsed)
+        self.unparsed = []
+        return unparsed
+
+
+class DeltaText:
+    # v1 增量编码下按追加顺序保存的文本片段，避免每次追加都复制完整文本
+    def __init__(self, text=''):
+        self.chunks = [text] if text else []
+        self.length = len(text)
+
+    def append(self, text):
+        if text:
+            self.chunks.append(text)
+            self.length += len(text)
+
+    def suffix(self, offset):
+        # 从末尾向前取 offset 之后的部分，开销只与新增长度相关
+        remaining = self.length - offset
+        if remaining <= 0:
+            return ''
+        pieces = []
+        for chunk in reversed(self.chunks):
+            if len(chunk) >= remaining:
+                pieces.append(chunk[len(chunk) - remaining:])
+                break
+            pieces.append(chunk)
+            remaining -= len(chunk)
+        return ''.join(reversed(pieces))
 
-                                        logger.debug(f"new_text: {new_text}")
-                                        is_img_message = True
-                                    else:
-                                        logger.error(f"获取图片下载链接失败: {image_response.text}")
-                            except:
-                                pass
+    def __len__(self):
+        return self.length
 
-                        if is_img_message == False:
-                            # print(f"data_json: {data_json}")
-                            if content_type == "multimodal_text" and last_content_type == "code":
-                                new_text = "\n```\n" + content.get("text", "")
-                                if BOT_MODE_ENABLED and BOT_MODE_ENABLED_CODE_BLOCK_OUTPUT == False:
-                                    new_text = content.get("text", "")
-                            elif role == "tool" and name == "dalle.text2im":
-                                logger.debug(f"无视消息: {content.get('text', '')}")
-                                continue
-                            # 代码块特殊处理
-                            if content_type == "code" and last_content_type != "code" and content_type != None:
-                                full_code = ''.join(content.get("text", ""))
-                                new_text = "\n```\n" + full_code[len(last_full_code):]
-                                # print(f"full_code: {full_code}")
-                                # print(f"last_full_code: {last_full_code}")
-                                # print(f"new_text: {new_text}")
-                                last_full_code = full_code  # 更新完整代码以备下次比较
-                                if BOT_MODE_ENABLED and BOT_MODE_ENABLED_CODE_BLOCK_OUTPUT == False:
-                                    new_text = ""
+    def __str__(self):
+        if len(self.chunks) > 1:
+            self.chunks = [''.join(self.chunks)]
+        return self.chunks[0] if self.chunks else ''
 
-                            elif last_content_type == "code" and content_type != "code" and content_type != None:
-                                full_code = ''.join(content.get("text", ""))
-                                new_text = "\n```\n" + full_code[len(last_full_code):]
-                                # print(f"full_code: {full_code}")
-                                # print(f"last_full_code: {last_full_code}")
-                                # print(f"new_text: {new_text}")
-                                last_full_code = ""  # 更新完整代码以备下次比较
-                                if BOT_MODE_ENABLED and BOT_MODE_ENABLED_CODE_BLOCK_OUTPUT == False:
-                                    new_text = ""
 
-                            elif content_type == "code" and last_content_type == "code" and content_type != None:
-                                full_code = ''.join(content.get("text", ""))
-                                new_text = full_code[len(last_full_code):]
-                                # print(f"full_code: {full_code}")
-                                # print(f"last_full_code: {last_full_code}")
-                                # print(f"new_text: {new_text}")
-                                last_full_code = full_code  # 更新完整代码以备下次比较
-                                if BOT_MODE_ENABLED and BOT_MODE_ENABLED_CODE_BLOCK_OUTPUT == False:
-                                    new_text = ""
+class StreamState:
+    """
+    记录流式翻译过程中各通道（text、code、code_result）已输出到的位置。
 
-                            else:
-                                # 只获取新的 parts
-                                parts = content.get("parts", [])
-                                full_text = ''.join(parts)
-                                if full_text == "![":
-                                    last_full_text = "!"
-                                new_text = full_text[len(last_full_text):]
-                                last_full_text = full_text
-                                if "\u3010" in new_text and not citation_accumulating:
-                                    citation_accumulating = True
-                                    citation_buffer = citation_buffer + new_text
-                                    # print(f"开始积累引用: {citation_buffer}")
-                                elif citation_accumulating:
-                                    citation_buffer += new_text
-                                    # print(f"积累引用: {citation_buffer}")
-                                if citation_accumulating:
-                                    if is_valid_citation_format(citation_buffer):
-                                        # print(f"合法格式: {citation_buffer}")
-                                        # 继续积累
-                                        if is_complete_citation_format(citation_buffer):
+    上游每个事件都携带截至当前的完整内容，take() 按消息 id 记录偏移量，
+    只截取新增的后缀，不再拼接和保存整段文本。若上游启用了 v1 增量编码，
+    apply_delta() 会把补丁应用到重建的事件上，追加的文本以 DeltaText 保存。
+    """
 
-                                            # 替换完整的引用格式
-                                            replaced_text, remaining_text, is_potential_citation = replace_complete_citation(
-                                                citation_buffer, citations)
-                                            # print(replaced_text)  # 输出替换后的文本
-                                            new_text = replaced_text
+    def __init__(self):
+        self.channels = {}
+        self.delta_encoding = None
+        self.document = {}
+        self.last_path = ''
+        self.last_op = 'replace'
+        self.pending_status = None
+
+    def take(self, channel, message_id, value):
+        tracked_id, offset, _ = self.channels.get(channel, (None, 0, None))
+        if tracked_id != message_id:
+            offset = 0
+        length, new_text = self.suffix(value, offset)
+        self.channels[channel] = (message_id, length, value)
+        return new_text
+
+    def reset(self, channel):
+        self.channels.pop(channel, None)
+
+    def contains(self, channel, needle):
+        value = self.channels.get(channel, (None, 0, None))[2]
+        if isinstance(value, list):
+            return any(needle in str(part) for part in value if isinstance(part, (str, DeltaText)))
+        return value is not None and needle in str(value)
+
+    @staticmethod
+    def suffix(value, offset):
+        if isinstance(value, str):
+            return len(value), value[offset:]
+        if isinstance(value, DeltaText):
+            return value.length, value.suffix(offset)
+        if not isinstance(value, list):
+            return 0, ''
+        total = 0
+        pieces = []
+        for part in value:
+            if isinstance(part, DeltaText):
+                if total + part.length > offset:
+                    pieces.append(part.suffix(max(offset - total, 0)))
+                total += part.length
+            elif isinstance(part, str):
+                if total + len(part) > offset:
+                    pieces.append(part[max(offset - total, 0):])
+                total += len(part)
+        return total, ''.join(pieces)
+
+    def apply_delta(self, operation):
+        # 消息状态的变更推迟到下一次补丁时生效，保证同一补丁中追加的文本不会因为
+        # 状态已变为 finished_successfully 而被跳过
+        if self.pending_status is not None:
+            message = self.document.get('message')
+            if isinstance(message, dict):
+                message['status'] = self.pending_status
+            self.pending_status = None
+        try:
+            self.apply_operation(operation)
+        except Exception as e:
+            logger.debug(f"增量补丁应用失败: {operation}, {e}")
+        return self.document
+
+    def apply_operation(self, operation):
+        if not isinstance(operation, dict):
+            return
+        path = operation.get('p', self.last_path)
+        op = operation.get('o', self.last_op)
+        value = operation.get('v')
+        self.last_path, self.last_op = path, op
+        if op == 'patch':
+            for sub_operation in value or []:
+                self.apply_operation(sub_operation)
+            return
+        if path == '':
+            if op in ('add', 'replace') and isinstance(value, dict):
+                self.document = value
+            return
+        keys = [key.replace('~1', '/').replace('~0', '~') for key in path.lstrip('/').split('/')]
+        if keys == ['message', 'status'] and op == 'replace':
+            self.pending_status = value
+            return
+        parent = self.document
+        for key in keys[:-1]:
+            parent = parent[int(key)] if isinstance(parent, list) else parent.setdefault(key, {})
+        key = keys[-1]
+        if isinstance(parent, list):
+            key = len(parent) if key == '-' else int(key)
+            current = parent[key] if key < len(parent) else None
+        else:
+            current = parent.get(key)
+
+        if op == 'append':
+            if isinstance(current, DeltaText):
+                current.append(value)
+            elif isinstance(current, str) and isinstance(value, str):
+                text = DeltaText(current)
+                text.append(value)
+                parent[key] = text
+            elif isinstance(current, list):
+                current.extend(value if isinstance(value, list) else [value])
+            elif isinstance(current, dict) and isinstance(value, dict):
+                current.update(value)
+            elif isinstance(parent, list) and key == len(parent):
+                parent.append(value)
+            else:
+                parent[key] = value
+        elif op in ('replace', 'add'):
+            if isinstance(parent, list) and (op == 'add' or key == len(parent)):
+                parent.insert(key, value)
+            else:
+                parent[key] = value
+        elif op == 'remove':
+            if current is not None:
+                del parent[key]
+        elif op == 'truncate':
+            if isinstance(current, DeltaText):
+                parent[key] = DeltaText(str(current)[:value])
+            elif current is not None:
+                parent[key] = current[:value]
+
+
+class ChunkEncoder:
+    """
+    chat.completion.chunk 帧编码器：id/object/created 等固定字段在每次补全中只渲染一次，
+    每个增量只需对 content 做一次 JSON 转义
+    """
 
-                                            if (is_potential_citation):
-                                                citation_buffer = remaining_text
-                                            else:
-                                                citation_accumulating = False
-                                                citation_buffer = ""
-                                            # print(f"替换完整的引用格式: {new_text}")
-                                        else:
-                                            continue
-                                    else:
-                                        # 不是合法格式，放弃积累并响应
-                                        # print(f"不合法格式: {citation_buffer}")
-                                        new_text = citation_buffer
-                                        citation_accumulating = False
-                                        citation_buffer = ""
+    def __init__(self, chat_message_id, model, created=None, usage_counter=None):
+        self.chat_message_id = chat_message_id
+        self.model = model
+        self.created = created or int(time.time())
+        self.prefixes = {}
+        # 需要返回 usage 时，输出的增量在编码时同步统计 token 数
+        self.usage_counter = usage_counter
+        self.keep_alive_frame = self.content('')
+
+    def prefix(self, model=None):
+        # 上游返回的 model_slug 可能与请求的模型不同，按模型缓存前缀
+        model = model or self.model
+        prefix = self.prefixes.get(model)
+        if prefix is None:
+            head = json.dumps({
+                "id": self.chat_message_id,
+                "object": "chat.completion.chunk",
+                "created": self.created,
+                "model": model
+            }, ensure_ascii=False)
+            prefix = 'data: ' + head[:-1] + ', "choices": [{"index": 0, "delta": '
+            self.prefixes[model] = prefix
+        return prefix
+
+    def role(self, model=None):
+        return self.prefix(model) + '{"role": "assistant"}, "finish_reason": null}]}\n\n'
+
+    def content(self, text, model=None):
+        if self.usage_counter:
+            self.usage_counter.add(text)
+        return self.prefix(model) + '{"content": ' + json.dumps(text, ensure_ascii=False) + '}, "finish_reason": null}]}\n\n'
+
+    def stop(self, model=None):
+        return self.prefix(model) + '{}, "finish_reason": "stop"}]}\n\n'
+
+    def usage(self, prompt_tokens, model=None):
+        # stream_options.include_usage 要求的最后一帧：choices 为空，只携带 usage
+        completion_tokens = self.usage_counter.total()
+        return 'data: ' + json.dumps({
+            "id": self.chat_message_id,
+            "object": "chat.completion.chunk",
+            "created": self.created,
+            "model": model or self.model,
+            "choices": [],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        }, ensure_ascii=False) + '\n\n'
 
-                                if "(" in new_text and not file_output_accumulating and not citation_accumulating:
-                                    file_output_accumulating = True
-                                    file_output_buffer = file_output_buffer + new_text
-                                    logger.debug(f"开始积累文件输出: {file_output_buffer}")
-                                elif file_output_accumulating:
-                                    file_output_buffer += new_text
-                                    logger.debug(f"积累文件输出: {file_output_buffer}")
-                                if file_output_accumulating:
-                                    if is_valid_sandbox_combined_corrected_final_v2(file_output_buffer):
-                                        logger.debug(f"合法文件输出格式: {file_output_buffer}")
-                                        # 继续积累
-                                        if is_complete_sandbox_format(file_output_buffer):
-                                            # 替换完整的引用格式
-                                            replaced_text = replace_sandbox(file_output_buffer, conversation_id,
-                                                                            message_id, api_key, proxy_api_prefix)
-                                            # print(replaced_text)  # 输出替换后的文本
-                                            new_text = replaced_text
-                                            file_output_accumulating = False
-                                            file_output_buffer = ""
-                                            logger.debug(f"替换完整的文件输出格式: {new_text}")
-                                        else:
-                                            continue
-                                    else:
-                                        # 不是合法格式，放弃积累并响应
-                                        logger.debug(f"不合法格式: {file_output_buffer}")
-                                        new_text = file_output_buffer
-                                        file_output_accumulating = False
-                                        file_output_buffer = ""
 
-                            # Python 工具执行输出特殊处理
-                            if role == "tool" and name == "python" and last_content_type != "execution_output" and content_type != None:
-                                full_code_result = ''.join(content.get("text", ""))
-                                new_text = "`Result:` \n```\n" + full_code_result[len(last_full_code_result):]
-                                if last_content_type == "code":
-                                    if BOT_MODE_ENABLED and BOT_MODE_ENABLED_CODE_BLOCK_OUTPUT == False:
-                                        new_text = ""
-                                    else:
-                                        new_text = "\n```\n" + new_text
-                                # print(f"full_code_result: {full_code_result}")
-                                # print(f"last_full_code_result: {last_full_code_result}")
-                                # print(f"new_text: {new_text}")
-                                last_full_code_result = full_code_result  # 更新完整代码以备下次比较
-                            elif last_content_type == "execution_output" and (
-                                    role != "tool" or name != "python") and content_type != None:
-                                # new_text = content.get("text", "") + "\n```"
-                                full_code_result = ''.join(content.get("text", ""))
-                                new_text = full_code_result[len(last_full_code_result):] + "\n```\n"
+class StreamTranslator:
+    """
+    把上游 SSE 响应逐块翻译为 chat.completion.chunk 帧，线程模式和 ASGI 模式共用
+    feed/finish 返回待发送的帧，以及 ('conversation_id', ...)、('all_new_text', ...) 元组
+    """
+
+    def __init__(self, api_key, chunk_encoder, model, proxy_api_prefix):
+        self.api_key = api_key
+        self.chunk_encoder = chunk_encoder
+        self.model = model
+        self.proxy_api_prefix = proxy_api_prefix
+        self.all_new_text = ""
+        self.first_output = True
+        self.sse_decoder = SSEDecoder()
+        self.stream_state = StreamState()
+        self.last_content_type = None  # 用于记录上一个消息的内容类型
+        self.conversation_id = ''
+        self.citation_buffer = ""
+        self.citation_accumulating = False
+        self.file_output_buffer = ""
+        self.file_output_accumulating = False
+        self.execution_output_image_url_buffer = ""
+        self.execution_output_image_id_buffer = ""
+        self.message = None
+
+    def feed(self, chunk):
+        output = []
+        # ping 事件和时间戳数据已在解析器中过滤
+        for event_name, event_data in self.sse_decoder.feed(chunk):
+            self.handle_event(event_name, event_data, output)
+        return output
+
+    def handle_event(self, event_name, event_data, output):
+        try:
+            data_content = event_data.strip()
+            if not data_content:
+                return
+            data_json = json.loads(data_content)
+            if event_name == 'delta_encoding':
+                self.stream_state.delta_encoding = data_json
+                return
+            if event_name == 'delta':
+                # v1 增量编码：把补丁应用到重建的事件上，再按完整事件处理
+                data_json = self.stream_state.apply_delta(data_json)
+            # print(f"data_json: {data_json}")
+            message = self.message = data_json.get("message", {})
+
+            if message == {} or message == None:
+                logger.debug(f"message 为空: data_json: {data_json}")
+
+            message_id = message.get("id")
+            message_status = message.get("status")
+            content = message.get("content", {})
+            role = message.get("author", {}).get("role")
+            content_type = content.get("content_type")
+
+            metadata = {}
+            citations = []
+            try:
+                metadata = message.get("metadata", {})
+                citations = metadata.get("citations", [])
+            except:
+                pass
+            name = message.get("author", {}).get("name")
+            if (
+                    role == "user" or message_status == "finished_successfully" or role == "system") and role != "tool":
+                # 如果是用户发来的消息，直接舍弃
+                return
+            try:
+                self.conversation_id = data_json.get("conversation_id")
+                # print(f"conversation_id: {conversation_id}")
+                if self.conversation_id:
+                    output.append(('conversation_id', self.conversation_id))
+            except:
+                pass
+                # 只获取新的部分
+            new_text = ""
+            is_img_message = False
+            parts = content.get("parts", [])
+            for part in parts:
+                try:
+                    # print(f"part: {part}")
+                    # print(f"part type: {part.get('content_type')}")
+                    if part.get('content_type') == 'image_asset_pointer':
+                        logger.debug(f"find img message~")
+                        is_img_message = True
+                        asset_pointer = part.get('asset_pointer').replace('file-service://', '')
+                        logger.debug(f"asset_pointer: {asset_pointer}")
+                        if USE_OAIUSERCONTENT_URL == True:
+                            image_link = get_download_url(asset_pointer, self.api_key, self.proxy_api_prefix)
+                        else:
+                            # 图片在后台下载保存，先返回固定的图片地址
+                            today_image_url = image_persister.persist(asset_pointer, self.api_key,
+                                                                      self.proxy_api_prefix)
+                            image_link = f"{UPLOAD_BASE_URL}/{today_image_url}"
+                        if image_link:
+                            if ((BOT_MODE_ENABLED == False) or (
+                                    BOT_MODE_ENABLED == True and BOT_MODE_ENABLED_MARKDOWN_IMAGE_OUTPUT == True)):
+                                new_text = f"\n![image]({image_link})\n[下载链接]({image_link})\n"
+                            if BOT_MODE_ENABLED == True and BOT_MODE_ENABLED_PLAIN_IMAGE_URL_OUTPUT == True:
+                                if self.all_new_text != "":
+                                    new_text = f"\n图片链接：{image_link}\n"
+                                else:
+                                    new_text = f"图片链接：{image_link}\n"
+                            if self.last_content_type == "code":
                                 if BOT_MODE_ENABLED and BOT_MODE_ENABLED_CODE_BLOCK_OUTPUT == False:
-                                    new_text = ""
-                                tmp_new_text = new_text
-                                if execution_output_image_url_buffer != "":
-                                    if ((BOT_MODE_ENABLED == False) or (
-                                            BOT_MODE_ENABLED == True and BOT_MODE_ENABLED_MARKDOWN_IMAGE_OUTPUT == True)):
-                                        logger.debug(f"BOT_MODE_ENABLED: {BOT_MODE_ENABLED}")
-                                        logger.debug(
-                                            f"BOT_MODE_ENABLED_MARKDOWN_IMAGE_OUTPUT: {BOT_MODE_ENABLED_MARKDOWN_IMAGE_OUTPUT}")
-                                        new_text = tmp_new_text + f"![image]({execution_output_image_url_buffer})\n[下载链接]({execution_output_image_url_buffer})\n"
-                                    if BOT_MODE_ENABLED == True and BOT_MODE_ENABLED_PLAIN_IMAGE_URL_OUTPUT == True:
-                                        logger.debug(f"BOT_MODE_ENABLED: {BOT_MODE_ENABLED}")
-                                        logger.debug(
-                                            f"BOT_MODE_ENABLED_PLAIN_IMAGE_URL_OUTPUT: {BOT_MODE_ENABLED_PLAIN_IMAGE_URL_OUTPUT}")
-                                        new_text = tmp_new_text + f"图片链接：{execution_output_image_url_buffer}\n"
-                                    execution_output_image_url_buffer = ""
+                                    new_text = new_text
+                                else:
+                                    new_text = "\n```\n" + new_text
+
+                            logger.debug(f"new_text: {new_text}")
+                            is_img_message = True
+                except:
+                    pass
+
+            if is_img_message == False:
+                # print(f"data_json: {data_json}")
+                if content_type == "multimodal_text" and self.last_content_type == "code":
+                    new_text = "\n```\n" + str(content.get("text", ""))
+                    if BOT_MODE_ENABLED and BOT_MODE_ENABLED_CODE_BLOCK_OUTPUT == False:
+                        new_text = str(content.get("text", ""))
+                elif role == "tool" and name == "dalle.text2im":
+                    logger.debug(f"无视消息: {content.get('text', '')}")
+                    return
+                # 代码块特殊处理
+                if content_type == "code" and self.last_content_type != "code" and content_type != None:
+                    new_text = "\n```\n" + self.stream_state.take('code', message_id, content.get("text", ""))
+                    # print(f"new_text: {new_text}")
+                    if BOT_MODE_ENABLED and BOT_MODE_ENABLED_CODE_BLOCK_OUTPUT == False:
+                        new_text = ""
+
+                elif self.last_content_type == "code" and content_type != "code" and content_type != None:
+                    new_text = "\n```\n" + self.stream_state.take('code', message_id, content.get("text", ""))
+                    # print(f"new_text: {new_text}")
+                    self.stream_state.reset('code')
+                    if BOT_MODE_ENABLED and BOT_MODE_ENABLED_CODE_BLOCK_OUTPUT == False:
+                        new_text = ""
+
+                elif content_type == "code" and self.last_content_type == "code" and content_type != None:
+                    new_text = self.stream_state.take('code', message_id, content.get("text", ""))
+                    # print(f"new_text: {new_text}")
+                    if BOT_MODE_ENABLED and BOT_MODE_ENABLED_CODE_BLOCK_OUTPUT == False:
+                        new_text = ""
+
+                else:
+                    # 只获取新的 parts
+                    new_text = self.stream_state.take('text', message_id, content.get("parts", []))
+                    if "\u3010" in new_text and not self.citation_accumulating:
+                        self.citation_accumulating = True
+                        self.citation_buffer = self.citation_buffer + new_text
+                        # print(f"开始积累引用: {citation_buffer}")
+                    elif self.citation_accumulating:
+                        self.citation_buffer += new_text
+                        # print(f"积累引用: {citation_buffer}")
+                    if self.citation_accumulating:
+                        if is_valid_citation_format(self.citation_buffer):
+                            # print(f"合法格式: {citation_buffer}")
+                            # 继续积累
+                            if is_complete_citation_format(self.citation_buffer):
+
+                                # 替换完整的引用格式
+                                replaced_text, remaining_text, is_potential_citation = replace_complete_citation(
+                                    self.citation_buffer, citations)
+                                # print(replaced_text)  # 输出替换后的文本
+                                new_text = replaced_text
+
+                                if (is_potential_citation):
+                                    self.citation_buffer = remaining_text
+                                else:
+                                    self.citation_accumulating = False
+                                    self.citation_buffer = ""
+                                # print(f"替换完整的引用格式: {new_text}")
+                            else:
+                                return
+                        else:
+                            # 不是合法格式，放弃积累并响应
+                            # print(f"不合法格式: {citation_buffer}")
+                            new_text = self.citation_buffer
+                            self.citation_accumulating = False
+                            self.citation_buffer = ""
+
+                    if "(" in new_text and not self.file_output_accumulating and not self.citation_accumulating:
+                        self.file_output_accumulating = True
+                        self.file_output_buffer = self.file_output_buffer + new_text
+                        logger.debug(f"开始积累文件输出: {self.file_output_buffer}")
+                    elif self.file_output_accumulating:
+                        self.file_output_buffer += new_text
+                        logger.debug(f"积累文件输出: {self.file_output_buffer}")
+                    if self.file_output_accumulating:
+                        if is_valid_sandbox_combined_corrected_final_v2(self.file_output_buffer):
+                            logger.debug(f"合法文件输出格式: {self.file_output_buffer}")
+                            # 继续积累
+                            if is_complete_sandbox_format(self.file_output_buffer):
+                                # 替换完整的引用格式
+                                replaced_text = replace_sandbox(self.file_output_buffer, self.conversation_id,
+                                                                message_id, self.api_key, self.proxy_api_prefix)
+                                # print(replaced_text)  # 输出替换后的文本
+                                new_text = replaced_text
+                                self.file_output_accumulating = False
+                                self.file_output_buffer = ""
+                                logger.debug(f"替换完整的文件输出格式: {new_text}")
+                            else:
+                                return
+                        else:
+                            # 不是合法格式，放弃积累并响应
+                            logger.debug(f"不合法格式: {self.file_output_buffer}")
+                            new_text = self.file_output_buffer
+                            self.file_output_accumulating = False
+                            self.file_output_buffer = ""
+
+                # Python 工具执行输出特殊处理
+                if role == "tool" and name == "python" and self.last_content_type != "execution_output" and content_type != None:
+                    new_text = "`Result:` \n```\n" + self.stream_state.take('code_result', message_id, content.get("text", ""))
+                    if self.last_content_type == "code":
+                        if BOT_MODE_ENABLED and BOT_MODE_ENABLED_CODE_BLOCK_OUTPUT == False:
+                            new_text = ""
+                        else:
+                            new_text = "\n```\n" + new_text
+                    # print(f"new_text: {new_text}")
+                elif self.last_content_type == "execution_output" and (
+                        role != "tool" or name != "python") and content_type != None:
+                    # new_text = content.get("text", "") + "\n```"
+                    new_text = self.stream_state.take('code_result', message_id, content.get("text", "")) + "\n```\n"
+                    if BOT_MODE_ENABLED and BOT_MODE_ENABLED_CODE_BLOCK_OUTPUT == False:
+                        new_text = ""
+                    tmp_new_text = new_text
+                    if self.execution_output_image_url_buffer != "":
+                        if ((BOT_MODE_ENABLED == False) or (
+                                BOT_MODE_ENABLED == True and BOT_MODE_ENABLED_MARKDOWN_IMAGE_OUTPUT == True)):
+                            logger.debug(f"BOT_MODE_ENABLED: {BOT_MODE_ENABLED}")
+                            logger.debug(
+                                f"BOT_MODE_ENABLED_MARKDOWN_IMAGE_OUTPUT: {BOT_MODE_ENABLED_MARKDOWN_IMAGE_OUTPUT}")
+                            new_text = tmp_new_text + f"![image]({self.execution_output_image_url_buffer})\n[下载链接]({self.execution_output_image_url_buffer})\n"
+                        if BOT_MODE_ENABLED == True and BOT_MODE_ENABLED_PLAIN_IMAGE_URL_OUTPUT == True:
+                            logger.debug(f"BOT_MODE_ENABLED: {BOT_MODE_ENABLED}")
+                            logger.debug(
+                                f"BOT_MODE_ENABLED_PLAIN_IMAGE_URL_OUTPUT: {BOT_MODE_ENABLED_PLAIN_IMAGE_URL_OUTPUT}")
+                            new_text = tmp_new_text + f"图片链接：{self.execution_output_image_url_buffer}\n"
+                        self.execution_output_image_url_buffer = ""
+
+                    if content_type == "code":
+                        new_text = new_text + "\n```\n"
+                    # print(f"new_text: {new_text}")
+                    self.stream_state.reset('code_result')
+                elif self.last_content_type == "execution_output" and role == "tool" and name == "python" and content_type != None:
+                    new_text = self.stream_state.take('code_result', message_id, content.get("text", ""))
+                    if BOT_MODE_ENABLED and BOT_MODE_ENABLED_CODE_BLOCK_OUTPUT == False:
+                        new_text = ""
+                    # print(f"new_text: {new_text}")
+
+                # 其余Action执行输出特殊处理
+                # if role == "tool" and name != "python" and name != "dalle.text2im" and last_content_type != "execution_output" and content_type != None:
+                #     new_text = ""
+                #     if last_content_type == "code":
+                #         if BOT_MODE_ENABLED and BOT_MODE_ENABLED_CODE_BLOCK_OUTPUT == False:
+                #             new_text = ""
+                #         else:
+                #             new_text = "\n```\n" + new_text
+
+            # 检查 new_text 中是否包含 <<ImageDisplayed>>
+            if self.stream_state.contains('code_result', "<<ImageDisplayed>>"):
+                # 进行提取操作
+                aggregate_result = message.get("metadata", {}).get("aggregate_result", {})
+                if aggregate_result:
+                    messages = aggregate_result.get("messages", [])
+                    for msg in messages:
+                        if msg.get("message_type") == "image":
+                            image_url = msg.get("image_url")
+                            if image_url:
+                                # 从 image_url 提取所需的字段
+                                image_file_id = image_url.split('://')[-1]
+                                logger.info(f"提取到的图片文件ID: {image_file_id}")
+                                if image_file_id != self.execution_output_image_id_buffer:
+                                    if USE_OAIUSERCONTENT_URL == True:
+                                        download_url = get_download_url(image_file_id, self.api_key,
+                                                                        self.proxy_api_prefix)
+                                        if download_url:
+                                            self.execution_output_image_url_buffer = download_url
+                                    else:
+                                        today_image_url = image_persister.persist(image_file_id, self.api_key,
+                                                                                  self.proxy_api_prefix)
+                                        self.execution_output_image_url_buffer = f"{UPLOAD_BASE_URL}/{today_image_url}"
 
-                                if content_type == "code":
-                                    new_text = new_text + "\n```\n"
-                                # print(f"full_code_result: {full_code_result}")
-                                # print(f"last_full_code_result: {last_full_code_result}")
-                                # print(f"new_text: {new_text}")
-                                last_full_code_result = ""  # 更新完整代码以备下次比较
-                            elif last_content_type == "execution_output" and role == "tool" and name == "python" and content_type != None:
-                                full_code_result = ''.join(content.get("text", ""))
-                                if BOT_MODE_ENABLED and BOT_MODE_ENABLED_CODE_BLOCK_OUTPUT == False:
-                                    new_text = ""
-                                else:
-                                    new_text = full_code_result[len(last_full_code_result):]
-                                # print(f"full_code_result: {full_code_result}")
-                                # print(f"last_full_code_result: {last_full_code_result}")
-                                # print(f"new_text: {new_text}")
-                                last_full_code_result = full_code_result
-
-                            # 其余Action执行输出特殊处理
-                            # if role == "tool" and name != "python" and name != "dalle.text2im" and last_content_type != "execution_output" and content_type != None:
-                            #     new_text = ""
-                            #     if last_content_type == "code":
-                            #         if BOT_MODE_ENABLED and BOT_MODE_ENABLED_CODE_BLOCK_OUTPUT == False:
-                            #             new_text = ""
-                            #         else:
-                            #             new_text = "\n```\n" + new_text
-
-                        # 检查 new_text 中是否包含 <<ImageDisplayed>>
-                        if "<<ImageDisplayed>>" in last_full_code_result:
-                            # 进行提取操作
-                            aggregate_result = message.get("metadata", {}).get("aggregate_result", {})
-                            if aggregate_result:
-                                messages = aggregate_result.get("messages", [])
-                                for msg in messages:
-                                    if msg.get("message_type") == "image":
-                                        image_url = msg.get("image_url")
-                                        if image_url:
-                                            # 从 image_url 提取所需的字段
-                                            image_file_id = image_url.split('://')[-1]
-                                            logger.info(f"提取到的图片文件ID: {image_file_id}")
-                                            if image_file_id != execution_output_image_id_buffer:
-                                                image_url = f"{BASE_URL}{proxy_api_prefix}/backend-api/files/{image_file_id}/download"
-
-                                                headers = {
-                                                    "Authorization": f"Bearer {api_key}"
-                                                }
-                                                image_response = requests.get(image_url, headers=headers)
-
-                                                if image_response.status_code == 200:
-                                                    download_url = image_response.json().get('download_url')
-                                                    logger.debug(f"download_url: {download_url}")
-                                                    if USE_OAIUSERCONTENT_URL == True:
-                                                        execution_output_image_url_buffer = download_url
-
-                                                    else:
-                                                        # 从URL下载图片
-                                                        # image_data = requests.get(download_url).content
-                                                        image_download_response = requests.get(download_url)
-                                                        # print(f"image_download_response: {image_download_response.text}")
-                                                        if image_download_response.status_code == 200:
-                                                            logger.debug(f"下载图片成功")
-                                                            image_data = image_download_response.content
-                                                            today_image_url = save_image(image_data)  # 保存图片，并获取文件名
-                                                            execution_output_image_url_buffer = f"{UPLOAD_BASE_URL}/{today_image_url}"
-
-                                                        else:
-                                                            logger.error(
-                                                                f"下载图片失败: {image_download_response.text}")
-
-                                            execution_output_image_id_buffer = image_file_id
-
-                        # 从 new_text 中移除 <<ImageDisplayed>>
-                        new_text = new_text.replace(
-                            "All the files uploaded by the user have been fully loaded. Searching won't provide "
-                            "additional information.",
-                            UPLOAD_SUCCESS_TEXT)
-                        new_text = new_text.replace("<<ImageDisplayed>>", "图片生成中，请稍后\n")
+                                self.execution_output_image_id_buffer = image_file_id
 
-                        # print(f"收到数据: {data_json}")
-                        # print(f"收到的完整文本: {full_text}")
-                        # print(f"上次收到的完整文本: {last_full_text}")
-                        # print(f"新的文本: {new_text}")
+            # 从 new_text 中移除 <<ImageDisplayed>>
+            new_text = new_text.replace(
+                "All the files uploaded by the user have been fully loaded. Searching won't provide "
+                "additional information.",
+                UPLOAD_SUCCESS_TEXT)
+            new_text = new_text.replace("<<ImageDisplayed>>", "图片生成中，请稍后\n")
 
-                        # 更新 last_content_type
-                        if content_type != None:
-                            last_content_type = content_type if role != "user" else last_content_type
+            # print(f"收到数据: {data_json}")
+            # print(f"新的文本: {new_text}")
 
-                        model_slug = message.get("metadata", {}).get("model_slug") or model
-
-                        if first_output:
-                            new_data = {
-                                "id": chat_message_id,
-                                "object": "chat.completion.chunk",
-                                "created": timestamp,
-                                "model": model_slug,
-                                "choices": [
-                                    {
-                                        "index": 0,
-                                        "delta": {"role": "assistant"},
-                                        "finish_reason": None
-                                    }
-                                ]
-                            }
-                            q_data = 'data: ' + json.dumps(new_data, ensure_ascii=False) + '\n\n'
-                            data_queue.put(q_data)
-                            first_output = False
-
-                        new_data = {
-                            "id": chat_message_id,
-                            "object": "chat.completion.chunk",
-                            "created": timestamp,
-                            "model": model_slug,
-                            "choices": [
-                                {
-                                    "index": 0,
-                                    "delta": {
-                                        "content": ''.join(new_text)
-                                    },
-                                    "finish_reason": None
-                                }
-                            ]
-                        }
-                        # print(f"Role: {role}")
-                        logger.info(f"发送消息: {new_text}")
-                        tmp = 'data: ' + json.dumps(new_data, ensure_ascii=False) + '\n\n'
-                        # print(f"发送数据: {tmp}")
-                        # 累积 new_text
-                        all_new_text += new_text
-                        q_data = 'data: ' + json.dumps(new_data, ensure_ascii=False) + '\n\n'
-                        data_queue.put(q_data)
-                        last_data_time[0] = time.time()
-                        if stop_event.is_set():
-                            break
-                    except json.JSONDecodeError:
-                        # print("JSON 解析错误")
-                        logger.info(f"发送数据: {complete_data}")
-                        if complete_data == 'data: [DONE]\n\n':
-                            logger.info(f"会话结束")
-                            q_data = complete_data
-                            data_queue.put(('all_new_text', all_new_text))
-                            data_queue.put(q_data)
-                            last_data_time[0] = time.time()
-                            if stop_event.is_set():
-                                break
-        if citation_buffer != "":
-            new_data = {
-                "id": chat_message_id,
-                "object": "chat.completion.chunk",
-                "created": timestamp,
-                "model": message.get("metadata", {}).get("model_slug"),
-                "choices": [
-                    {
-                        "index": 0,
-                        "delta": {
-                            "content": ''.join(citation_buffer)
-                        },
-                        "finish_reason": None
-                    }
-                ]
-            }
-            tmp = 'data: ' + json.dumps(new_data) + '\n\n'
-            # print(f"发送数据: {tmp}")
+            # 更新 last_content_type
+            if content_type != None:
+                self.last_content_type = content_type if role != "user" else self.last_content_type
+
+            model_slug = message.get("metadata", {}).get("model_slug") or self.model
+
+            if self.first_output:
+                output.append(self.chunk_encoder.role(model_slug))
+                self.first_output = False
+
+            # print(f"Role: {role}")
+            logger.debug(f"发送消息: {new_text}")
             # 累积 new_text
-            all_new_text += citation_buffer
-            q_data = 'data: ' + json.dumps(new_data) + '\n\n'
-            data_queue.put(q_data)
-            last_data_time[0] = time.time()
+            self.all_new_text += new_text
+            output.append(self.chunk_encoder.content(new_text, model_slug))
+        except json.JSONDecodeError:
+            # print("JSON 解析错误")
+            logger.info(f"发送数据: {data_content}")
+            if data_content == '[DONE]':
+                logger.info(f"会话结束")
+                q_data = 'data: [DONE]\n\n'
+                output.append(('all_new_text', self.all_new_text))
+                output.append(q_data)
+
+    def finish(self):
+        output = []
+        if self.citation_buffer != "":
+            # 累积 new_text
+            self.all_new_text += self.citation_buffer
+            output.append(self.chunk_encoder.content(self.citation_buffer, self.message.get("metadata", {}).get("model_slug")))
+        buffer = self.sse_decoder.flush()
         if buffer:
             try:
                 buffer_json = json.loads(buffer)
                 logger.info(f"最后的缓存数据: {buffer_json}")
                 error_message = buffer_json.get("detail", {}).get("message", "未知错误")
-                error_data = {
-                    "id": chat_message_id,
-                    "object": "chat.completion.chunk",
-                    "created": timestamp,
-                    "model": "error",
-                    "choices": [
-                        {
-                            "index": 0,
-                            "delta": {
-                                "content": ''.join("```\n" + error_message + "\n```")
-                            },
-                            "finish_reason": None
-                        }
-                    ]
-                }
-                tmp = 'data: ' + json.dumps(error_data) + '\n\n'
-                logger.info(f"发送最后的数据: {tmp}")
+                q_data = self.chunk_encoder.content("```\n" + error_message + "\n```", "error")
+                logger.info(f"发送最后的数据: {q_data}")
                 # 累积 new_text
-                all_new_text += ''.join("```\n" + error_message + "\n```")
-                q_data = 'data: ' + json.dumps(error_data) + '\n\n'
-                data_queue.put(q_data)
-                last_data_time[0] = time.time()
+                self.all_new_text += "```\n" + error_message + "\n```"
+                output.append(q_data)
                 complete_data = 'data: [DONE]\n\n'
                 logger.info(f"会话结束")
                 q_data = complete_data
-                data_queue.put(('all_new_text', all_new_text))
-                data_queue.put(q_data)
-                last_data_time[0] = time.time()
+                output.append(('all_new_text', self.all_new_text))
+                output.append(q_data)
             except:
                 # print("JSON 解析错误")
                 logger.info(f"发送最后的数据: {buffer}")
-                error_data = {
-                    "id": chat_message_id,
-                    "object": "chat.completion.chunk",
-                    "created": timestamp,
-                    "model": "error",
-                    "choices": [
-                        {
-                            "index": 0,
-                            "delta": {
-                                "content": ''.join("```\n" + buffer + "\n```")
-                            },
-                            "finish_reason": None
-                        }
-                    ]
-                }
-                tmp = 'data: ' + json.dumps(error_data) + '\n\n'
-                q_data = tmp
-                data_queue.put(q_data)
-                last_data_time[0] = time.time()
+                output.append(self.chunk_encoder.content("```\n" + buffer + "\n```", "error"))
                 complete_data = 'data: [DONE]\n\n'
                 logger.info(f"会话结束")
                 q_data = complete_data
-                data_queue.put(('all_new_text', all_new_text))
-                data_queue.put(q_data)
-                last_data_time[0] = time.time()
+                output.append(('all_new_text', self.all_new_text))
+                output.append(q_data)
+        return output
+
+    def abort(self):
+        logger.info(f"会话结束")
+        return [('all_new_text', self.all_new_text), 'data: [DONE]\n\n']
+
+
+def data_fetcher(upstream_response, data_queue, stop_event, last_data_time, api_key, chunk_encoder, model,
+                 proxy_api_prefix):
+    translator = StreamTranslator(api_key, chunk_encoder, model, proxy_api_prefix)
+    try:
+        for chunk in upstream_response.iter_content(chunk_size=1024):
+            if stop_event.is_set():
+                logger.info(f"接受到停止信号，停止数据处理线程")
+                break
+            if chunk:
+                for item in translator.feed(chunk):
+                    data_queue.put(item)
+                    last_data_time[0] = time.time()
+        for item in translator.finish():
+            data_queue.put(item)
+            last_data_time[0] = time.time()
     except Exception as e:
         logger.error(f"Exception: {e}")
-        complete_data = 'data: [DONE]\n\n'
-        logger.info(f"会话结束")
-        q_data = complete_data
-        data_queue.put(('all_new_text', all_new_text))
-        data_queue.put(q_data)
+        for item in translator.abort():
+            data_queue.put(item)
         last_data_time[0] = time.time()
+    finally:
+        # 提前结束时关闭响应，避免占用连接池中的连接
+        upstream_response.close()
 
 
-def keep_alive(last_data_time, stop_event, queue, model, chat_message_id):
-    while not stop_event.is_set():
-        if time.time() - last_data_time[0] >= 1:
-            # logger.debug(f"发送保活消息")
-            # 当前时间戳
-            timestamp = int(time.time())
-            new_data = {
-                "id": chat_message_id,
-                "object": "chat.completion.chunk",
-                "created": timestamp,
-                "model": model,
-                "choices": [
-                    {
-                        "index": 0,
-                        "delta": {
-                            "content": ''
-                        },
-                        "finish_reason": None
-                    }
-                ]
-            }
-            queue.put(f'data: {json.dumps(new_data)}\n\n')  # 发送保活消息
-            last_data_time[0] = time.time()
-        time.sleep(1)
+class HeartbeatScheduler:
+    """
+    进程内共享的保活调度器：一个线程跟踪所有活跃的流，只向空闲超过 interval 秒的流发送空增量
+    """
 
-    if stop_event.is_set():
-        logger.debug(f"接受到停止信号，停止保活线程")
-        return
+    def __init__(self, interval):
+        self.interval = interval
+        self.streams = {}
+        self.next_stream_id = 0
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def register(self, data_queue, chunk_encoder, last_data_time):
+        with self.condition:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='heartbeat', daemon=True)
+                self.thread.start()
+            self.next_stream_id += 1
+            self.streams[self.next_stream_id] = (data_queue, chunk_encoder.keep_alive_frame, last_data_time)
+            self.condition.notify()
+            return self.next_stream_id
+
+    def unregister(self, stream_id):
+        with self.condition:
+            self.streams.pop(stream_id, None)
+
+    def run(self):
+        with self.condition:
+            while True:
+                if not self.streams:
+                    self.condition.wait()
+                    continue
+                now = time.time()
+                next_deadline = now + self.interval
+                for data_queue, keep_alive_frame, last_data_time in self.streams.values():
+                    deadline = last_data_time[0] + self.interval
+                    if deadline <= now:
+                        data_queue.put(keep_alive_frame)  # 发送保活消息
+                        last_data_time[0] = now
+                        deadline = now + self.interval
+                    next_deadline = min(next_deadline, deadline)
+                # 睡到最早一个流到期，期间有新流注册时会被唤醒
+                self.condition.wait(max(next_deadline - now, 0.01))
+
+    def snapshot(self):
+        with self.condition:
+            return {
+                "interval": self.interval,
+                "streams": len(self.streams)
+            }
 
 
-import tiktoken
+heartbeat_scheduler = HeartbeatScheduler(SERVER_HEARTBEAT_INTERVAL)
 
 
 def count_tokens(text, model_name):
@@ -1824,18 +3602,48 @@ def count_tokens(text, model_name):
     :param model_name: The name of the model to use for tokenization.
     :return: Number of tokens in the text for the specified model.
     """
-    # 获取指定模型的编码器
-    if model_name == 'gpt-3.5-turbo':
-        model_name = 'gpt-3.5-turbo'
-    else:
-        model_name = 'gpt-4'
-    encoder = tiktoken.encoding_for_model(model_name)
-
     # 编码文本并计算token数量
-    token_list = encoder.encode(text)
+    token_list = get_token_encoder(model_name).encode(text)
     return len(token_list)
 
 
+def get_token_encoder(model_name):
+    # 获取指定模型的编码器，首次使用时才导入 tiktoken，编码由 tiktoken 缓存，只加载一次
+    import tiktoken
+    if model_name != 'gpt-3.5-turbo':
+        model_name = 'gpt-4'
+    return tiktoken.encoding_for_model(model_name)
+
+
+class PromptTokenCache:
+    """
+    消息文本的 sha1 -> token 数的 LRU 缓存：客户端每轮对话都会重发完整的历史消息，已统计过的消息不再重新编码
+    """
+
+    def __init__(self, size=4096):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def count(self, text, model_name):
+        encoder = get_token_encoder(model_name)
+        key = (encoder.name, hashlib.sha1(text.encode('utf-8')).digest())
+        with self.lock:
+            tokens = self.entries.get(key)
+            if tokens is not None:
+                self.entries.move_to_end(key)
+                return tokens
+        tokens = len(encoder.encode(text))
+        with self.lock:
+            self.entries[key] = tokens
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return tokens
+
+
+prompt_token_cache = PromptTokenCache(TOKEN_USAGE_PROMPT_CACHE_SIZE)
+
+
 def count_total_input_words(messages, model):
     """
     Count the total number of words in all messages' content.
@@ -1847,52 +3655,89 @@ def count_total_input_words(messages, model):
             for item in content:
                 if item.get("type") == "text":  # 仅处理类型为"text"的项
                     text_content = item.get("text", "")
-                    total_words += count_tokens(text_content, model)
+                    total_words += prompt_token_cache.count(text_content, model)
         elif isinstance(content, str):  # 处理字符串类型的content
-            total_words += count_tokens(content, model)
+            total_words += prompt_token_cache.count(content, model)
         # 不处理其他类型的content
 
     return total_words
 
 
-# 添加缓存
-def add_to_dict(key, value):
-    global refresh_dict
-    refresh_dict[key] = value
-    logger.info("添加access_token缓存成功.............")
+class CompletionTokenCounter:
+    """
+    增量统计输出的 token 数：已收到的文本在最后一个空白处切分后编码，
+    tiktoken 的 token 通常以空格开头，分段结果与整体编码基本一致。
+    中文等没有空白的文本累积到 MAX_PENDING 个字符后直接编码，待编码的文本长度有上限
+    """
 
+    MAX_PENDING = 256
 
-import threading
-import time
+    def __init__(self, model_name):
+        self.encoder = get_token_encoder(model_name)
+        self.tokens = 0
+        self.pending = ''
 
+    def add(self, text):
+        if not text:
+            return
+        # 待编码文本中除开头外没有空白，只需在新增的文本中查找
+        cut = max(text.rfind(' '), text.rfind('\n'))
+        if cut >= 0:
+            cut += len(self.pending)
+        pending = self.pending + text
+        if cut <= 0 and len(pending) >= self.MAX_PENDING:
+            cut = len(pending)
+        if cut > 0:
+            self.tokens += len(self.encoder.encode(pending[:cut]))
+            pending = pending[cut:]
+        self.pending = pending
 
-# 定义 Flask 路由
-@app.route(f'/{API_PREFIX}/v1/chat/completions' if API_PREFIX else '/v1/chat/completions', methods=['POST'])
-def chat_completions():
-    logger.info(f"New Request")
-    proxy_api_prefix = getPROXY_API_PREFIX(lock)
+    def total(self):
+        if self.pending:
+            self.tokens += len(self.encoder.encode(self.pending))
+            self.pending = ''
+        return self.tokens
 
-    if proxy_api_prefix == None:
-        return jsonify({"error": "PROXY_API_PREFIX is not accessible"}), 401
-    data = request.json
+
+# 统计输入 token 的线程池：在等待上游响应的同时完成统计（tiktoken 编码时会释放 GIL）
+usage_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='usage')
+
+
+def wants_stream_usage(data):
+    stream_options = data.get('stream_options') or {}
+    return bool(data.get('stream')) and bool(stream_options.get('include_usage'))
+
+
+class ChatRequestError(Exception):
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+def parse_chat_request(data, auth_header):
+    """
+    校验 /v1/chat/completions 请求并换取 access token，Flask 路由和 ASGI 模式共用
+    :return: (messages, model, stream, api_key, account_id)
+    """
+    if not upstream_selector.has_upstreams():
+        raise ChatRequestError("PROXY_API_PREFIX is not accessible", 401)
     messages = data.get('messages')
     model = data.get('model', "gpt-3.5-turbo")
     ori_model_name = model
-    accessible_model_list = get_accessible_model_list()
-    if model not in accessible_model_list and not 'gpt-4-gizmo-' in model:
-        return jsonify({"error": "model is not accessible"}), 401
     model_config = find_model_config(model)
+    if not model_config and not 'gpt-4-gizmo-' in model:
+        raise ChatRequestError("model is not accessible", 401)
     if model_config:
-        ori_model_name = model_config.get('ori_name', model)
+        ori_model_name = model_config['ori_name']
     if "o1-" in ori_model_name:
         # 使用列表推导式过滤系统角色
         messages = [message for message in messages if message["role"] in ["user", "assistant"]]
 
     stream = data.get('stream', False)
 
-    auth_header = request.headers.get('Authorization')
     if not auth_header or not auth_header.startswith('Bearer '):
-        return jsonify({"error": "Authorization header is missing or invalid"}), 401
+        raise ChatRequestError("Authorization header is missing or invalid", 401)
     api_key = None
     try:
         api_key = auth_header.split(' ')[1].split(',')[0].strip()
@@ -1900,25 +3745,50 @@ def chat_completions():
         logging.info(f"{api_key}:{account_id}")
     except IndexError:
         account_id = None
-    if not api_key.startswith("eyJhb"):
-        refresh_token = api_key
-        if api_key in refresh_dict:
-            logger.info(f"从缓存读取到api_key.........。")
-            api_key = refresh_dict.get(api_key)
-        else:
-            if REFRESH_TOACCESS_ENABLEOAI:
-                api_key = oaiGetAccessToken(api_key)
-            else:
-                api_key = oaiFreeGetAccessToken(REFRESH_TOACCESS_OAIFREE_REFRESHTOACCESS_URL, api_key)
-            if not api_key.startswith("eyJhb"):
-                return jsonify({"error": "refresh_token is wrong or refresh_token url is wrong!"}), 401
-            add_to_dict(refresh_token, api_key)
+    api_key = get_access_token(api_key)
+    if not api_key:
+        raise ChatRequestError("refresh_token is wrong or refresh_token url is wrong!", 401)
     logger.info(f"api_key: {api_key}")
+    return messages, model, stream, api_key, account_id
+
+
+# 定义 Flask 路由
+@app.route(f'/{API_PREFIX}/v1/chat/completions' if API_PREFIX else '/v1/chat/completions', methods=['POST'])
+def chat_completions():
+    logger.info(f"New Request")
 
-    upstream_response = send_text_prompt_and_get_response(messages, api_key, account_id, stream, model,
-                                                          proxy_api_prefix)
+    try:
+        messages, model, stream, api_key, account_id = parse_chat_request(request.json,
+                                                                          request.headers.get('Authorization'))
+    except ChatRequestError as e:
+        return jsonify({"error": e.message}), e.status_code
+
+    # 非流式响应和 stream_options.include_usage 时统计 usage，输入 token 在后台统计
+    ori_model_name = get_ori_model_name(model)
+    include_usage = wants_stream_usage(request.json)
+    usage_counter = None
+    prompt_tokens_future = None
+    if not stream or include_usage:
+        usage_counter = CompletionTokenCounter(ori_model_name)
+        prompt_tokens_future = usage_executor.submit(count_total_input_words, messages, ori_model_name)
+
+    proxy_api_prefix = upstream_selector.acquire()
+    try:
+        upstream_response = send_text_prompt_and_get_response(messages, api_key, account_id, stream, model,
+                                                              proxy_api_prefix)
+    except AttachmentError as e:
+        upstream_selector.release(proxy_api_prefix)
+        logger.error(f"{e}")
+        return jsonify({"error": e.message}), e.status_code
+    except requests.RequestException:
+        upstream_selector.release(proxy_api_prefix, failed=True)
+        raise
+    except Exception:
+        upstream_selector.release(proxy_api_prefix)
+        raise
 
     if upstream_response.status_code != 200:
+        upstream_selector.release(proxy_api_prefix, upstream_response.status_code)
         return jsonify({"error": f"{upstream_response.text}"}), upstream_response.status_code
 
     # 在非流式响应的情况下，我们需要一个变量来累积所有的 new_text
@@ -1930,7 +3800,7 @@ def chat_completions():
         data_queue = Queue()
         stop_event = threading.Event()
         last_data_time = [time.time()]
-        chat_message_id = generate_unique_id("chatcmpl")
+        chunk_encoder = ChunkEncoder(generate_unique_id("chatcmpl"), model, usage_counter=usage_counter)
 
         conversation_id_print_tag = False
 
@@ -1938,14 +3808,12 @@ def chat_completions():
 
         # 启动数据处理线程
         fetcher_thread = threading.Thread(target=data_fetcher, args=(
-            upstream_response, data_queue, stop_event, last_data_time, api_key, chat_message_id, model,
+            upstream_response, data_queue, stop_event, last_data_time, api_key, chunk_encoder, model,
             proxy_api_prefix))
         fetcher_thread.start()
 
-        # 启动保活线程
-        keep_alive_thread = threading.Thread(target=keep_alive,
-                                             args=(last_data_time, stop_event, data_queue, model, chat_message_id))
-        keep_alive_thread.start()
+        # 注册到共享的保活调度器
+        heartbeat_id = heartbeat_scheduler.register(data_queue, chunk_encoder, last_data_time)
 
         try:
             while True:
@@ -1963,23 +3831,9 @@ def chat_completions():
                     # print(f"收到会话id: {conversation_id}")
                 elif data == 'data: [DONE]\n\n':
                     # 接收到结束信号，退出循环
-                    timestamp = int(time.time())
-
-                    new_data = {
-                        "id": chat_message_id,
-                        "object": "chat.completion.chunk",
-                        "created": timestamp,
-                        "model": model,
-                        "choices": [
-                            {
-                                "delta": {},
-                                "index": 0,
-                                "finish_reason": "stop"
-                            }
-                        ]
-                    }
-                    q_data = 'data: ' + json.dumps(new_data, ensure_ascii=False) + '\n\n'
-                    yield q_data
+                    yield chunk_encoder.stop()
+                    if include_usage:
+                        yield chunk_encoder.usage(prompt_tokens_future.result())
 
                     logger.debug(f"会话结束-外层")
                     yield data
@@ -1993,8 +3847,8 @@ def chat_completions():
 
         finally:
             stop_event.set()
+            heartbeat_scheduler.unregister(heartbeat_id)
             fetcher_thread.join()
-            keep_alive_thread.join()
 
             # if conversation_id:
             #     # print(f"准备删除的会话id： {conversation_id}")
@@ -2003,15 +3857,14 @@ def chat_completions():
     if not stream:
         # 执行流式响应的生成函数来累积 all_new_text
         # 迭代生成器对象以执行其内部逻辑
-        for _ in generate(proxy_api_prefix):
-            pass
+        try:
+            for _ in generate(proxy_api_prefix):
+                pass
+        finally:
+            upstream_selector.release(proxy_api_prefix)
         # 构造响应的 JSON 结构
-        ori_model_name = ''
-        model_config = find_model_config(model)
-        if model_config:
-            ori_model_name = model_config.get('ori_name', model)
-        input_tokens = count_total_input_words(messages, ori_model_name)
-        comp_tokens = count_tokens(all_new_text, ori_model_name)
+        input_tokens = prompt_tokens_future.result()
+        comp_tokens = usage_counter.total()
         if input_tokens >= 100 and comp_tokens <= 0:
             # 返回错误消息和状态码429
             error_response = {"error": "空回复"}
@@ -2043,26 +3896,27 @@ def chat_completions():
             # 返回 JSON 响应
             return jsonify(response_json)
     else:
-        return Response(generate(proxy_api_prefix), mimetype='text/event-stream')
+        response = Response(generate(proxy_api_prefix), mimetype='text/event-stream')
+        # 响应关闭时（包括客户端提前断开）归还上游前缀
+        response.call_on_close(lambda: upstream_selector.release(proxy_api_prefix))
+        return response
 
 
 @app.route(f'/{API_PREFIX}/v1/images/generations' if API_PREFIX else '/v1/images/generations', methods=['POST'])
 def images_generations():
     logger.info(f"New Img Request")
-    proxy_api_prefix = getPROXY_API_PREFIX(lock)
-    if proxy_api_prefix == None:
+    if not upstream_selector.has_upstreams():
         return jsonify({"error": "PROXY_API_PREFIX is not accessible"}), 401
     data = request.json
     logger.debug(f"data: {data}")
     api_key = None
     model = data.get('model', "gpt-3.5-turbo")
     ori_model_name = model
-    accessible_model_list = get_accessible_model_list()
-    if model not in accessible_model_list and not 'gpt-4-gizmo-' in model:
-        return jsonify({"error": "model is not accessible"}), 401
     model_config = find_model_config(model)
+    if not model_config and not 'gpt-4-gizmo-' in model:
+        return jsonify({"error": "model is not accessible"}), 401
     if model_config:
-        ori_model_name = model_config.get('ori_name', model)
+        ori_model_name = model_config['ori_name']
     if "o1-" in ori_model_name:
         # 使用列表推导式过滤系统角色
         messages = [message for message in messages if message["role"] in ["user", "assistant"]]
@@ -2086,19 +3940,9 @@ def images_generations():
         logging.info(f"{api_key}:{account_id}")
     except IndexError:
         account_id = None
-    if not api_key.startswith("eyJhb"):
-        refresh_token = api_key
-        if api_key in refresh_dict:
-            logger.info(f"从缓存读取到api_key.........")
-            api_key = refresh_dict.get(api_key)
-        else:
-            if REFRESH_TOACCESS_ENABLEOAI:
-                api_key = oaiGetAccessToken(api_key)
-            else:
-                api_key = oaiFreeGetAccessToken(REFRESH_TOACCESS_OAIFREE_REFRESHTOACCESS_URL, api_key)
-            if not api_key.startswith("eyJhb"):
-                return jsonify({"error": "refresh_token is wrong or refresh_token url is wrong!"}), 401
-            add_to_dict(refresh_token, api_key)
+    api_key = get_access_token(api_key)
+    if not api_key:
+        return jsonify({"error": "refresh_token is wrong or refresh_token url is wrong!"}), 401
 
     logger.info(f"api_key: {api_key}")
 
@@ -2112,9 +3956,19 @@ def images_generations():
         }
     ]
 
-    upstream_response = send_text_prompt_and_get_response(messages, api_key, account_id, False, model, proxy_api_prefix)
+    proxy_api_prefix = upstream_selector.acquire()
+    try:
+        upstream_response = send_text_prompt_and_get_response(messages, api_key, account_id, False, model,
+                                                              proxy_api_prefix)
+    except requests.RequestException:
+        upstream_selector.release(proxy_api_prefix, failed=True)
+        raise
+    except Exception:
+        upstream_selector.release(proxy_api_prefix)
+        raise
 
     if upstream_response.status_code != 200:
+        upstream_selector.release(proxy_api_prefix, upstream_response.status_code)
         return jsonify({"error": f"{upstream_response.text}"}), upstream_response.status_code
 
     # 在非流式响应的情况下，我们需要一个变量来累积所有的 new_text
@@ -2123,14 +3977,10 @@ def images_generations():
     # 处理流式响应
     def generate(proxy_api_prefix):
         nonlocal all_new_text  # 引用外部变量
-        chat_message_id = generate_unique_id("chatcmpl")
-        # 当前时间戳
-        timestamp = int(time.time())
-
-        buffer = ""
-        last_full_text = ""  # 用于存储之前所有出现过的 parts 组成的完整文本
-        last_full_code = ""
-        last_full_code_result = ""
+        chunk_encoder = ChunkEncoder(generate_unique_id("chatcmpl"), model)
+
+        sse_decoder = SSEDecoder()
+        stream_state = StreamState()
         last_content_type = None  # 用于记录上一个消息的内容类型
         conversation_id = ''
         citation_buffer = ""
@@ -2138,29 +3988,25 @@ def images_generations():
         message = None
         for chunk in upstream_response.iter_content(chunk_size=1024):
             if chunk:
-                buffer += chunk.decode('utf-8')
-                # 检查是否存在 "event: ping"，如果存在，则只保留 "data:" 后面的内容
-                if "event: ping" in buffer:
-                    if "data:" in buffer:
-                        buffer = buffer.split("data:", 1)[1]
-                        buffer = "data:" + buffer
-                # 使用正则表达式移除特定格式的字符串
-                # print("应用正则表达式之前的 buffer:", buffer.replace('\n', '\\n'))
-                buffer = re.sub(r'data: \d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d{6}(\r\n|\r|\n){2}', '', buffer)
-                # print("应用正则表达式之后的 buffer:", buffer.replace('\n', '\\n'))
-
-                while 'data:' in buffer and '\n\n' in buffer:
-                    end_index = buffer.index('\n\n') + 2
-                    complete_data, buffer = buffer[:end_index], buffer[end_index:]
+                # ping 事件和时间戳数据已在解析器中过滤
+                for event_name, event_data in sse_decoder.feed(chunk):
+                    data_content = event_data.strip()
                     # 解析 data 块
                     try:
-                        data_json = json.loads(complete_data[6:].strip())
+                        data_json = json.loads(data_content)
+                        if event_name == 'delta_encoding':
+                            stream_state.delta_encoding = data_json
+                            continue
+                        if event_name == 'delta':
+                            # v1 增量编码：把补丁应用到重建的事件上，再按完整事件处理
+                            data_json = stream_state.apply_delta(data_json)
                         # print(f"data_json: {data_json}")
                         message = data_json.get("message", {})
 
                         if message is None:
                             logger.error(f"message 为空: data_json: {data_json}")
 
+                        message_id = message.get("id")
                         message_status = message.get("status")
                         content = message.get("content", {})
                         role = message.get("author", {}).get("role")
@@ -2198,96 +4044,56 @@ def images_generations():
                                     is_img_message = True
                                     asset_pointer = part.get('asset_pointer').replace('file-service://', '')
                                     logger.debug(f"asset_pointer: {asset_pointer}")
-                                    image_url = f"{BASE_URL}{proxy_api_prefix}/backend-api/files/{asset_pointer}/download"
-
-                                    headers = {
-                                        "Authorization": f"Bearer {api_key}"
-                                    }
-                                    image_response = requests.get(image_url, headers=headers)
-
-                                    if image_response.status_code == 200:
-                                        download_url = image_response.json().get('download_url')
-                                        logger.debug(f"download_url: {download_url}")
-                                        if USE_OAIUSERCONTENT_URL == True and response_format == "url":
-                                            image_link = f"{download_url}"
-                                            image_urls.append(image_link)  # 将图片链接保存到列表中
+                                    if response_format == "url" and USE_OAIUSERCONTENT_URL == False:
+                                        # 图片在后台下载保存，先返回固定的图片地址
+                                        today_image_url = image_persister.persist(asset_pointer, api_key,
+                                                                                  proxy_api_prefix)
+                                        image_urls.append(f"{UPLOAD_BASE_URL}/{today_image_url}")
+                                        new_text = ""
+                                    else:
+                                        download_url = get_download_url(asset_pointer, api_key, proxy_api_prefix)
+                                        if download_url and response_format == "url":
+                                            image_urls.append(download_url)  # 将图片链接保存到列表中
                                             new_text = ""
-                                        else:
-                                            if response_format == "url":
-                                                # 从URL下载图片
-                                                # image_data = requests.get(download_url).content
-                                                image_download_response = requests.get(download_url)
-                                                # print(f"image_download_response: {image_download_response.text}")
-                                                if image_download_response.status_code == 200:
-                                                    logger.debug(f"下载图片成功")
-                                                    image_data = image_download_response.content
-                                                    today_image_url = save_image(image_data)  # 保存图片，并获取文件名
-                                                    # new_text = f"\n![image]({UPLOAD_BASE_URL}/{today_image_url})\n[下载链接]({UPLOAD_BASE_URL}/{today_image_url})\n"
-                                                    image_link = f"{UPLOAD_BASE_URL}/{today_image_url}"
-                                                    image_urls.append(image_link)  # 将图片链接保存到列表中
-                                                    new_text = ""
-                                                else:
-                                                    logger.error(f"下载图片失败: {image_download_response.text}")
+                                        elif download_url:
+                                            # 使用base64编码图片
+                                            image_download_response = http_client.get(download_url)
+                                            if image_download_response.status_code == 200:
+                                                logger.debug(f"下载图片成功")
+                                                image_data = image_download_response.content
+                                                image_base64 = base64.b64encode(image_data).decode('utf-8')
+                                                image_urls.append(image_base64)
+                                                new_text = ""
                                             else:
-                                                # 使用base64编码图片
-                                                # image_data = requests.get(download_url).content
-                                                image_download_response = requests.get(download_url)
-                                                if image_download_response.status_code == 200:
-                                                    logger.debug(f"下载图片成功")
-                                                    image_data = image_download_response.content
-                                                    image_base64 = base64.b64encode(image_data).decode('utf-8')
-                                                    image_urls.append(image_base64)
-                                                    new_text = ""
-                                                else:
-                                                    logger.error(f"下载图片失败: {image_download_response.text}")
-                                        if last_content_type == "code":
-                                            new_text = new_text
-                                            # new_text = "\n```\n" + new_text
-                                        logger.debug(f"new_text: {new_text}")
-                                        is_img_message = True
-                                    else:
-                                        logger.error(f"获取图片下载链接失败: {image_response.text}")
+                                                logger.error(f"下载图片失败: {image_download_response.text}")
+                                    logger.debug(f"new_text: {new_text}")
                             except:
                                 pass
 
                         if is_img_message == False:
                             # print(f"data_json: {data_json}")
                             if content_type == "multimodal_text" and last_content_type == "code":
-                                new_text = "\n```\n" + content.get("text", "")
+                                new_text = "\n```\n" + str(content.get("text", ""))
                             elif role == "tool" and name == "dalle.text2im":
                                 logger.debug(f"无视消息: {content.get('text', '')}")
                                 continue
                             # 代码块特殊处理
                             if content_type == "code" and last_content_type != "code" and content_type != None:
-                                full_code = ''.join(content.get("text", ""))
-                                new_text = "\n```\n" + full_code[len(last_full_code):]
-                                # print(f"full_code: {full_code}")
-                                # print(f"last_full_code: {last_full_code}")
+                                new_text = "\n```\n" + stream_state.take('code', message_id, content.get("text", ""))
                                 # print(f"new_text: {new_text}")
-                                last_full_code = full_code  # 更新完整代码以备下次比较
 
                             elif last_content_type == "code" and content_type != "code" and content_type != None:
-                                full_code = ''.join(content.get("text", ""))
-                                new_text = "\n```\n" + full_code[len(last_full_code):]
-                                # print(f"full_code: {full_code}")
-                                # print(f"last_full_code: {last_full_code}")
+                                new_text = "\n```\n" + stream_state.take('code', message_id, content.get("text", ""))
                                 # print(f"new_text: {new_text}")
-                                last_full_code = ""  # 更新完整代码以备下次比较
+                                stream_state.reset('code')
 
                             elif content_type == "code" and last_content_type == "code" and content_type != None:
-                                full_code = ''.join(content.get("text", ""))
-                                new_text = full_code[len(last_full_code):]
-                                # print(f"full_code: {full_code}")
-                                # print(f"last_full_code: {last_full_code}")
+                                new_text = stream_state.take('code', message_id, content.get("text", ""))
                                 # print(f"new_text: {new_text}")
-                                last_full_code = full_code  # 更新完整代码以备下次比较
 
                             else:
                                 # 只获取新的 parts
-                                parts = content.get("parts", [])
-                                full_text = ''.join(parts)
-                                new_text = full_text[len(last_full_text):]
-                                last_full_text = full_text  # 更新完整文本以备下次比较
+                                new_text = stream_state.take('text', message_id, content.get("parts", []))
                                 if "\u3010" in new_text and not citation_accumulating:
                                     citation_accumulating = True
                                     citation_buffer = citation_buffer + new_text
@@ -2325,117 +4131,56 @@ def images_generations():
                             # Python 工具执行输出特殊处理
                             if role == "tool" and name == "python" and last_content_type != "execution_output" and content_type != None:
 
-                                full_code_result = ''.join(content.get("text", ""))
-                                new_text = "`Result:` \n```\n" + full_code_result[len(last_full_code_result):]
+                                new_text = "`Result:` \n```\n" + stream_state.take('code_result', message_id, content.get("text", ""))
                                 if last_content_type == "code":
                                     new_text = "\n```\n" + new_text
-                                # print(f"full_code_result: {full_code_result}")
-                                # print(f"last_full_code_result: {last_full_code_result}")
                                 # print(f"new_text: {new_text}")
-                                last_full_code_result = full_code_result  # 更新完整代码以备下次比较
                             elif last_content_type == "execution_output" and (
                                     role != "tool" or name != "python") and content_type != None:
                                 # new_text = content.get("text", "") + "\n```"
-                                full_code_result = ''.join(content.get("text", ""))
-                                new_text = full_code_result[len(last_full_code_result):] + "\n```\n"
+                                new_text = stream_state.take('code_result', message_id, content.get("text", "")) + "\n```\n"
                                 if content_type == "code":
                                     new_text = new_text + "\n```\n"
-                                # print(f"full_code_result: {full_code_result}")
-                                # print(f"last_full_code_result: {last_full_code_result}")
                                 # print(f"new_text: {new_text}")
-                                last_full_code_result = ""  # 更新完整代码以备下次比较
+                                stream_state.reset('code_result')
                             elif last_content_type == "execution_output" and role == "tool" and name == "python" and content_type != None:
-                                full_code_result = ''.join(content.get("text", ""))
-                                new_text = full_code_result[len(last_full_code_result):]
-                                # print(f"full_code_result: {full_code_result}")
-                                # print(f"last_full_code_result: {last_full_code_result}")
+                                new_text = stream_state.take('code_result', message_id, content.get("text", ""))
                                 # print(f"new_text: {new_text}")
-                                last_full_code_result = full_code_result
 
                         # print(f"收到数据: {data_json}")
-                        # print(f"收到的完整文本: {full_text}")
-                        # print(f"上次收到的完整文本: {last_full_text}")
                         # print(f"新的文本: {new_text}")
 
                         # 更新 last_content_type
                         if content_type != None:
                             last_content_type = content_type if role != "user" else last_content_type
 
-                        new_data = {
-                            "id": chat_message_id,
-                            "object": "chat.completion.chunk",
-                            "created": timestamp,
-                            "model": message.get("metadata", {}).get("model_slug"),
-                            "choices": [
-                                {
-                                    "index": 0,
-                                    "delta": {
-                                        "content": ''.join(new_text)
-                                    },
-                                    "finish_reason": None
-                                }
-                            ]
-                        }
                         # print(f"Role: {role}")
-                        logger.info(f"发送消息: {new_text}")
-                        tmp = 'data: ' + json.dumps(new_data, ensure_ascii=False) + '\n\n'
-                        # print(f"发送数据: {tmp}")
+                        logger.debug(f"发送消息: {new_text}")
                         # 累积 new_text
                         all_new_text += new_text
-                        yield 'data: ' + json.dumps(new_data, ensure_ascii=False) + '\n\n'
+                        yield chunk_encoder.content(new_text, message.get("metadata", {}).get("model_slug"))
                     except json.JSONDecodeError:
                         # print("JSON 解析错误")
-                        logger.info(f"发送数据: {complete_data}")
-                        if complete_data == 'data: [DONE]\n\n':
+                        logger.info(f"发送数据: {data_content}")
+                        if data_content == '[DONE]':
                             logger.info(f"会话结束")
-                            yield complete_data
+                            yield 'data: [DONE]\n\n'
         if citation_buffer != "":
-            new_data = {
-                "id": chat_message_id,
-                "object": "chat.completion.chunk",
-                "created": timestamp,
-                "model": message.get("metadata", {}).get("model_slug"),
-                "choices": [
-                    {
-                        "index": 0,
-                        "delta": {
-                            "content": ''.join(citation_buffer)
-                        },
-                        "finish_reason": None
-                    }
-                ]
-            }
-            tmp = 'data: ' + json.dumps(new_data) + '\n\n'
-            # print(f"发送数据: {tmp}")
             # 累积 new_text
             all_new_text += citation_buffer
-            yield 'data: ' + json.dumps(new_data) + '\n\n'
+            yield chunk_encoder.content(citation_buffer, message.get("metadata", {}).get("model_slug"))
+        buffer = sse_decoder.flush()
         if buffer:
             # print(f"最后的数据: {buffer}")
             # delete_conversation(conversation_id, api_key)
             try:
                 buffer_json = json.loads(buffer)
                 error_message = buffer_json.get("detail", {}).get("message", "未知错误")
-                error_data = {
-                    "id": chat_message_id,
-                    "object": "chat.completion.chunk",
-                    "created": timestamp,
-                    "model": "error",
-                    "choices": [
-                        {
-                            "index": 0,
-                            "delta": {
-                                "content": ''.join("```\n" + error_message + "\n```")
-                            },
-                            "finish_reason": None
-                        }
-                    ]
-                }
-                tmp = 'data: ' + json.dumps(error_data) + '\n\n'
-                logger.info(f"发送最后的数据: {tmp}")
+                q_data = chunk_encoder.content("```\n" + error_message + "\n```", "error")
+                logger.info(f"发送最后的数据: {q_data}")
                 # 累积 new_text
-                all_new_text += ''.join("```\n" + error_message + "\n```")
-                yield 'data: ' + json.dumps(error_data) + '\n\n'
+                all_new_text += "```\n" + error_message + "\n```"
+                yield q_data
             except:
                 # print("JSON 解析错误")
                 logger.info(f"发送最后的数据: {buffer}")
@@ -2445,8 +4190,11 @@ def images_generations():
 
     # 执行流式响应的生成函数来累积 all_new_text
     # 迭代生成器对象以执行其内部逻辑
-    for _ in generate(proxy_api_prefix):
-        pass
+    try:
+        for _ in generate(proxy_api_prefix):
+            pass
+    finally:
+        upstream_selector.release(proxy_api_prefix)
     # 构造响应的 JSON 结构
     response_json = {}
     # 检查 image_urls 是否为空
@@ -2532,53 +4280,45 @@ def catch_all(path):
 @app.route('/images/<filename>')
 @cross_origin()  # 使用装饰器来允许跨域请求
 def get_image(filename):
-    # 检查文件是否存在
-    if not os.path.isfile(os.path.join('images', filename)):
-        return "文件不存在哦！", 404
-    return send_from_directory('images', filename)
+    # 图片仍在后台下载时等待下载完成
+    if not image_store.resolve(filename):
+        image_persister.wait(filename)
+    return serve_stored_file(image_store, filename)
 
 
 @app.route('/files/<filename>')
 @cross_origin()  # 使用装饰器来允许跨域请求
 def get_file(filename):
-    # 检查文件是否存在
-    if not os.path.isfile(os.path.join('files', filename)):
-        return "文件不存在哦！", 404
-    return send_from_directory('files', filename)
+    return serve_stored_file(file_store, filename)
 
 
 @app.route(f'/{API_PREFIX}/getAccountID' if API_PREFIX else '/getAccountID', methods=['POST'])
 @cross_origin()  # 使用装饰器来允许跨域请求
 def getAccountID():
     logger.info(f"New Account Request")
-    proxy_api_prefix = getPROXY_API_PREFIX(lock)
-    if proxy_api_prefix is None:
+    if not upstream_selector.has_upstreams():
         return jsonify({"error": "PROXY_API_PREFIX is not accessible"}), 401
     auth_header = request.headers.get('Authorization')
     if not auth_header or not auth_header.startswith('Bearer '):
         return jsonify({"error": "Authorization header is missing or invalid"}), 401
     api_key = auth_header.split(' ')[1].split(',')[0].strip()
 
-    if not api_key.startswith("eyJhb"):
-        refresh_token = api_key
-        if api_key in refresh_dict:
-            logger.info(f"从缓存读取到api_key.........")
-            api_key = refresh_dict.get(api_key)
-        else:
-            if REFRESH_TOACCESS_ENABLEOAI:
-                api_key = oaiGetAccessToken(api_key)
-            else:
-                api_key = oaiFreeGetAccessToken(REFRESH_TOACCESS_OAIFREE_REFRESHTOACCESS_URL, api_key)
-            if not api_key.startswith("eyJhb"):
-                return jsonify({"error": "refresh_token is wrong or refresh_token url is wrong!"}), 401
-            add_to_dict(refresh_token, api_key)
+    api_key = get_access_token(api_key)
+    if not api_key:
+        return jsonify({"error": "refresh_token is wrong or refresh_token url is wrong!"}), 401
     logger.info(f"api_key: {api_key}")
 
+    proxy_api_prefix = upstream_selector.acquire()
     url = f"{BASE_URL}{proxy_api_prefix}/backend-api/accounts/check/v4-2023-04-27"
     headers = {
         "Authorization": "Bearer " + api_key
     }
-    res = requests.get(url, headers=headers)
+    try:
+        res = http_client.get(url, headers=headers)
+    except requests.RequestException:
+        upstream_selector.release(proxy_api_prefix, failed=True)
+        raise
+    upstream_selector.release(proxy_api_prefix, res.status_code)
     if res.status_code == 200:
         data = res.json()
         result = {"plus": set(), "team": set()}
@@ -2594,43 +4334,501 @@ def getAccountID():
         return jsonify({"error": "Request failed."}), 400
 
 
+@app.route(f'/{API_PREFIX}/ready' if API_PREFIX else '/ready', methods=['GET'])
+@cross_origin()  # 使用装饰器来允许跨域请求
+def get_ready():
+    # 内置模型在启动时即可使用，GPTs 加载完成后才返回 200
+    ready = gpts_loaded.is_set()
+    return jsonify({
+        "ready": ready,
+        "models": len(get_accessible_model_list())
+    }), 200 if ready else 503
+
+
+def stats_route(path):
+    """
+    统计接口会暴露运行状态，只在设置了 backend_container_api_prefix 时开放
+    """
+
+    def decorator(func):
+        if API_PREFIX:
+            app.route(f'/{API_PREFIX}{path}', methods=['GET'])(cross_origin()(func))
+        return func
+
+    return decorator
+
+
+@stats_route('/stats')
+def get_stats():
+    return jsonify({
+        "http_pool": get_http_pool_stats(),
+        "upstreams": upstream_selector.snapshot(),
+        "heartbeat": heartbeat_scheduler.snapshot(),
+        "token_exchange": token_singleflight.snapshot(),
+        "token_refresher": token_refresher.last_summary,
+        "redis": redis_store.snapshot(),
+        "storage": {
+            "images": image_store.last_summary,
+            "files": file_store.last_summary
+        },
+        "image_persister": image_persister.snapshot()
+    })
+
+
+@stats_route('/stats/redis')
+def get_redis_stats():
+    # 遍历各命名空间的 key，Redis 中 key 较多时耗时较长，不放在 /stats 中
+    try:
+        keyspace = redis_store.keyspace()
+    except redis.RedisError as e:
+        keyspace = {"error": str(e)}
+    return jsonify({
+        "cache": redis_store.snapshot(),
+        "keyspace": keyspace
+    })
+
+
+import random
+
+
+class TokenBucket:
+    """
+    令牌桶限速：每秒补充 rate 个令牌，最多积累 capacity 个
+    """
+
+    def __init__(self, rate, capacity):
+        if rate <= 0 or capacity < 1:
+            raise ValueError(f"token_refresher 的 rate 必须大于 0，burst 不能小于 1，当前为 {rate}, {capacity}")
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class BulkTokenRefresher:
+    """
+    并发刷新所有已知的 refresh_token：只刷新剩余有效期不足 refresh_ahead 秒的 token，
+    对认证接口限速，临时错误按指数退避加抖动重试，失效的 refresh_token 从缓存中移除
+    """
+
+    def __init__(self, workers, rate, burst, retries, refresh_ahead):
+        self.workers = workers
+        self.bucket = TokenBucket(rate, burst)
+        self.retries = retries
+        self.refresh_ahead = refresh_ahead
+        self.last_summary = None
+
+    def refresh_one(self, refresh_token):
+        cached = token_cache.get(refresh_token, skip_local=True)
+        if cached and cached[1] - time.time() > self.refresh_ahead:
+            return 'skipped', 0
+        for attempt in range(self.retries + 1):
+            self.bucket.acquire()
+            try:
+                # 与请求中的换取共用 single-flight 和 Redis 锁，同一个 refresh_token 不会被重复换取
+                access_token = token_singleflight.do(refresh_token, lambda: exchange_with_lock(
+                    refresh_token, request_access_token, self.refresh_ahead))
+                if not access_token:
+                    # 合并到了请求中的换取，只拿到失败结果而没有错误类型，按临时错误重试
+                    raise TokenExchangeError("access_token 换取失败", transient=True)
+            except TokenExchangeError as e:
+                if not e.transient:
+                    logger.warning(f"refresh_token 已失效，移除缓存: {e}")
+                    token_cache.delete(refresh_token)
+                    return 'evicted', attempt
+                if attempt == self.retries:
+                    logger.error(f"刷新 access_token 失败: {e}")
+                    return 'failed', attempt
+                time.sleep(min(2 ** attempt, 30) * random.uniform(0.5, 1.5))
+                continue
+            return 'refreshed', attempt
+        return 'failed', self.retries
+
+    def run(self):
+        started_at = time.time()
+        refresh_tokens = token_cache.refresh_tokens()
+        summary = {'total': len(refresh_tokens), 'refreshed': 0, 'skipped': 0, 'failed': 0, 'evicted': 0,
+                   'retries': 0}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for result, retries in executor.map(self.refresh_one, refresh_tokens):
+                summary[result] += 1
+                summary['retries'] += retries
+        summary['started_at'] = int(started_at)
+        summary['elapsed'] = round(time.time() - started_at, 3)
+        self.last_summary = summary
+        return summary
+
+
+token_refresher = BulkTokenRefresher(TOKEN_REFRESHER_WORKERS, TOKEN_REFRESHER_RATE, TOKEN_REFRESHER_BURST,
+                                     TOKEN_REFRESHER_RETRIES, TOKEN_REFRESHER_REFRESH_AHEAD)
+
+
 # 内置自动刷新access_token
-def updateRefresh_dict():
-    success_num = 0
-    error_num = 0
+def refresh_access_tokens():
     logger.info(f"==========================================")
     logging.info("开始更新access_token.........")
-    for key in refresh_dict:
-        refresh_token = key
-        if REFRESH_TOACCESS_ENABLEOAI:
-            access_token = oaiGetAccessToken(key)
-        else:
-            access_token = oaiFreeGetAccessToken(REFRESH_TOACCESS_OAIFREE_REFRESHTOACCESS_URL, key)
-        if not access_token.startswith("eyJhb"):
-            logger.debug("refresh_token is wrong or refresh_token url is wrong!")
-            error_num += 1
-        add_to_dict(refresh_token, access_token)
-        success_num += 1
-    logging.info("更新成功: " + str(success_num) + ", 失败: " + str(error_num))
+    summary = token_refresher.run()
+    logging.info(f"更新成功: {summary['refreshed']}, 未到期: {summary['skipped']}, 失败: {summary['failed']}, "
+                 f"移除: {summary['evicted']}, 重试: {summary['retries']}, 耗时: {summary['elapsed']}s")
     logger.info(f"==========================================")
-    logging.info("开始更新KEY_FOR_GPTS_INFO_ACCESS_TOKEN和GPTS配置信息.......")
-    # 加载配置并添加到全局列表
-    gpts_data = load_gpts_config("./data/gpts.json")
-    add_config_to_global_list(BASE_URL, getPROXY_API_PREFIX(lock), gpts_data)
 
-    accessible_model_list = get_accessible_model_list()
-    logger.info(f"当前可用 GPTS 列表: {accessible_model_list}")
 
-    # 检查列表中是否有重复的模型名称
-    if len(accessible_model_list) != len(set(accessible_model_list)):
-        raise Exception("检测到重复的模型名称，请检查环境变量或配置文件......")
+# 内置自动刷新GPTS配置信息
+def updateRefresh_dict():
+    logger.info(f"==========================================")
+    logging.info("开始更新KEY_FOR_GPTS_INFO_ACCESS_TOKEN和GPTS配置信息.......")
+    load_gpts_models()
     logging.info("更新KEY_FOR_GPTS_INFO_ACCESS_TOKEN和GPTS配置信息成功......")
     logger.info(f"==========================================")
 
 
-# 每天3点自动刷新
+# 每天3点自动刷新GPTS配置信息
 scheduler.add_job(id='updateRefresh_run', func=updateRefresh_dict, trigger='cron', hour=3, minute=0)
+# access_token 按剩余有效期分散刷新，每次只处理即将过期的 token
+scheduler.add_job(id='refreshAccessToken_run', func=refresh_access_tokens, trigger='interval',
+                  seconds=TOKEN_REFRESHER_INTERVAL, jitter=min(TOKEN_REFRESHER_INTERVAL // 10, 60))
+
+
+def sweep_storage():
+    for store in (image_store, file_store):
+        summary = store.sweep()
+        logger.info(f"清理 {store.root}: 删除 {summary['removed']} 个文件，释放 {summary['freed']} 字节，"
+                    f"剩余 {summary['files']} 个文件，共 {summary['bytes']} 字节")
+
+
+# 定时清理 ./images 和 ./files
+scheduler.add_job(id='sweepStorage_run', func=sweep_storage, trigger='interval', seconds=STORAGE_SWEEP_INTERVAL)
+
+import asyncio
+
+CHAT_COMPLETIONS_PATH = f'/{API_PREFIX}/v1/chat/completions' if API_PREFIX else '/v1/chat/completions'
+
+CORS_HEADERS = [
+    (b'access-control-allow-origin', b'*'),
+    (b'access-control-allow-headers', b'Content-Type,Authorization,X-Requested-With'),
+    (b'access-control-allow-methods', b'GET,PUT,POST,DELETE,OPTIONS')
+]
+
+
+def create_async_http_client():
+    import httpx
+    # 每个流只占用一个连接，不限制总连接数，空闲连接按 pool_maxsize 保留
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(HTTP_CLIENT_READ_TIMEOUT, connect=HTTP_CLIENT_CONNECT_TIMEOUT),
+        limits=httpx.Limits(max_connections=None, max_keepalive_connections=HTTP_CLIENT_POOL_MAXSIZE)
+    )
+
+
+async def read_asgi_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body += message.get('body', b'')
+        if not message.get('more_body', False):
+            return body
+
+
+def replay_asgi_body(body, receive):
+    # 请求体已被读取，转交给 WSGI 应用前重新提供一次
+    pending = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+    async def replay():
+        if pending:
+            return pending.pop()
+        return await receive()
+
+    return replay
+
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def send_asgi_json(send, data, status_code):
+    await send({
+        'type': 'http.response.start',
+        'status': status_code,
+        'headers': [(b'content-type', b'application/json')] + CORS_HEADERS
+    })
+    await send({'type': 'http.response.body', 'body': json.dumps(data).encode('utf-8')})
+
+
+class AsyncStreamingApp:
+    """
+    ASGI 入口：流式 /v1/chat/completions 在事件循环中转发，其余请求仍交给 Flask 处理
+    """
+
+    def __init__(self, wsgi_app):
+        from a2wsgi import WSGIMiddleware
+        self.wsgi = WSGIMiddleware(wsgi_app, workers=SERVER_THREADS)
+        self.client = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] == CHAT_COMPLETIONS_PATH:
+            body = await read_asgi_body(receive)
+            if body is None:
+                return
+            try:
+                data = json.loads(body)
+            except ValueError:
+                data = None
+            if isinstance(data, dict) and data.get('stream'):
+                headers = {key.decode('latin-1').lower(): value.decode('latin-1') for key, value in scope['headers']}
+                await self.stream_chat_completions(data, headers.get('authorization'), receive, send)
+                return
+            receive = replay_asgi_body(body, receive)
+        await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.client = create_async_http_client()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.client is not None:
+                    await self.client.aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def stream_chat_completions(self, data, auth_header, receive, send):
+        import httpx
+        logger.info(f"New Request")
+        loop = asyncio.get_running_loop()
+        # 校验、换取 token 和上传附件仍是同步代码，放到线程池执行，不阻塞事件循环
+        try:
+            messages, model, stream, api_key, account_id = await loop.run_in_executor(
+                None, parse_chat_request, data, auth_header)
+        except ChatRequestError as e:
+            await send_asgi_json(send, {"error": e.message}, e.status_code)
+            return
+
+        # stream_options.include_usage 时统计 usage，输入 token 在后台统计
+        prompt_tokens_future = None
+        if wants_stream_usage(data):
+            prompt_tokens_future = usage_executor.submit(count_total_input_words, messages,
+                                                         get_ori_model_name(model))
+
+        proxy_api_prefix = upstream_selector.acquire()
+        status_code = None
+        failed = False
+        try:
+            try:
+                conversation_request = await loop.run_in_executor(
+                    None, build_conversation_request, messages, api_key, account_id, model, proxy_api_prefix)
+            except AttachmentError as e:
+                logger.error(f"{e}")
+                await send_asgi_json(send, {"error": e.message}, e.status_code)
+                return
+            if not conversation_request:
+                await send_asgi_json(send, {"error": "model is not accessible"}, 401)
+                return
+            url, headers, payload = conversation_request
+            async with self.client.stream('POST', url, headers=headers, json=payload) as upstream_response:
+                status_code = upstream_response.status_code
+                if status_code != 200:
+                    text = (await upstream_response.aread()).decode('utf-8', errors='replace')
+                    await send_asgi_json(send, {"error": text}, status_code)
+                    return
+                await send({
+                    'type': 'http.response.start',
+                    'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream; charset=utf-8')] + CORS_HEADERS
+                })
+                await self.relay_stream(upstream_response, api_key, model, proxy_api_prefix, receive, send,
+                                        prompt_tokens_future)
+        except httpx.HTTPError:
+            failed = True
+            raise
+        finally:
+            upstream_selector.release(proxy_api_prefix, status_code, failed)
+
+    async def relay_stream(self, upstream_response, api_key, model, proxy_api_prefix, receive, send,
+                           prompt_tokens_future=None):
+        loop = asyncio.get_running_loop()
+        usage_counter = CompletionTokenCounter(get_ori_model_name(model)) if prompt_tokens_future else None
+        chunk_encoder = ChunkEncoder(generate_unique_id("chatcmpl"), model, usage_counter=usage_counter)
+        translator = StreamTranslator(api_key, chunk_encoder, model, proxy_api_prefix)
+        chunks = upstream_response.aiter_bytes()
+        disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+        next_chunk = None
+        conversation_id_print_tag = False
+
+        async def send_items(items):
+            nonlocal conversation_id_print_tag
+            for item in items:
+                if isinstance(item, tuple) and item[0] == 'all_new_text':
+                    logger.info(f"完整消息: {item[1]}")
+                elif isinstance(item, tuple) and item[0] == 'conversation_id':
+                    if conversation_id_print_tag == False:
+                        logger.info(f"当前会话id: {item[1]}")
+                        conversation_id_print_tag = True
+                elif item == 'data: [DONE]\n\n':
+                    await send({'type': 'http.response.body', 'body': chunk_encoder.stop().encode('utf-8'),
+                                'more_body': True})
+                    if prompt_tokens_future:
+                        prompt_tokens = await asyncio.wrap_future(prompt_tokens_future)
+                        await send({'type': 'http.response.body',
+                                    'body': chunk_encoder.usage(prompt_tokens).encode('utf-8'), 'more_body': True})
+                    logger.debug(f"会话结束-外层")
+                    await send({'type': 'http.response.body', 'body': item.encode('utf-8')})
+                    return True
+                else:
+                    await send({'type': 'http.response.body', 'body': item.encode('utf-8'), 'more_body': True})
+                    # STEAM_SLEEP_TIME 优化传输质量，改善卡顿现象
+                    if STEAM_SLEEP_TIME > 0:
+                        await asyncio.sleep(STEAM_SLEEP_TIME)
+            return False
+
+        try:
+            while True:
+                if next_chunk is None:
+                    next_chunk = asyncio.ensure_future(chunks.__anext__())
+                # 事件循环上的保活计时器：heartbeat_interval 秒内没有上游数据就发送空增量
+                done, _ = await asyncio.wait({next_chunk, disconnected}, timeout=SERVER_HEARTBEAT_INTERVAL,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if disconnected in done:
+                    logger.info(f"客户端已断开，停止转发")
+                    return
+                if not done:
+                    await send({'type': 'http.response.body', 'body': chunk_encoder.keep_alive_frame.encode('utf-8'),
+                                'more_body': True})
+                    continue
+                try:
+                    chunk = next_chunk.result()
+                except StopAsyncIteration:
+                    next_chunk = None
+                    break
+                next_chunk = None
+                if chunk:
+                    # 翻译过程中可能下载图片等同步请求，放到线程池执行
+                    if await send_items(await loop.run_in_executor(None, translator.feed, chunk)):
+                        return
+            items = await loop.run_in_executor(None, translator.finish)
+        except Exception as e:
+            logger.error(f"Exception: {e}")
+            items = translator.abort()
+        finally:
+            disconnected.cancel()
+            if next_chunk is not None:
+                next_chunk.cancel()
+        if not await send_items(items):
+            await send({'type': 'http.response.body', 'body': b''})
+
+
+def run_asgi_server():
+    import uvicorn
+    uvicorn.run(AsyncStreamingApp(app), host='0.0.0.0', port=33333, lifespan='on', log_level=LOG_LEVEL.lower())
+
+
+scheduler_lock_file = None
+
+
+def start_scheduler_once(lock_path):
+    """
+    每个 worker 在后台线程中等待文件锁，只有持有锁的 worker 启动定时任务；
+    该 worker 退出（包括平滑重启）后锁被释放，由其余 worker 中的一个接管
+    """
+    try:
+        import fcntl
+    except ImportError:
+        # 没有 fcntl 的平台上不会以多进程方式运行，直接启动定时任务
+        scheduler.start()
+        return
+    lock_file = open(lock_path, 'w')
+
+    def acquire():
+        global scheduler_lock_file
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        # 保持文件对象的引用，避免被回收后释放锁
+        scheduler_lock_file = lock_file
+        scheduler.start()
+        logger.info(f"定时任务在 worker {os.getpid()} 中运行")
+
+    threading.Thread(target=acquire, name='scheduler-lock', daemon=True).start()
+
+
+def preload_state():
+    # 在 fork 之前加载 tiktoken 编码，worker 通过写时复制共享
+    try:
+        for model_name in ['gpt-3.5-turbo', 'gpt-4']:
+            get_token_encoder(model_name)
+    except Exception as e:
+        logger.warning(f"预加载 tiktoken 编码失败: {e}")
+    # Pillow 在 worker 中按需导入，这里只预先导入模块，由 worker 共享
+    import importlib
+    importlib.import_module('PIL.Image')
+
+
+def reset_after_fork():
+    global http_client
+    # 父进程中建立的连接不能在子进程中复用，重新创建连接池
+    http_client = create_http_client()
+    if SERVER_FAST_START:
+        load_gpts_models_in_background()
+
+
+def gunicorn_post_fork(server, worker):
+    reset_after_fork()
+    start_scheduler_once(os.path.join(tempfile.gettempdir(), f'refreshtov1api-scheduler-{server.pid}.lock'))
+
+
+def run_gunicorn_server():
+    from gunicorn.app.base import BaseApplication
+
+    class GunicornApplication(BaseApplication):
+        def load_config(self):
+            options = {
+                'bind': '0.0.0.0:33333',
+                'workers': SERVER_WORKERS,
+                'threads': SERVER_THREADS,
+                'worker_class': 'uvicorn.workers.UvicornWorker' if SERVER_MODE == 'asgi' else 'gthread',
+                # 配置、GPTS 和 tiktoken 在主进程加载一次后再 fork
+                'preload_app': True,
+                # send_file 返回的文件通过 sendfile 发送，不经过 Python 读写
+                'sendfile': True,
+                'graceful_timeout': SERVER_GRACEFUL_TIMEOUT,
+                'post_fork': gunicorn_post_fork,
+                'loglevel': LOG_LEVEL.lower()
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            preload_state()
+            return AsyncStreamingApp(app) if SERVER_MODE == 'asgi' else app
+
+    GunicornApplication().run()
+
 
 # 运行 Flask 应用
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=33333, threaded=True)
+    if SERVER_USES_GUNICORN:
+        run_gunicorn_server()
+    elif SERVER_MODE == 'asgi':
+        scheduler.start()
+        run_asgi_server()
+    else:
+        scheduler.start()
+        app.run(host='0.0.0.0', port=33333, threaded=True)